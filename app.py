@@ -1,9 +1,17 @@
+import asyncio
 import streamlit as st
 import re
 
 # --- IMPORT UTILITIES ---
-from utils.llm import generate_response
-from utils.parser import parse_response
+from utils.llm import (
+    GENERATION_TIMEOUT, get_handle, lookup_cached, response_cache, server_client, shared_batcher,
+    store_response, stream_response_async, token_budget
+)
+from utils.parser import SECTIONS, aiter_sections, is_complete, parse_response, parse_test_cases
+from utils.prompts import build_app_prompt
+from utils.sandbox import SANDBOX_WORKERS, SandboxPool
+from utils.scheduler import Overloaded, QueueTimeout
+from utils.telemetry import RequestTrace, metrics, timed
 from utils.visualizer import render_mermaid, validate_and_fix_mermaid
 
 # ---------------------------------------------------------------------
@@ -31,20 +39,219 @@ st.markdown("""
 </style>
 """, unsafe_allow_html=True)
 
+# ---------------------------------------------------------------------
+# Model Handle (loaded once per process, in the background)
+# ---------------------------------------------------------------------
+@st.cache_resource
+def model_handle():
+    return get_handle().start()
+
+@st.cache_resource
+def sandbox_pool():
+    """Warm worker interpreters for running generated code against its test cases."""
+    return SandboxPool().start()
+
+def render_server_status(client):
+    status = client.status()
+    if status.get("ready"):
+        st.success("🟢 Inference server ready")
+    elif status.get("status") == "unreachable":
+        st.error(f"🔴 Inference server unreachable: {status.get('error')}")
+    elif status.get("draining"):
+        st.warning("🟡 Inference server is draining")
+    else:
+        st.warning(f"🟡 Inference server model {status.get('status', 'loading')}...")
+
+def render_model_status(handle):
+    if handle.ready:
+        st.success(f"🟢 Model ready on `{handle.backend.describe()}` (loaded in {handle.load_seconds:.1f} s)")
+        if handle.load_phases:
+            st.caption(" · ".join(f"{name}: {seconds:.1f} s" for name, seconds in handle.load_phases.items()))
+    elif handle.status == "failed":
+        st.error(f"🔴 Model failed to load: {handle.error}")
+    else:
+        st.warning("🟡 Loading model in the background...")
+
+def render_stats_panel(client):
+    """Per-stage latencies and token counters (utils.telemetry); the server's too when remote."""
+    snapshots = {"This process": metrics.snapshot()}
+    if client:
+        try:
+            snapshots["Inference server"] = client.stats().get("telemetry", {})
+        except Exception as e:
+            st.caption(f"Server telemetry unavailable: {e}")
+    for title, snap in snapshots.items():
+        if not snap.get("stages"):
+            continue
+        st.caption(title)
+        col1, col2 = st.columns(2)
+        if "generated_tokens_total" in snap["counters"]:
+            col1.metric("Decode tok/s", f"{snap['gauges'].get('decode_tokens_per_second', 0):.1f}")
+            col2.metric("Generated tokens", snap["counters"]["generated_tokens_total"])
+        st.table([
+            {"stage": name, "n": s["count"], "p50 ms": round(1000 * s["p50"], 1), "p95 ms": round(1000 * s["p95"], 1)}
+            for name, s in snap["stages"].items()
+        ])
+
+# ---------------------------------------------------------------------
+# Section Renderers
+# ---------------------------------------------------------------------
+@timed("render_section")
+def render_section(key, sections):
+    """Render one parsed section; called as soon as its end marker streams in."""
+    # --- METADATA ---
+    if key == 'metadata' and sections.get('metadata'):
+        st.markdown('<div class="content-box">', unsafe_allow_html=True)
+        st.subheader("📋 Metadata")
+        md = sections['metadata']
+        st.markdown(f"**Language:** `{md.get('LANGUAGE','N/A')}`  ")
+        st.markdown(f"**Filename:** `{md.get('FILENAME','N/A')}`  ")
+        st.markdown(f"**Algorithm:** `{md.get('ALGORITHM','N/A')}`")
+        st.markdown('</div>', unsafe_allow_html=True)
+
+    # --- CODE ---
+    elif key == 'code' and sections.get('code'):
+        st.markdown('<div class="content-box">', unsafe_allow_html=True)
+        st.subheader("💻 Generated Code")
+        st.code(sections['code'], language=sections.get('language','python'))
+        st.markdown('</div>', unsafe_allow_html=True)
+
+    # --- VISUALIZATION ---
+    elif key == 'visualization' and sections.get('visualization'):
+        st.markdown('<div class="mermaid-box">', unsafe_allow_html=True)
+        st.subheader("🎨 Flow Visualization")
+        try:
+            render_mermaid(sections['visualization'])
+        except Exception as e:
+            st.error(f"Mermaid render error: {e}")
+            st.code(sections['visualization'], language='text')
+        st.markdown('</div>', unsafe_allow_html=True)
+
+    # --- ANNOTATED CODE ---
+    elif key == 'annotated' and sections.get('annotated'):
+        st.markdown('<div class="content-box">', unsafe_allow_html=True)
+        st.subheader("📝 Step-by-Step Explanation")
+        for line in sections['annotated'].split('\n'):
+            if re.match(r'^\s*(line\s+\d+|lines?\s+\d+-\d+|\d+\.)', line, re.IGNORECASE):
+                st.markdown(f"**{line.strip()}**")
+            else:
+                st.markdown(line.strip())
+        st.markdown('</div>', unsafe_allow_html=True)
+
+    # --- COMPLEXITY ---
+    elif key == 'complexity' and sections.get('complexity'):
+        st.markdown('<div class="content-box">', unsafe_allow_html=True)
+        st.subheader("⚡ Complexity Analysis")
+        st.markdown(sections['complexity'])
+        st.markdown('</div>', unsafe_allow_html=True)
+
+    # --- TEST CASES ---
+    elif key == 'test_cases' and sections.get('test_cases'):
+        st.markdown('<div class="content-box">', unsafe_allow_html=True)
+        st.subheader("🧪 Test Cases")
+        st.markdown(sections['test_cases'].replace('\n','<br>'), unsafe_allow_html=True)
+        if st.session_state.get('run_tests'):
+            render_test_results(sections)
+        st.markdown('</div>', unsafe_allow_html=True)
+
+TEST_ICONS = {'passed': '✅', 'failed': '❌', 'error': '💥', 'timeout': '⏱️', 'skipped': '⏭️'}
+
+def render_test_results(sections):
+    """Run the generated code against its parsed test cases and show pass/fail per case."""
+    cases = parse_test_cases(sections['test_cases'])
+    if not cases or not sections.get('code'):
+        st.caption("No structured test cases to run.")
+        return
+    language = sections.get('language', 'python')
+    if not language.startswith('py'):
+        st.caption(f"Running test cases is only supported for Python, not `{language}`.")
+        return
+    with st.spinner(f"Running {len(cases)} test cases..."):
+        results = sandbox_pool().run(sections['code'], cases)
+    passed = sum(r['status'] == 'passed' for r in results)
+    st.markdown(f"**Test run: {passed}/{len(results)} passed**")
+    st.table([
+        {
+            "": TEST_ICONS[r['status']], "case": r['name'], "input": r['input'], "expected": r['expected'],
+            "actual": r.get('actual') if r['status'] in ('passed', 'failed') else r.get('error'),
+        }
+        for r in results
+    ])
+
 # ---------------------------------------------------------------------
 # Main App
 # ---------------------------------------------------------------------
+def session_id():
+    """Streamlit session id, so the scheduler can share the model fairly between browser tabs."""
+    try:
+        from streamlit.runtime.scriptrunner import get_script_run_ctx
+        ctx = get_script_run_ctx()
+        return ctx.session_id if ctx else None
+    except ImportError:
+        return None
+
+async def stream_sections(prompt, visible, slots, trace):
+    """
+    Render each section as soon as it completes. Streams through the async API
+    (shared batcher, or the inference server), so when Streamlit stops this run
+    (Generate clicked again, tab closed) the request is cancelled and its row
+    stops decoding at the next step instead of running to max_new_tokens.
+    """
+    chunks = trace.awatch(stream_response_async(
+        prompt, timeout=GENERATION_TIMEOUT, priority="interactive", client=session_id()
+    ))
+    async for key, sections, response in aiter_sections(chunks):
+        if key is None:
+            return response, sections
+        if visible[key]:
+            with slots[key].container():
+                render_section(key, sections)
+
 def main():
+    # With LLM_SERVER_URL set the model lives in server.py, not in this process
+    client = server_client()
+    handle = None if client else model_handle()
+
     with st.sidebar:
         st.title("⚙️ Settings")
+        if client:
+            render_server_status(client)
+        else:
+            render_model_status(handle)
         st.markdown("---")
-        show_metadata = st.checkbox("Show Metadata", value=True)
-        show_viz = st.checkbox("Show Visualization", value=True)
-        show_code = st.checkbox("Show Code", value=True)
-        show_annotated = st.checkbox("Show Annotated Code", value=True)
-        show_complexity = st.checkbox("Show Complexity", value=True)
-        show_tests = st.checkbox("Show Test Cases", value=True)
+        visible = {
+            'metadata': st.checkbox("Show Metadata", value=True),
+            'visualization': st.checkbox("Show Visualization", value=True),
+            'code': st.checkbox("Show Code", value=True),
+            'annotated': st.checkbox("Show Annotated Code", value=True),
+            'complexity': st.checkbox("Show Complexity", value=True),
+            'test_cases': st.checkbox("Show Test Cases", value=True),
+        }
+        # Runs the generated Python code against its TEST CASES in the sandbox pool
+        # Opt-in: the code runs on this host with network access and can read its files
+        if st.checkbox("Run Test Cases", value=False, key='run_tests', disabled=SANDBOX_WORKERS == 0,
+                       help=None if SANDBOX_WORKERS else "Set SANDBOX_WORKERS=1 or more to enable"):
+            st.warning("⚠️ Generated code runs on this machine with your user's network and file access. "
+                       "Only run code you would run yourself.")
+            sandbox_pool()  # start the workers now, so they are warm by the time tests arrive
         st.markdown("---")
+        if client:
+            with st.expander("📈 Server Stats"):
+                try:
+                    st.json(client.stats())
+                except Exception as e:
+                    st.caption(f"Unavailable: {e}")
+        else:
+            with st.expander("📈 Batcher Stats"):
+                st.json(shared_batcher().stats())
+        if response_cache is not None:
+            with st.expander("🗄️ Response Cache"):
+                st.json(response_cache.stats())
+        if token_budget is not None:
+            with st.expander("🎯 Token Budgets"):
+                st.json(token_budget.stats())
+        if st.checkbox("📊 Live stats", value=False):
+            render_stats_panel(client)
         st.info("AI-powered code generator with visual flow diagrams using Mistral 7B")
 
     st.title("🎨 AI Code Visualizer")
@@ -59,117 +266,49 @@ def main():
     col1, col2, col3 = st.columns([1, 2, 1])
     with col2:
         if st.button("🚀 Generate Code", use_container_width=True) and user_prompt:
-            with st.spinner("🔄 Generating code and visualization using local Mistral 7B..."):
-                try:
-                    response = generate_response(f"""
-Generate the mermaid syntax according to the rules
-You are an expert software engineer. Follow this format strictly:
-
-===METADATA===
-LANGUAGE: <language>
-FILENAME: <filename>
-ALGORITHM: <algorithm>
-===END METADATA===
-
-===CODE===
-```<language>
-<code>
-```
-===END CODE===
-
-===VISUALIZATION===
-```mermaid
-flowchart TD
-Start([Start]) --> Step1[Do something]
-Step1 --> End([End])
-```
-===END VISUALIZATION===
-
-===ANNOTATED CODE===
-Detailed line-by-line explanation.
-===END ANNOTATED===
-
-===COMPLEXITY===
-Time: O(n)
-Space: O(1)
-===END COMPLEXITY===
-
-===TEST CASES===
-Test 1: 
-input:
-output:
-===END TEST CASES===
-TASK: {user_prompt}
-""")
-
-                    st.session_state['last_response'] = response
-                    sections = parse_response(response)
-                    # st.write("🔍 Parsed sections:", list(sections.keys()))
-
-                    # --- METADATA ---
-                    if show_metadata and sections.get('metadata'):
-                        with st.container():
-                            st.markdown('<div class="content-box">', unsafe_allow_html=True)
-                            st.subheader("📋 Metadata")
-                            md = sections['metadata']
-                            st.markdown(f"**Language:** `{md.get('LANGUAGE','N/A')}`  ")
-                            st.markdown(f"**Filename:** `{md.get('FILENAME','N/A')}`  ")
-                            st.markdown(f"**Algorithm:** `{md.get('ALGORITHM','N/A')}`")
-                            st.markdown('</div>', unsafe_allow_html=True)
-
-                    # --- CODE ---
-                    if show_code and sections.get('code'):
-                        with st.container():
-                            st.markdown('<div class="content-box">', unsafe_allow_html=True)
-                            st.subheader("💻 Generated Code")
-                            st.code(sections['code'], language=sections.get('language','python'))
-                            st.markdown('</div>', unsafe_allow_html=True)
-
-                    # --- VISUALIZATION ---
-                    if show_viz and sections.get('visualization'):
-                        with st.container():
-                            st.markdown('<div class="mermaid-box">', unsafe_allow_html=True)
-                            st.subheader("🎨 Flow Visualization")
-                            try:
-                                render_mermaid(sections['visualization'])
-                            except Exception as e:
-                                st.error(f"Mermaid render error: {e}")
-                                st.code(sections['visualization'], language='text')
-                            st.markdown('</div>', unsafe_allow_html=True)
-
-                    # --- ANNOTATED CODE ---
-                    if show_annotated and sections.get('annotated'):
-                        with st.container():
-                            st.markdown('<div class="content-box">', unsafe_allow_html=True)
-                            st.subheader("📝 Step-by-Step Explanation")
-                            for line in sections['annotated'].split('\n'):
-                                if re.match(r'^\s*(line\s+\d+|lines?\s+\d+-\d+|\d+\.)', line, re.IGNORECASE):
-                                    st.markdown(f"**{line.strip()}**")
-                                else:
-                                    st.markdown(line.strip())
-                            st.markdown('</div>', unsafe_allow_html=True)
-
-                    # --- COMPLEXITY ---
-                    if show_complexity and sections.get('complexity'):
-                        with st.container():
-                            st.markdown('<div class="content-box">', unsafe_allow_html=True)
-                            st.subheader("⚡ Complexity Analysis")
-                            st.markdown(sections['complexity'])
-                            st.markdown('</div>', unsafe_allow_html=True)
-
-                    # --- TEST CASES ---
-                    if show_tests and sections.get('test_cases'):
-                        with st.container():
-                            st.markdown('<div class="content-box">', unsafe_allow_html=True)
-                            st.subheader("🧪 Test Cases")
-                            st.markdown(sections['test_cases'].replace('\n','<br>'), unsafe_allow_html=True)
-                            st.markdown('</div>', unsafe_allow_html=True)
-
-                    st.download_button("📥 Download Full Response", response, file_name="response.txt")
-                    st.success("✅ Code generation completed!")
+            # One slot per section, in display order, filled as each section finishes streaming
+            slots = {key: st.empty() for key, _, _ in SECTIONS}
+            status = st.empty()
+            trace = RequestTrace("app")
+            try:
+                prompt = build_app_prompt(user_prompt)
+                cached = lookup_cached(prompt)
+                if cached:
+                    outcome = "cached"
+                    # Served from the response cache: no model, no re-parse
+                    response = cached['response']
+                    sections = cached['sections'] or parse_response(response)
+                    for key, _, _ in SECTIONS:
+                        if visible[key]:
+                            with slots[key].container():
+                                render_section(key, sections)
+                else:
+                    if handle is not None and not handle.ready:
+                        status.info("⏳ Waiting for the model to finish loading...")
+                        handle.get()
+                    status.info("🔄 Generating code and visualization using local Mistral 7B...")
+                    response, sections = asyncio.run(stream_sections(prompt, visible, slots, trace))
+                    if is_complete(response):
+                        outcome = "complete"
+                        store_response(prompt, response, sections)
+                    else:
+                        outcome = "truncated"
+                        st.warning("⏱️ Generation stopped early; showing the sections that completed.")
 
-                except Exception as e:
-                    st.error(f"❌ Error generating or parsing: {e}")
+                status.empty()
+                st.session_state['last_response'] = response
+                st.download_button("📥 Download Full Response", response, file_name="response.txt")
+                st.success("✅ Code generation completed!")
+                trace.finish(outcome, sections=sorted(k for k, v in sections.items() if v))
+
+            except (Overloaded, QueueTimeout) as e:
+                status.empty()
+                trace.finish("busy", error=str(e))
+                st.warning(f"🚦 The model is busy right now, please try again in a moment. ({e})")
+            except Exception as e:
+                status.empty()
+                trace.finish("error", error=str(e))
+                st.error(f"❌ Error generating or parsing: {e}")
 
         elif user_prompt == "":
             st.warning("⚠️ Please enter a code request first!")
@@ -0,0 +1,117 @@
+# benchmarks/flowchart.py
+"""
+AST flowchart benchmark: what AST_FLOWCHART=1 saves per request, and what
+utils.flowchart costs instead.
+
+- Prompt: each template prefix with and without its VISUALIZATION section.
+- Decode: the model-written diagrams in benchmarks/fixtures/mermaid, i.e.
+  what the model no longer generates per request.
+- Build: python_flowchart time on generated Python modules of growing size.
+
+Sizes are in tokens with --tokenizer, else in characters. Run it without
+AST_FLOWCHART set, so the full prompts are there to compare.
+
+    python -m benchmarks.flowchart
+    python -m benchmarks.flowchart --tokenizer byte --functions 10 100 1000
+"""
+import argparse
+import glob
+import json
+import os
+import statistics
+import time
+
+from benchmarks.mermaid import FIXTURES
+from utils.flowchart import python_flowchart
+from utils.mermaid import parse_mermaid
+from utils.prompts import APP_PREFIX, MAIN_PREFIX, _without_visualization
+
+FUNCTION = '''
+def search_{i}(items, target):
+    """Binary search."""
+    lo, hi = 0, len(items) - 1
+    while lo <= hi:
+        mid = (lo + hi) // 2
+        if items[mid] == target:
+            return mid
+        elif items[mid] < target:
+            lo = mid + 1
+        else:
+            hi = mid - 1
+    try:
+        check(items)
+    except ValueError as e:
+        log(e)
+        raise
+    finally:
+        done()
+    for x in items:
+        if x is None:
+            continue
+        if x < 0:
+            break
+    else:
+        return -1
+    return None
+'''
+
+
+def module(functions):
+    return "".join(FUNCTION.format(i=i) for i in range(functions)) + (
+        '\nif __name__ == "__main__":\n    print(search_0([1, 2, 3], 2))\n'
+    )
+
+
+def main():
+    ap = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    ap.add_argument("--tokenizer", help="model path / hub id, or 'byte' (default: count characters)")
+    ap.add_argument("--functions", type=int, nargs="+", default=[1, 10, 100], help="generated module sizes")
+    ap.add_argument("--repeat", type=int, default=5)
+    ap.add_argument("--out", help="also write the results as JSON here")
+    args = ap.parse_args()
+
+    if args.tokenizer:
+        from benchmarks.prompt_tokens import load_tokenizer
+        tokenizer = load_tokenizer(args.tokenizer)
+        size, unit = (lambda text: len(tokenizer(text, add_special_tokens=False).input_ids)), "tokens"
+    else:
+        size, unit = len, "chars"
+
+    results = {"unit": unit, "prompt": {}, "build": []}
+    print(f"{'prompt':<8} {'full':>8} {'no viz':>8} {'saved':>8}  ({unit})")
+    for name, prefix in (("app", APP_PREFIX), ("main", MAIN_PREFIX)):
+        full, short = size(prefix), size(_without_visualization(prefix))
+        results["prompt"][name] = {"full": full, "without_visualization": short}
+        print(f"{name:<8} {full:>8} {short:>8} {full - short:>8}")
+
+    diagrams = [path for path in sorted(glob.glob(os.path.join(FIXTURES, "*.mmd")))
+                if not path.endswith(".expected.mmd")]
+    sizes = []
+    for path in diagrams:
+        with open(path, encoding="utf-8") as f:
+            sizes.append(size("```mermaid\n" + f.read().strip() + "\n```\n"))
+    results["decode"] = {"diagrams": len(sizes), "mean": statistics.mean(sizes), "max": max(sizes)}
+    print(f"\nVISUALIZATION bodies not decoded: mean {statistics.mean(sizes):.0f} {unit}, "
+          f"max {max(sizes)} over {len(sizes)} fixtures")
+
+    print(f"\n{'functions':>10} {'lines':>8} {'nodes':>8} {'ms':>10}")
+    for functions in args.functions:
+        code = module(functions)
+        best = float("inf")
+        for _ in range(args.repeat):
+            python_flowchart.cache_clear()
+            started = time.perf_counter()
+            diagram = python_flowchart(code)
+            best = min(best, time.perf_counter() - started)
+        nodes = len(parse_mermaid(diagram).nodes)
+        row = {"functions": functions, "lines": code.count("\n"), "nodes": nodes, "ms": round(best * 1000, 3)}
+        results["build"].append(row)
+        print(f"{functions:>10} {row['lines']:>8} {nodes:>8} {row['ms']:>10.2f}")
+
+    if args.out:
+        with open(args.out, "w", encoding="utf-8") as f:
+            json.dump(results, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
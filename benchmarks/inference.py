@@ -0,0 +1,247 @@
+# benchmarks/inference.py
+"""
+Inference benchmark: runs a fixed prompt set through utils.llm under several
+configurations and records time-to-first-token, prefill time, decode tokens/sec,
+total latency and peak host/device memory.
+
+Each configuration runs in a fresh interpreter (utils.llm reads its settings
+from the environment at import). Results are written as JSON so runs from
+different commits can be compared:
+
+    python -m benchmarks.inference                              # tiny CPU model
+    python -m benchmarks.inference --backend gpu --quant nf4 fp4 --batch-size 1 4
+    python -m benchmarks.inference --compare old.json new.json
+"""
+import argparse
+import itertools
+import json
+import os
+import platform
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+RESULTS_DIR = os.path.join(ROOT, "benchmarks", "results")
+
+# Fixed workload: keep stable so numbers stay comparable across commits
+PROMPTS = [
+    "Write a function to find the maximum subarray sum using Kadane's algorithm",
+    "Print all prime numbers up to n using the sieve of Eratosthenes",
+    "Implement binary search over a sorted list and return the index or -1",
+    "Breadth-first search on a grid to find the shortest path from S to E",
+    "Implement an LRU cache with get and put in O(1)",
+    "Check whether a string of brackets is balanced using a stack",
+]
+
+
+# ---------- Child: run one configuration ----------
+def _peak_rss_mb():
+    try:
+        import resource
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        return peak / 1024 if sys.platform != "darwin" else peak / (1024 * 1024)
+    except ImportError:  # Windows
+        import psutil
+        return psutil.Process().memory_info().peak_wset / (1024 * 1024)
+
+
+def _decode_totals(llm):
+    totals = llm.speculation_stats()
+    return {key: sum(t[key] for t in totals.values()) for key in ("requests", "new_tokens", "prefill_seconds", "decode_seconds")}
+
+
+def _run_single(llm, prompt, max_new_tokens):
+    started = time.perf_counter()
+    first = None
+    for _ in llm.stream_response(prompt, max_new_tokens=max_new_tokens):
+        if first is None:
+            first = time.perf_counter()
+    finished = time.perf_counter()
+    return [{"ttft_s": (first or finished) - started, "latency_s": finished - started}]
+
+
+def _run_batch(llm, prompts, max_new_tokens):
+    started = time.perf_counter()
+    firsts = [None] * len(prompts)
+
+    def sink(i):
+        def on_chunk(_):
+            if firsts[i] is None:
+                firsts[i] = time.perf_counter()
+        return on_chunk
+
+    llm.generate_batch(prompts, max_new_tokens, [sink(i) for i in range(len(prompts))])
+    finished = time.perf_counter()
+    return [{"ttft_s": (f or finished) - started, "latency_s": finished - started} for f in firsts]
+
+
+def run_child(config):
+    import utils.llm as llm
+    from utils.prompts import build_app_prompt
+
+    load_started = time.perf_counter()
+    tokenizer, model = llm.get_handle().get()
+    load_seconds = time.perf_counter() - load_started
+
+    prompts = [build_app_prompt(p) for p in PROMPTS]
+    passes = 2 if config["cache"] == "full" else 1  # second pass measures warm response-cache hits
+    batch = config["batch_size"]
+
+    for _ in range(passes):
+        before = _decode_totals(llm)
+        requests = []
+        wall_started = time.perf_counter()
+        for i in range(0, len(prompts), batch):
+            group = prompts[i:i + batch]
+            if batch == 1:
+                requests += _run_single(llm, group[0], config["max_new_tokens"])
+            else:
+                requests += _run_batch(llm, group, config["max_new_tokens"])
+        wall = time.perf_counter() - wall_started
+        after = _decode_totals(llm)
+
+    delta = {key: after[key] - before[key] for key in after}
+    device_mb = None
+    try:
+        import torch
+        if torch.cuda.is_available():
+            device_mb = torch.cuda.max_memory_allocated() / (1024 * 1024)
+    except ImportError:
+        pass
+
+    latencies = sorted(r["latency_s"] for r in requests)
+    return {
+        "config": config,
+        "backend": llm.get_handle().backend.describe(),
+        "load_seconds": load_seconds,
+        "requests": len(requests),
+        "ttft_p50_s": statistics.median(r["ttft_s"] for r in requests),
+        "latency_p50_s": statistics.median(latencies),
+        "latency_p95_s": latencies[min(len(latencies) - 1, int(0.95 * len(latencies)))],
+        "prefill_mean_s": delta["prefill_seconds"] / delta["requests"] if delta["requests"] else 0.0,
+        "decode_tokens_per_sec": (delta["new_tokens"] - delta["requests"]) / delta["decode_seconds"] if delta["decode_seconds"] else 0.0,
+        "generated_tokens": delta["new_tokens"],
+        "throughput_tokens_per_sec": delta["new_tokens"] / wall if wall else 0.0,
+        "wall_seconds": wall,
+        "peak_rss_mb": _peak_rss_mb(),
+        "peak_device_mb": device_mb,
+    }
+
+
+# ---------- Parent: sweep configurations ----------
+def _config_env(config, scratch):
+    env = dict(os.environ, PYTHONPATH=ROOT, LLM_BACKEND=config["backend"], SPECULATIVE=config["speculative"],
+               SECTION_PIPELINE=config["pipeline"])
+    if config["backend"] == "gpu":
+        env["LLM_GPU_QUANT"] = config["quant"]
+    else:
+        env["LLM_CPU_QUANTIZE"] = config["quant"]
+    env["PREFIX_CACHE_DIR"] = "" if config["cache"] == "off" else os.path.join(scratch, "prefix")
+    env["RESPONSE_CACHE_PATH"] = os.path.join(scratch, "responses.sqlite3") if config["cache"] == "full" else ""
+    return env
+
+
+def _git_commit():
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"], cwd=ROOT, capture_output=True, text=True, check=True
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return "unknown"
+
+
+def sweep(args):
+    configs = [
+        dict(backend=args.backend, quant=quant, batch_size=batch, cache=cache,
+             speculative=spec, pipeline=pipeline, max_new_tokens=args.max_new_tokens)
+        for quant, batch, cache, spec, pipeline in itertools.product(
+            args.quant, args.batch_size, args.cache, args.speculative, args.pipeline
+        )
+    ]
+    results = []
+    for config in configs:
+        with tempfile.TemporaryDirectory() as scratch:
+            proc = subprocess.run(
+                [sys.executable, "-m", "benchmarks.inference", "--child", json.dumps(config)],
+                cwd=ROOT, env=_config_env(config, scratch), capture_output=True, text=True
+            )
+        if proc.returncode != 0:
+            print(f"[bench] {config} failed:\n{proc.stderr.strip()[-2000:]}")
+            results.append({"config": config, "error": proc.stderr.strip().splitlines()[-1:]})
+            continue
+        result = json.loads(proc.stdout.strip().splitlines()[-1])
+        results.append(result)
+        print(
+            f"[bench] {config['quant']:>5} batch={config['batch_size']} cache={config['cache']:<6} "
+            f"spec={config['speculative']:<13} pipeline={config['pipeline']:<10} ttft={result['ttft_p50_s']:.3f}s "
+            f"prefill={result['prefill_mean_s']:.3f}s decode={result['decode_tokens_per_sec']:.1f} tok/s "
+            f"p50={result['latency_p50_s']:.2f}s rss={result['peak_rss_mb']:.0f}MB"
+        )
+
+    report = {
+        "commit": _git_commit(),
+        "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "python": platform.python_version(),
+        "machine": platform.machine(),
+        "prompts": len(PROMPTS),
+        "results": results,
+    }
+    out = args.output or os.path.join(RESULTS_DIR, f"{report['commit']}-{args.backend}.json")
+    os.makedirs(os.path.dirname(out) or ".", exist_ok=True)
+    with open(out, "w", encoding="utf-8") as f:
+        json.dump(report, f, indent=2)
+    print(f"[bench] results written to {out}")
+
+
+def compare(old_path, new_path):
+    """Print per-config deltas between two result files."""
+    def load(path):
+        with open(path, encoding="utf-8") as f:
+            report = json.load(f)
+        return report, {json.dumps(r["config"], sort_keys=True): r for r in report["results"] if "error" not in r}
+
+    old, old_results = load(old_path)
+    new, new_results = load(new_path)
+    print(f"{old['commit']} -> {new['commit']}")
+    for key in sorted(old_results.keys() & new_results.keys()):
+        a, b = old_results[key], new_results[key]
+        cfg = json.loads(key)
+        print(f"  {cfg['quant']} batch={cfg['batch_size']} cache={cfg['cache']} spec={cfg['speculative']} "
+              f"pipeline={cfg.get('pipeline', 'sequential')}")
+        for metric in ("ttft_p50_s", "prefill_mean_s", "decode_tokens_per_sec", "latency_p50_s", "peak_rss_mb"):
+            before, after = a[metric], b[metric]
+            change = (after - before) / before * 100 if before else 0.0
+            print(f"    {metric:<24}{before:>10.3f} -> {after:>10.3f}  ({change:+.1f}%)")
+
+
+def main():
+    ap = argparse.ArgumentParser(description="Inference benchmark for utils.llm")
+    ap.add_argument("--backend", default="tiny", choices=["tiny", "cpu", "gpu"])
+    ap.add_argument("--quant", nargs="+", default=None,
+                    help="gpu: nf4 fp4 int8 none; cpu/tiny: int8 none")
+    ap.add_argument("--batch-size", nargs="+", type=int, default=[1])
+    ap.add_argument("--cache", nargs="+", default=["off", "prefix"], choices=["off", "prefix", "full"])
+    ap.add_argument("--speculative", nargs="+", default=["off"], choices=["off", "prompt_lookup", "draft"])
+    ap.add_argument("--pipeline", nargs="+", default=["sequential"], choices=["sequential", "fanout"])
+    ap.add_argument("--max-new-tokens", type=int, default=128)
+    ap.add_argument("--output", help="result file (default: benchmarks/results/<commit>-<backend>.json)")
+    ap.add_argument("--compare", nargs=2, metavar=("OLD", "NEW"))
+    ap.add_argument("--child", help=argparse.SUPPRESS)
+    args = ap.parse_args()
+
+    if args.child:
+        print(json.dumps(run_child(json.loads(args.child))))
+        return
+    if args.compare:
+        compare(*args.compare)
+        return
+    if args.quant is None:
+        args.quant = ["nf4"] if args.backend == "gpu" else ["none"] if args.backend == "tiny" else ["int8"]
+    sweep(args)
+
+
+if __name__ == "__main__":
+    main()
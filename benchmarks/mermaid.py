@@ -0,0 +1,276 @@
+# benchmarks/mermaid.py
+"""
+Mermaid sanitizer benchmark: the previous regex/token-chaining
+validate_and_fix_mermaid vs. the graph-IR parser in utils.mermaid, on
+generated messy diagrams (10k nodes by default). Reports time, and how many
+of the diagram's real edges survive versus how many spurious ones appear.
+
+    python -m benchmarks.mermaid                          # 1k and 10k nodes
+    python -m benchmarks.mermaid --nodes 10000 50000 --skip-old
+    python -m benchmarks.mermaid --cases nested_line --nodes 2000 8000 --skip-old  # one long line
+    python -m benchmarks.mermaid --nodes 200 1000 3000 --layout  # also time layout + SVG, full vs simplified
+    python -m benchmarks.mermaid --check                  # fixture corpus only
+    python -m benchmarks.mermaid --check --update         # rewrite the expected outputs
+
+The fixture corpus lives in benchmarks/fixtures/mermaid: each NAME.mmd is a
+messy model output and NAME.expected.mmd the sanitized diagram it must produce.
+"""
+import argparse
+import glob
+import json
+import os
+import random
+import re
+import time
+from collections import OrderedDict
+
+from utils.layout import layout_graph, render_svg
+from utils.mermaid import parse_mermaid
+from utils.visualizer import DIAGRAM_MAX_EDGES, DIAGRAM_MAX_NODES, diagram_html, simplify_graph, \
+    validate_and_fix_mermaid
+
+FIXTURES = os.path.join(os.path.dirname(os.path.abspath(__file__)), "fixtures", "mermaid")
+
+
+# ---------- Previous implementation, kept for comparison ----------
+def _old_safe_id(label, used):
+    base = re.sub(r'[^A-Za-z0-9_]', '_', label).strip('_')
+    if not base:
+        base = "node"
+    if re.match(r'^\d', base):
+        base = "n_" + base
+    candidate = base
+    i = 1
+    while candidate in used:
+        candidate = f"{base}_{i}"
+        i += 1
+    used.add(candidate)
+    return candidate
+
+def _old_clean_label(lbl):
+    s = str(lbl).replace('\r', ' ').replace('\n', ' ').replace('"', "'")
+    return re.sub(r'\s+', ' ', s).strip()
+
+def _old_label(token):
+    token = token.strip()
+    for pattern in (r'\[([^\]]+)\]', r'\(([^\)]+)\)', r'"([^"]+)"', r"'([^']+)'"):
+        m = re.search(pattern, token)
+        if m:
+            return _old_clean_label(m.group(1))
+    token = _old_clean_label(re.sub(r'\s*-\s*$', '', token))
+    if len(token) > 60:
+        token = token[:57] + '...'
+    return token if token else "node"
+
+def regex_fix(src):
+    s = str(src).replace("```mermaid", "").replace("```", "")
+    s = re.sub(r'mermaid\s+version\s+[0-9\.]+', '', s, flags=re.IGNORECASE)
+    s = re.sub(r'^[A-Za-z0-9_]+__.*\[".*"\]\s*$', '', s, flags=re.MULTILINE)
+    s = re.sub(r'(?i)^\s*flowchart\s+(TD|LR|RL|BT|TB)\s*', '', s, flags=re.MULTILINE)
+    s = re.sub(r'(?i)^\s*graph\s+(TD|LR|RL|BT|TB)\s*', '', s, flags=re.MULTILINE)
+    s = re.sub(r'(?i)subgraph\s+[A-Za-z0-9_\-]+\s*', '', s)
+    s = re.sub(r'(?m)^\s*end\s*$', '', s)
+    s = s.replace('->', '-->')
+    s = re.sub(r'\s*-->\s*', ' --> ', s)
+    body = re.sub(r'\s+', ' ', ' '.join(line.strip() for line in s.splitlines() if line.strip())).strip()
+    parts = [p.strip() for p in re.split(r'\s*-->\s*', body) if p.strip()]
+    if not parts:
+        return "flowchart TD\n"
+    used_ids, id_map, nodes_order, edges = set(), OrderedDict(), [], []
+    prev_id = None
+    for token in parts:
+        token = re.sub(r'^\s*-\s*', '', re.sub(r'\s*-\s*$', '', token.strip()))
+        label = _old_label(token) or ' '.join(token.split()[:6])
+        if label in id_map:
+            nid = id_map[label]
+        else:
+            nid = id_map[label] = _old_safe_id(label, used_ids)
+            nodes_order.append((nid, label))
+        if prev_id is not None:
+            edges.append((prev_id, nid))
+        prev_id = nid
+    lines = ["flowchart TD"] + [f'{nid}["{_old_clean_label(label)}"]' for nid, label in nodes_order]
+    lines += [f'{a} --> {b}' for a, b in OrderedDict.fromkeys(edges)]
+    return "\n".join(lines)
+
+
+def ir_fix(src):
+    return parse_mermaid(src).to_mermaid()
+
+
+# ---------- Inputs ----------
+WORDS = ["read input", "check bounds", "swap items", "update max", "push node", "pop node", "merge halves",
+         "return result", "visit neighbour", "increment i"]
+
+
+def messy(nodes, seed=0):
+    """
+    A branching diagram written the way models write them: inline shapes,
+    edge labels, `->` slips, labels split over two lines, `-- text -->`
+    links, `&` groups, plus style lines, comments and prose.
+    Returns (source, {(source label, target label)}).
+    """
+    rng = random.Random(seed)
+    labels = [f"Step {i} {rng.choice(WORDS)}" for i in range(nodes)]
+    shapes = [("[", "]"), ("{", "}"), ("(", ")"), ("([", "])")]
+    declared = set()
+    edges = set()
+    lines = ["Here is the flowchart:", "```mermaid", "flowchart TD"]
+
+    def ref(i):
+        if i in declared:
+            return f"N{i}"
+        declared.add(i)
+        opener, closer = rng.choice(shapes)
+        label = labels[i]
+        if rng.random() < 0.1:
+            head, tail = label.split(" ", 1)
+            label = f"{head}\n    {tail}"
+        return f"N{i}{opener}{label}{closer}"
+
+    lines.append(f"    {ref(0)}")
+    for i in range(1, nodes):
+        parent = rng.randrange(max(0, i - 50), i)
+        form = rng.random()
+        if form < 0.45:
+            lines.append(f"    {ref(parent)} --> {ref(i)}")
+        elif form < 0.6:
+            lines.append(f"    {ref(parent)} -->|{rng.choice(['yes', 'no'])}| {ref(i)}")
+        elif form < 0.75:
+            lines.append(f"    {ref(parent)} -> {ref(i)}")
+        elif form < 0.85:
+            lines.append(f"    {ref(parent)} -- {rng.choice(WORDS)} --> {ref(i)}")
+        else:
+            other = rng.randrange(max(0, i - 50), i)
+            lines.append(f"    {ref(parent)} & {ref(other)} --> {ref(i)}")
+            edges.add((labels[other], labels[i]))
+        edges.add((labels[parent], labels[i]))
+        if rng.random() < 0.2:
+            back = rng.randrange(0, i)
+            lines.append(f"    N{i} --> N{back}" if back in declared else f"    N{i} --> {ref(back)}")
+            edges.add((labels[i], labels[back]))
+        if rng.random() < 0.02:
+            lines.append(rng.choice([f"    style N{i} fill:#f9f", "    %% loop body", "This step repeats."]))
+    lines.append("```")
+    return "\n".join(lines), edges
+
+
+def colliding(nodes, seed=0):
+    """Label-only nodes whose labels all reduce to the same ID base (`Check`), chained pairwise."""
+    rng = random.Random(seed)
+    labels = list(OrderedDict.fromkeys(
+        "Check " + "".join(rng.choice("?!#.,:+*") for _ in range(12)) for _ in range(nodes)
+    ))
+    lines = ["flowchart TD"] + [f"    [{a}] --> [{b}]" for a, b in zip(labels, labels[1:])]
+    return "\n".join(lines), set(zip(labels, labels[1:]))
+
+
+def nested_line(nodes, seed=0):
+    """One line of nodes whose labels nest brackets and never close (`N1[a[1] b --> N2[a[2] b`)."""
+    labels = [f"a[{i}] b" for i in range(nodes)]
+    src = "flowchart TD\n" + " --> ".join(f"N{i}[{label}" for i, label in enumerate(labels))
+    return src, set(zip(labels, labels[1:]))
+
+
+CASES = {"messy": messy, "colliding": colliding, "nested_line": nested_line}
+
+
+def edge_stats(output, expected):
+    """(real edges kept, spurious edges) of a sanitized diagram, compared by node label."""
+    graph = parse_mermaid(output)
+    label = {nid: node.label or nid for nid, node in graph.nodes.items()}
+    got = {(label[e.source], label[e.target]) for e in graph.edges}
+    return len(got & expected), len(got - expected)
+
+
+def seconds(fn, arg):
+    started = time.perf_counter()
+    result = fn(arg)
+    return time.perf_counter() - started, result
+
+
+# ---------- Fixture corpus ----------
+def check_fixtures(update=False):
+    failures = 0
+    for path in sorted(glob.glob(os.path.join(FIXTURES, "*.mmd"))):
+        if path.endswith(".expected.mmd"):
+            continue
+        expected_path = path[:-len(".mmd")] + ".expected.mmd"
+        with open(path, encoding="utf-8") as f:
+            got = validate_and_fix_mermaid(f.read()).strip() + "\n"
+        if update:
+            with open(expected_path, "w", encoding="utf-8") as f:
+                f.write(got)
+            print(f"[INFO] Wrote {os.path.relpath(expected_path)}")
+            continue
+        expected = open(expected_path, encoding="utf-8").read() if os.path.exists(expected_path) else None
+        if got != expected:
+            failures += 1
+            print(f"[FAIL] {os.path.basename(path)}\n--- expected\n{expected}--- got\n{got}")
+        else:
+            print(f"[OK] {os.path.basename(path)}")
+    return failures
+
+
+def main():
+    ap = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    ap.add_argument("--nodes", type=int, nargs="+", default=[1000, 10000], help="generated diagram sizes")
+    ap.add_argument("--cases", nargs="+", choices=sorted(CASES), default=list(CASES))
+    ap.add_argument("--skip-old", action="store_true", help="skip the previous sanitizer (quadratic on collisions)")
+    ap.add_argument("--layout", action="store_true", help="also time utils.layout on the sanitized diagram")
+    ap.add_argument("--check", action="store_true", help="only check the fixture corpus")
+    ap.add_argument("--update", action="store_true", help="with --check: rewrite the expected outputs")
+    ap.add_argument("--out", help="also write the results as JSON here")
+    args = ap.parse_args()
+
+    if args.check:
+        failures = check_fixtures(args.update)
+        raise SystemExit(1 if failures else 0)
+
+    results = []
+    for name in args.cases:
+        for nodes in args.nodes:
+            src, expected = CASES[name](nodes)
+            ir_s, ir_out = seconds(ir_fix, src)
+            kept, spurious = edge_stats(ir_out, expected)
+            row = {"case": name, "nodes": nodes, "chars": len(src), "edges": len(expected),
+                   "ir_ms": ir_s * 1e3, "ir_kept": kept, "ir_spurious": spurious,
+                   "old_ms": None, "old_kept": None, "old_spurious": None}
+            if not args.skip_old:
+                old_s, old_out = seconds(regex_fix, src)
+                row["old_ms"] = old_s * 1e3
+                row["old_kept"], row["old_spurious"] = edge_stats(old_out, expected)
+            if args.layout:
+                graph = parse_mermaid(ir_out)
+                layout_s, layout = seconds(layout_graph, graph)
+                svg_s, svg = seconds(lambda g: render_svg(g, layout), graph)
+                # Simplified: budgeted diagram plus one laid-out sub-diagram per collapsed cluster
+                simple_s, simple = seconds(diagram_html, ir_out)
+                row.update(layout_ms=layout_s * 1e3, svg_ms=svg_s * 1e3, svg_kb=len(svg) / 1024,
+                           simple_ms=simple_s * 1e3, simple_kb=len(simple) / 1024,
+                           simple_nodes=len(simplify_graph(graph)[0].nodes))
+            results.append(row)
+
+    def cell(value, fmt):
+        return "-" if value is None else format(value, fmt)
+
+    print(f"{'case':<11}{'nodes':>7}{'edges':>7}{'old ms':>10}{'ir ms':>9}"
+          f"{'old kept':>10}{'old spur':>10}{'ir kept':>9}{'ir spur':>9}")
+    for r in results:
+        print(f"{r['case']:<11}{r['nodes']:>7}{r['edges']:>7}{cell(r['old_ms'], '.1f'):>10}{r['ir_ms']:>9.1f}"
+              f"{cell(r['old_kept'], 'd'):>10}{cell(r['old_spurious'], 'd'):>10}"
+              f"{r['ir_kept']:>9}{r['ir_spurious']:>9}")
+    if args.layout:
+        print(f"\nLayout, full vs simplified (budget {DIAGRAM_MAX_NODES} nodes / {DIAGRAM_MAX_EDGES} edges)")
+        print(f"{'case':<11}{'nodes':>7}{'full ms':>10}{'full KB':>9}{'simple ms':>11}{'shown':>7}{'simple KB':>11}")
+        for r in results:
+            print(f"{r['case']:<11}{r['nodes']:>7}{r['layout_ms'] + r['svg_ms']:>10.1f}{r['svg_kb']:>9.0f}"
+                  f"{r['simple_ms']:>11.1f}{r['simple_nodes']:>7}{r['simple_kb']:>11.0f}")
+    if args.out:
+        with open(args.out, "w", encoding="utf-8") as f:
+            json.dump({"results": results}, f, indent=2)
+        print(f"[INFO] Results written to {args.out}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,84 @@
+# benchmarks/prompt_tokens.py
+"""
+Prompt tokenization micro-benchmark: CPU time per request for tokenizing the
+whole rendered prompt vs. PromptTemplate.encode (pre-tokenized fixed text,
+only the user's request tokenized), at several batch sizes.
+
+    python -m benchmarks.prompt_tokens                    # tokenizer from MISTRAL_MODEL_PATH
+    python -m benchmarks.prompt_tokens --tokenizer byte   # tiny byte-level tokenizer, no download
+    python -m benchmarks.prompt_tokens --requests 5000 --batch-size 1 8 32
+"""
+import argparse
+import itertools
+import json
+import os
+import time
+
+from utils.prompts import APP_TEMPLATE, MAIN_TEMPLATE
+
+REQUESTS = [
+    "Write a function to find the maximum subarray sum using Kadane's algorithm",
+    "Print all prime numbers up to n using the sieve of Eratosthenes",
+    "Implement binary search over a sorted list and return the index or -1",
+    "Breadth-first search on a grid to find the shortest path from S to E",
+    "Implement an LRU cache with get and put in O(1)",
+    "Check whether a string of brackets is balanced using a stack",
+]
+
+
+def load_tokenizer(name):
+    if name == "byte":
+        from utils.backends import build_byte_tokenizer
+        return build_byte_tokenizer()
+    from transformers import AutoTokenizer
+    return AutoTokenizer.from_pretrained(name)
+
+
+def cpu_per_request(fn, batches):
+    """Mean process CPU seconds per request over all batches."""
+    started = time.process_time()
+    count = 0
+    for batch in batches:
+        fn(batch)
+        count += len(batch)
+    return (time.process_time() - started) / count
+
+
+def main():
+    ap = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    ap.add_argument("--tokenizer", default=os.environ.get("MISTRAL_MODEL_PATH", "byte"),
+                    help="model path / hub id, or 'byte' for the tiny byte-level tokenizer")
+    ap.add_argument("--requests", type=int, default=2000)
+    ap.add_argument("--batch-size", type=int, nargs="+", default=[1, 8])
+    ap.add_argument("--out", help="also write the results as JSON here")
+    args = ap.parse_args()
+
+    tokenizer = load_tokenizer(args.tokenizer)
+    results = []
+    for template, name in ((APP_TEMPLATE, "app"), (MAIN_TEMPLATE, "main")):
+        exact = template.segments(tokenizer) is not None  # warms the fixed segments too
+        # Vary the text so no tokenizer-side cache can help either path
+        users = [f"{text} (request {i})" for i, text in zip(range(args.requests), itertools.cycle(REQUESTS))]
+        for batch_size in args.batch_size:
+            batches = [users[i:i + batch_size] for i in range(0, len(users), batch_size)]
+            full = cpu_per_request(lambda b: tokenizer([template.render(u) for u in b]).input_ids, batches)
+            split = cpu_per_request(lambda b: template.encode(tokenizer, b), batches)
+            results.append({
+                "template": name, "batch_size": batch_size, "split_exact": exact,
+                "full_us": full * 1e6, "template_us": split * 1e6,
+                "saved_us": (full - split) * 1e6, "speedup": full / split if split else 0.0,
+            })
+
+    print(f"{'template':<9}{'batch':>6}{'full µs/req':>14}{'split µs/req':>14}{'saved':>10}{'speedup':>9}")
+    for r in results:
+        print(f"{r['template']:<9}{r['batch_size']:>6}{r['full_us']:>14.1f}{r['template_us']:>14.1f}"
+              f"{r['saved_us']:>10.1f}{r['speedup']:>8.1f}x" + ("" if r["split_exact"] else "  (fallback)"))
+    print("At R requests/s, tokenization frees saved_us × R µs of CPU per second.")
+    if args.out:
+        with open(args.out, "w", encoding="utf-8") as f:
+            json.dump({"tokenizer": args.tokenizer, "requests": args.requests, "results": results}, f, indent=2)
+        print(f"[INFO] Results written to {args.out}")
+
+
+if __name__ == "__main__":
+    main()
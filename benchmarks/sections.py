@@ -0,0 +1,170 @@
+# benchmarks/sections.py
+"""
+Section parser benchmark: the previous regex-per-section parse_response vs.
+the incremental SectionStreamParser, on multi-megabyte responses and on
+pathological ones whose end markers never arrive. Reports one whole-text
+parse and a streamed parse (small chunks, as utils.llm emits them).
+
+    python -m benchmarks.sections                     # 1 and 4 MB inputs
+    python -m benchmarks.sections --mb 8 --chunk 32
+    python -m benchmarks.sections --cases missing_end repeated_starts --out sections.json
+"""
+import argparse
+import json
+import re
+import time
+
+from utils.parser import (
+    ANNOTATED_END, ANNOTATED_START, CODE_END, CODE_START, COMPLEXITY_END, COMPLEXITY_START, METADATA_END,
+    METADATA_START, SECTIONS, TEST_END, TEST_START, VIZ_END, VIZ_START, SectionStreamParser, parse_response,
+)
+
+
+# ---------- Previous implementation, kept for comparison ----------
+def regex_parse(response):
+    sections = {}
+    first_metadata_index = response.find(METADATA_START)
+    if first_metadata_index != -1:
+        response = response[first_metadata_index:].strip()
+    for key, start, end in SECTIONS:
+        match = re.search(f'{re.escape(start)}(.*?){re.escape(end)}', response, re.DOTALL | re.IGNORECASE)
+        sections[key] = match.group(1).strip() if match else None
+    if sections['metadata']:
+        metadata_dict = {}
+        for line in sections['metadata'].splitlines():
+            if ':' in line:
+                key, value = line.split(':', 1)
+                metadata_dict[key.strip().upper()] = value.strip()
+        sections['metadata'] = metadata_dict
+        sections['language'] = metadata_dict.get('LANGUAGE', 'python').lower()
+    if sections['code']:
+        code_match = re.search(r'```(\w+)\n(.*?)```', sections['code'], re.DOTALL)
+        if code_match:
+            sections['language'] = code_match.group(1).lower()
+            sections['code'] = code_match.group(2).strip()
+        else:
+            sections['code'] = sections['code'].strip()
+    if sections['visualization']:
+        sections['visualization'] = sections['visualization'].replace('```mermaid', '').replace('```', '').strip()
+    return sections
+
+
+def regex_stream(chunks):
+    """The previous _SectionWatcher: re-parse the whole response whenever an end marker shows up."""
+    response = ""
+    pending = {key: end.lower() for key, _, end in SECTIONS}
+    longest = max(len(end) for _, _, end in SECTIONS)
+    for chunk in chunks:
+        tail_start = max(0, len(response) - longest)
+        response += chunk
+        tail = response[tail_start:].lower()
+        finished = [key for key, end in pending.items() if end in tail]
+        if finished:
+            regex_parse(response)
+            for key in finished:
+                del pending[key]
+    return regex_parse(response)
+
+
+def parser_stream(chunks):
+    parser = SectionStreamParser()
+    for chunk in chunks:
+        if parser.feed(chunk):
+            parser.sections()
+    return parser.sections()
+
+
+# ---------- Inputs ----------
+CODE_LINE = "    total = total + values[i] * weights[i]  # accumulate\n"
+
+
+def well_formed(size):
+    """A complete response whose CODE section is padded to about `size` characters."""
+    body = CODE_LINE * max(1, size // len(CODE_LINE))
+    return (
+        f"Sure, here it is.\n{METADATA_START}\nLANGUAGE: python\nALGORITHM: weighted sum\n{METADATA_END}\n"
+        f"{CODE_START}\n```python\ndef run(values, weights):\n    total = 0\n{body}    return total\n```\n{CODE_END}\n"
+        f"{VIZ_START}\n```mermaid\nflowchart TD\n    A[Start] --> B[Loop]\n    B --> C[End]\n```\n{VIZ_END}\n"
+        f"{ANNOTATED_START}\nline 1: loop\n{ANNOTATED_END}\n"
+        f"{COMPLEXITY_START}\nTime: O(n)\nSpace: O(1)\n{COMPLEXITY_END}\n"
+        f"{TEST_START}\nrun([1], [2]) -> 2\n{TEST_END}\n"
+    )
+
+
+def missing_end(size):
+    """Every start marker, no end marker: each regex scans to the end of the text and fails."""
+    filler = CODE_LINE * max(1, size // len(CODE_LINE) // len(SECTIONS))
+    return "".join(f"{start}\n{filler}" for _, start, _ in SECTIONS)
+
+
+def repeated_starts(size):
+    """
+    A start marker on every line and no end marker: the regex retries from each
+    one, which is quadratic, so this input is capped at 100 kB.
+    """
+    line = f"{CODE_START} x = 1\n"
+    return METADATA_START + "\n" + line * max(1, min(size, 100_000) // len(line))
+
+
+def equals_run(size):
+    """One long run of '=' characters, which every marker starts with."""
+    return METADATA_START + "=" * size
+
+
+CASES = {
+    "well_formed": well_formed,
+    "missing_end": missing_end,
+    "repeated_starts": repeated_starts,
+    "equals_run": equals_run,
+}
+
+
+def seconds(fn, arg):
+    started = time.perf_counter()
+    result = fn(arg)
+    return time.perf_counter() - started, result
+
+
+def main():
+    ap = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    ap.add_argument("--mb", type=float, nargs="+", default=[1, 4], help="input sizes in megabytes")
+    ap.add_argument("--chunk", type=int, default=16, help="characters per streamed chunk")
+    ap.add_argument("--cases", nargs="+", choices=sorted(CASES), default=list(CASES))
+    ap.add_argument("--skip-regex-stream", action="store_true",
+                    help="skip the previous streamed parse (slow on large inputs)")
+    ap.add_argument("--out", help="also write the results as JSON here")
+    args = ap.parse_args()
+
+    results = []
+    for name in args.cases:
+        for mb in args.mb:
+            text = CASES[name](int(mb * 1_000_000))
+            chunks = [text[i:i + args.chunk] for i in range(0, len(text), args.chunk)]
+            regex_s, expected = seconds(regex_parse, text)
+            parser_s, got = seconds(parse_response, text)
+            if got != expected:
+                raise SystemExit(f"[ERROR] {name}: parse_response differs from the previous parser")
+            parser_stream_s, streamed = seconds(parser_stream, chunks)
+            if streamed != expected:
+                raise SystemExit(f"[ERROR] {name}: streamed parse differs from the previous parser")
+            regex_stream_s = None if args.skip_regex_stream else seconds(regex_stream, chunks)[0]
+            results.append({
+                "case": name, "chars": len(text), "chunks": len(chunks),
+                "regex_ms": regex_s * 1e3, "parser_ms": parser_s * 1e3,
+                "regex_stream_ms": regex_stream_s * 1e3 if regex_stream_s is not None else None,
+                "parser_stream_ms": parser_stream_s * 1e3,
+            })
+
+    print(f"{'case':<17}{'MB':>6}{'regex ms':>11}{'parser ms':>11}{'regex stream':>14}{'parser stream':>15}")
+    for r in results:
+        regex_stream_ms = f"{r['regex_stream_ms']:.1f}" if r["regex_stream_ms"] is not None else "-"
+        print(f"{r['case']:<17}{r['chars'] / 1e6:>6.1f}{r['regex_ms']:>11.1f}{r['parser_ms']:>11.1f}"
+              f"{regex_stream_ms:>14}{r['parser_stream_ms']:>15.1f}")
+    if args.out:
+        with open(args.out, "w", encoding="utf-8") as f:
+            json.dump({"chunk": args.chunk, "results": results}, f, indent=2)
+        print(f"[INFO] Results written to {args.out}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,73 @@
+# benchmarks/startup.py
+"""
+Startup-time benchmark: eager (load weights before the UI can paint) versus the
+lazy background handle in utils.llm.
+
+Each mode runs in a fresh interpreter so import caches do not leak between runs.
+
+    python -m benchmarks.startup --model-path /path/to/mistral_7b_instruct_v2_4bit
+"""
+import argparse
+import json
+import os
+import subprocess
+import sys
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# Old behaviour: importing the UI modules meant loading the weights first
+EAGER = """
+import json, time
+t0 = time.perf_counter()
+from model_loader import load_model
+import utils.parser, utils.visualizer
+tokenizer, model = load_model({path!r})
+t1 = time.perf_counter()
+print(json.dumps({{"interactive_s": t1 - t0, "ready_s": t1 - t0}}))
+"""
+
+# New behaviour: the UI is interactive once imports finish; weights arrive later
+LAZY = """
+import json, time
+t0 = time.perf_counter()
+import utils.llm, utils.parser, utils.visualizer
+handle = utils.llm.get_handle().start()
+t1 = time.perf_counter()
+handle.get()
+t2 = time.perf_counter()
+print(json.dumps({{"interactive_s": t1 - t0, "ready_s": t2 - t0}}))
+"""
+
+
+def run(script, model_path):
+    env = dict(os.environ, MISTRAL_MODEL_PATH=model_path, PYTHONPATH=ROOT)
+    out = subprocess.run(
+        [sys.executable, "-c", script.format(path=model_path)],
+        cwd=ROOT, env=env, capture_output=True, text=True, check=True
+    ).stdout
+    return json.loads(out.strip().splitlines()[-1])
+
+
+def main():
+    ap = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    ap.add_argument("--model-path", default=os.environ.get("MISTRAL_MODEL_PATH"))
+    ap.add_argument("--repeat", type=int, default=3)
+    args = ap.parse_args()
+    if not args.model_path:
+        ap.error("--model-path (or MISTRAL_MODEL_PATH) is required")
+
+    results = {}
+    for name, script in (("eager", EAGER), ("lazy", LAZY)):
+        runs = [run(script, args.model_path) for _ in range(args.repeat)]
+        results[name] = {
+            key: min(r[key] for r in runs) for key in ("interactive_s", "ready_s")
+        }
+
+    print(f"{'mode':<8}{'interactive (s)':>18}{'model ready (s)':>18}")
+    for name, r in results.items():
+        print(f"{name:<8}{r['interactive_s']:>18.2f}{r['ready_s']:>18.2f}")
+    print(json.dumps(results))
+
+
+if __name__ == "__main__":
+    main()
@@ -1,85 +1,88 @@
-import os
-import re
-from utils.llm import generate_response
-from utils.visualizer import render_graphviz
-
-
-# ---------------------------------------------------------------------
-# Mermaid syntax validator and fixer
-# ---------------------------------------------------------------------
-def validate_and_fix_mermaid(mermaid_code):
-    """
-    Validates and attempts to fix common Mermaid syntax errors.
-    """
-    lines = mermaid_code.strip().split('\n')
-    fixed_lines = []
-
-    for line in lines:
-        line = line.strip()
-        if not line:
-            continue
-
-        # Fix common syntax issues
-        # 1. Remove invalid characters from node IDs
-        line = re.sub(r'([A-Za-z0-9_]+)\s*\[([^\]]+)\]', lambda m: f'{m.group(1)}["{m.group(2)}"]', line)
-
-        # 2. Fix arrow syntax (ensure spaces around arrows)
-        line = re.sub(r'(\w+)-->(\w+)', r'\1 --> \2', line)
-        line = re.sub(r'(\w+)->(\w+)', r'\1 --> \2', line)
-
-        # 3. Fix decision nodes (ensure proper syntax)
-        line = re.sub(r'\{([^\}]+)\}', r'{\1}', line)
-
-        # 4. Fix labels on arrows
-        line = re.sub(r'-->\|([^\|]+)\|', r'--> |\1|', line)
+"""
+Command-line code generator.
 
-        fixed_lines.append(line)
+    python main.py                                   # interactive: one request from the prompt
+    python main.py --batch prompts.jsonl             # offline: one {"id", "prompt"} object per line
+    python main.py --batch prompts.jsonl --out results.jsonl --concurrency 16
 
-    return '\n    '.join(fixed_lines)
+Batch mode appends one JSON result per record to --out (parsed sections,
+status, diagram path) and writes each record's diagram under --diagrams.
+The output file is the checkpoint: rerunning the same command skips records
+already written and retries the ones that failed.
+"""
+import argparse
+import asyncio
+import functools
+import hashlib
+import json
+import os
+import re
+import shutil
+import subprocess
+import time
+from utils.llm import GENERATION_TIMEOUT, generate_response_async, get_handle, server_client, stream_response_async
+from utils.flowchart import AST_FLOWCHART
+from utils.parser import aiter_sections, is_complete, parse_response
+from utils.prompts import build_main_prompt
+from utils.scheduler import Overloaded, QueueTimeout
+from utils.telemetry import RequestTrace, metrics, timed
+from utils.visualizer import DIAGRAM_RENDERER, diagram_html, diagram_mermaid, validate_and_fix_mermaid
 
 
 # ---------------------------------------------------------------------
 # Render Mermaid diagrams as HTML with fallback
 # ---------------------------------------------------------------------
-def render_mermaid_html(mermaid_code, output_path="outputs/viz.html"):
-    os.makedirs(os.path.dirname(output_path), exist_ok=True)
-
-    # Try to fix common syntax errors
-    fixed_mermaid = validate_and_fix_mermaid(mermaid_code)
-
-    html_template = f"""
-<!DOCTYPE html>
-<html lang="en">
-<head>
-    <meta charset="UTF-8">
-    <meta name="viewport" content="width=device-width, initial-scale=1.0">
-    <title>Mermaid Diagram</title>
+# Browser-side rendering, used with DIAGRAM_RENDERER=mermaid or when server-side layout fails
+MERMAID_SCRIPT = """\
     <script type="module">
         import mermaid from 'https://cdn.jsdelivr.net/npm/mermaid@10/dist/mermaid.esm.min.mjs';
-        mermaid.initialize({{ 
+        mermaid.initialize({ 
             startOnLoad: true, 
             theme: 'default',
-            flowchart: {{ 
+            flowchart: { 
                 useMaxWidth: true,
                 htmlLabels: true,
                 curve: 'basis'
-            }},
+            },
             securityLevel: 'loose'
-        }});
+        });
 
         // Error handling
-        window.addEventListener('load', () => {{
-            setTimeout(() => {{
+        window.addEventListener('load', () => {
+            setTimeout(() => {
                 const errorDiv = document.querySelector('.mermaid-error');
                 const mermaidDiv = document.querySelector('.mermaid');
-                if (mermaidDiv && mermaidDiv.getAttribute('data-processed') !== 'true') {{
+                if (mermaidDiv && mermaidDiv.getAttribute('data-processed') !== 'true') {
                     errorDiv.style.display = 'block';
                     console.error('Mermaid rendering failed');
-                }}
-            }}, 2000);
-        }});
+                }
+            }, 2000);
+        });
     </script>
-    <style>
+"""
+
+
+@timed("render_html")
+def render_mermaid_html(mermaid_code, output_path="outputs/viz.html", announce=True):
+    os.makedirs(os.path.dirname(output_path), exist_ok=True)
+
+    # Try to fix common syntax errors
+    fixed_mermaid = validate_and_fix_mermaid(mermaid_code)
+    svg = None
+    if DIAGRAM_RENDERER == "svg":
+        try:
+            svg = diagram_html(mermaid_code)
+        except Exception as e:
+            print(f"[WARN] Server-side diagram layout failed, using mermaid.js: {e}")
+
+    html_template = f"""
+<!DOCTYPE html>
+<html lang="en">
+<head>
+    <meta charset="UTF-8">
+    <meta name="viewport" content="width=device-width, initial-scale=1.0">
+    <title>Mermaid Diagram</title>
+{'' if svg else MERMAID_SCRIPT}    <style>
         body {{ 
             font-family: 'Segoe UI', Tahoma, Geneva, Verdana, sans-serif; 
             background: linear-gradient(135deg, #667eea 0%, #764ba2 100%);
@@ -147,8 +150,8 @@ def render_mermaid_html(mermaid_code, output_path="outputs/viz.html"):
             <p>Check the original code section below for details.</p>
         </div>
 
-        <div class="mermaid">
-{fixed_mermaid}
+        <div class="mermaid"{' data-processed="true"' if svg else ''}>
+{svg or diagram_mermaid(mermaid_code)}
         </div>
 
         <div class="original-code">
@@ -166,131 +169,292 @@ def render_mermaid_html(mermaid_code, output_path="outputs/viz.html"):
 """
     with open(output_path, "w", encoding="utf-8") as f:
         f.write(html_template)
-    print(f"✅ Mermaid diagram saved to {output_path}")
+    if announce:
+        print(f"✅ Mermaid diagram saved to {output_path}")
 
 
 # ---------------------------------------------------------------------
-# Enhanced prompt with strict Mermaid syntax guidelines
+# Render Graphviz diagrams: DOT source, plus SVG when Graphviz is installed
 # ---------------------------------------------------------------------
-user_prompt = input("Enter your code request: ")
-
-prompt = f"""
-You are an expert senior software engineer, code reviewer, and teacher. Respond precisely in the format requested below.
-
-TASK: {user_prompt}
-
-OUTPUT FORMAT — Generate **only** the sections below in this exact order and format:
-
-===METADATA===
-LANGUAGE: <lowercase language, e.g. java, python, cpp>
-FILENAME: <suggested filename with extension, e.g. MaxSubsetSum.java>
-ALGORITHM: <short id, e.g. kadane | non_adjacent | sum_of_positives>
-===END METADATA===
-
-===CODE===
-```<language>
-<Complete runnable source code only. Include imports and a minimal main/test harness. No extra prose inside this fenced code block.>
-```
-===END CODE===
-
-===VISUALIZATION===
-```mermaid
-flowchart TD
-    Start([Start]) --> Step1[Step description]
-    Step1 --> Decision{{Condition?}}
-    Decision -->|Yes| Step2[Action if true]
-    Decision -->|No| Step3[Action if false]
-    Step2 --> End([End])
-    Step3 --> End
-```
-
-CRITICAL MERMAID RULES:
-1. ALWAYS start with "flowchart TD" on the first line
-2. Node IDs must be alphanumeric only (no spaces, no special chars except underscore)
-3. Use these shapes ONLY:
-   - Start/End: ([Text])
-   - Process: [Text]
-   - Decision: {{Text}}
-4. Arrow syntax: NodeA --> NodeB or NodeA -->|Label| NodeB
-5. Every node must have a unique ID
-6. All node IDs must be defined before use
-7. Keep descriptions short and clear
-8. NO line breaks inside node text
-9. Example valid nodes:
-   - Start([Begin])
-   - Init[Initialize variables]
-   - Check{{Is x > 0?}}
-   - End([Finish])
-
-===END VISUALIZATION===
-
-===ANNOTATED CODE===
-Provide the same code again with line numbers and a detailed step-by-step explanation of each line or logical block.
-Numbered steps must reference line numbers (e.g., "line 3: initialize sum...").
-No code fences here — explanation text only.
-===END ANNOTATED===
-
-===COMPLEXITY===
-Time: O(...)
-Space: O(...)
-===END COMPLEXITY===
-
-===TEST CASES===
-List at least 3 test inputs and expected outputs, including edge cases.
-===END TEST CASES===
-
-RULES:
-- The Mermaid diagram MUST be syntactically correct
-- Test your Mermaid syntax mentally before outputting
-- Use simple, clear node names
-- Every path must lead to an end node
-- Keep the diagram focused on main logic flow
-"""
+@timed("render_html")
+def render_graphviz(dot_source, output_path="outputs/viz.dot", announce=True):
+    os.makedirs(os.path.dirname(output_path), exist_ok=True)
+    with open(output_path, "w", encoding="utf-8") as f:
+        f.write(dot_source)
+    saved = output_path
+    if shutil.which("dot"):
+        svg_path = os.path.splitext(output_path)[0] + ".svg"
+        try:
+            subprocess.run(["dot", "-Tsvg", output_path, "-o", svg_path], check=True, timeout=60,
+                           capture_output=True)
+            saved = svg_path
+        except (subprocess.SubprocessError, OSError) as e:
+            print(f"[WARN] Graphviz could not render {output_path}: {e}")
+    if announce:
+        print(f"✅ Graphviz diagram saved to {saved}")
+    return saved
 
-# ---------------------------------------------------------------------
-# Run the model
-# ---------------------------------------------------------------------
-response = generate_response(prompt)
 
 # ---------------------------------------------------------------------
-# Extract second METADATA and everything after
+# Extract visualization (Mermaid or Graphviz)
 # ---------------------------------------------------------------------
-matches = re.findall(r"(===METADATA===.*?)(?=(?:===METADATA===|$))", response, flags=re.DOTALL)
-if len(matches) > 1:
-    start_index = response.find(matches[1])
-    response = response[start_index:].strip()
-else:
-    match = re.search(r"(===METADATA===.*)", response, flags=re.DOTALL)
-    if match:
-        response = match.group(1).strip()
+def extract_visualization(response):
+    """("mermaid" | "dot", source) from the model output, or (None, None)."""
+    if AST_FLOWCHART:
+        # The prompt has no VISUALIZATION section; Python code is drawn from its AST
+        flowchart = parse_response(response)['visualization']
+        if flowchart:
+            return "mermaid", flowchart
+    viz_match = re.search(r"```(mermaid|dot)\n(.*?)```", response, flags=re.DOTALL | re.IGNORECASE)
+    if viz_match:
+        return viz_match.group(1).lower(), viz_match.group(2).strip()
+    # A code block without a language tag that still looks like Mermaid
+    fallback_match = re.search(r"```\n(flowchart.*?)```", response, flags=re.DOTALL | re.IGNORECASE)
+    if fallback_match:
+        return "mermaid", fallback_match.group(1).strip()
+    return None, None
+
+def save_visualization(response, stem="outputs/viz", announce=True):
+    """Write the response's diagram next to `stem` (.html or .dot/.svg); returns the path or None."""
+    viz_type, viz_data = extract_visualization(response)
+    if viz_type == "mermaid":
+        render_mermaid_html(viz_data, output_path=stem + ".html", announce=announce)
+        return stem + ".html"
+    if viz_type == "dot":
+        return render_graphviz(viz_data, output_path=stem + ".dot", announce=announce)
+    return None
+
 
 # ---------------------------------------------------------------------
-# Extract visualization (Mermaid or Graphviz)
+# Interactive mode: run the model, printing each section as soon as it is complete
 # ---------------------------------------------------------------------
-viz_match = re.search(r"```(mermaid|dot)\n(.*?)```", response, flags=re.DOTALL | re.IGNORECASE)
-if viz_match:
-    viz_type = viz_match.group(1).lower()
-    viz_data = viz_match.group(2).strip()
-
+async def print_sections(prompt, trace):
+    """Print each section as it completes; Ctrl+C cancels generation at the next decode step."""
+    # CLI runs are batch work: the scheduler serves interactive UI requests first
+    chunks = trace.awatch(
+        stream_response_async(prompt, timeout=GENERATION_TIMEOUT, priority="batch", client="main.py")
+    )
+    async for key, sections, response in aiter_sections(chunks):
+        if key is None:
+            return response
+        value = sections.get(key)
+        if isinstance(value, dict):
+            value = "\n".join(f"{k}: {v}" for k, v in value.items())
+        print(f"--- {key.upper()} ---")
+        print(value if value else "(empty)")
+        print()
+
+def run_interactive():
+    # Start loading weights in the background while the user types the request
+    if server_client() is None:
+        get_handle().start()
+    user_prompt = input("Enter your code request: ")
+    prompt = build_main_prompt(user_prompt)
+
+    print("\n=== MODEL RESPONSE ===\n")
+    trace = RequestTrace("main")
+    response = asyncio.run(print_sections(prompt, trace))
+    if not is_complete(response):
+        print("⏱️ Generation stopped early; only the completed sections are shown.")
+
+    viz_type, viz_data = extract_visualization(response)
     if viz_type == "mermaid":
         print(f"📊 Found Mermaid diagram ({len(viz_data)} chars)")
-        # Render Mermaid HTML with validation
-        render_mermaid_html(viz_data)
     elif viz_type == "dot":
         print("📊 Found Graphviz diagram")
-        render_graphviz(viz_data)
     else:
-        print("⚠️ Visualization format not recognized.")
-else:
-    print("⚠️ No valid visualization found in model output.")
-    # Try to extract any code block that might be mermaid
-    fallback_match = re.search(r"```\n(flowchart.*?)```", response, flags=re.DOTALL | re.IGNORECASE)
-    if fallback_match:
-        print("🔄 Found potential Mermaid code without language tag, attempting to render...")
-        render_mermaid_html(fallback_match.group(1).strip())
+        print("⚠️ No valid visualization found in model output.")
+    save_visualization(response)
+
+    trace.finish("complete" if is_complete(response) else "truncated")
+
 
 # ---------------------------------------------------------------------
-# Print final clean output
+# Batch mode: JSONL prompts in, JSONL results out, resumable
 # ---------------------------------------------------------------------
-print("\n=== MODEL RESPONSE ===\n")
-print(response)
\ No newline at end of file
+def read_records(path):
+    """Stream {"id", "prompt"} records; the id defaults to the line number."""
+    with open(path, encoding="utf-8") as f:
+        for number, line in enumerate(f, 1):
+            line = line.strip()
+            if not line:
+                continue
+            try:
+                record = json.loads(line)
+            except ValueError:
+                print(f"[WARN] {path}:{number}: not valid JSON, skipped")
+                continue
+            if isinstance(record, str):
+                record = {"prompt": record}
+            request = record.get("prompt") or record.get("request")
+            if not request:
+                print(f"[WARN] {path}:{number}: no \"prompt\", skipped")
+                continue
+            yield {"id": str(record.get("id", number)), "prompt": request}
+
+def load_checkpoint(path):
+    """
+    Ids already written to the output file (failed records excluded, so they
+    are retried). A line cut short by a crash is dropped first.
+    """
+    done = set()
+    if not os.path.exists(path):
+        return done
+    with open(path, "rb+") as f:
+        data = f.read()
+        if data and not data.endswith(b"\n"):
+            f.truncate(data.rfind(b"\n") + 1)
+            data = data[:data.rfind(b"\n") + 1]
+    for line in data.decode("utf-8").splitlines():
+        try:
+            result = json.loads(line)
+        except ValueError:
+            continue
+        if result.get("status") == "error":
+            done.discard(result.get("id"))
+        else:
+            done.add(result.get("id"))
+    return done
+
+def _file_stem(record_id):
+    """A file name for the record's diagram; the hash keeps ids like "a/b" and "a_b" apart."""
+    digest = hashlib.sha1(record_id.encode("utf-8")).hexdigest()[:8]
+    return (re.sub(r"[^A-Za-z0-9_.-]", "_", record_id)[:100] or "record") + "-" + digest
+
+async def process_record(record, args):
+    """Generate, parse and draw one record; returns its result line."""
+    prompt = build_main_prompt(record["prompt"])
+    started = time.perf_counter()
+    trace = RequestTrace("main-batch", id=record["id"])
+    for attempt in range(args.retries + 1):
+        try:
+            result = await generate_response_async(
+                prompt, args.max_new_tokens, timeout=GENERATION_TIMEOUT, priority="batch", client="main.py"
+            )
+            break
+        except (Overloaded, QueueTimeout) as e:
+            if attempt == args.retries:
+                trace.finish("busy", error=str(e))
+                return {"id": record["id"], "status": "error", "error": str(e)}
+            await asyncio.sleep(min(30.0, 2.0 ** attempt))
+        except Exception as e:
+            trace.finish("error", error=str(e))
+            return {"id": record["id"], "status": "error", "error": f"{type(e).__name__}: {e}"}
+
+    # Off the event loop, and one bad diagram must not abort the other records
+    diagram = diagram_error = None
+    try:
+        diagram = await asyncio.get_running_loop().run_in_executor(
+            None, functools.partial(save_visualization, result["response"],
+                                    os.path.join(args.diagrams, _file_stem(record["id"])), announce=False)
+        )
+    except Exception as e:
+        diagram_error = f"{type(e).__name__}: {e}"
+        print(f"[WARN] {record['id']}: could not save the diagram: {diagram_error}")
+    trace.finish(result["status"])
+    return {
+        "id": record["id"],
+        "prompt": record["prompt"],
+        "status": result["status"],
+        "sections": result["sections"],
+        "diagram": diagram,
+        "diagram_error": diagram_error,
+        "seconds": round(time.perf_counter() - started, 3),
+        "response_chars": len(result["response"]),
+        "response": result["response"],
+    }
+
+async def run_batch(args):
+    done = load_checkpoint(args.out)
+    if done:
+        print(f"[batch] Resuming: {len(done)} records already in {args.out}")
+    os.makedirs(os.path.dirname(os.path.abspath(args.out)), exist_ok=True)
+    tokens_before = metrics.snapshot()["counters"].get("generated_tokens_total", 0)
+
+    # Enough requests in flight for the micro-batcher to fill its batches
+    slots = asyncio.Semaphore(args.concurrency)
+    pending = set()
+    statuses = {}
+    latencies = []
+    started = time.perf_counter()
+
+    with open(args.out, "a", encoding="utf-8") as out:
+        async def run_one(record):
+            try:
+                result = await process_record(record, args)
+            finally:
+                slots.release()
+            # One durable line per record: this file is the checkpoint
+            out.write(json.dumps(result, ensure_ascii=False) + "\n")
+            out.flush()
+            os.fsync(out.fileno())
+            statuses[result["status"]] = statuses.get(result["status"], 0) + 1
+            if "seconds" in result:
+                latencies.append(result["seconds"])
+            finished = sum(statuses.values())
+            print(f"[batch] {finished} done | {record['id']}: {result['status']}"
+                  + (f" ({result['seconds']:.1f} s)" if "seconds" in result else f" ({result.get('error')})"))
+
+        skipped = submitted = 0
+        for record in read_records(args.input):
+            if record["id"] in done:
+                skipped += 1
+                continue
+            if args.limit and submitted >= args.limit:
+                break
+            submitted += 1
+            await slots.acquire()
+            task = asyncio.create_task(run_one(record))
+            pending.add(task)
+            task.add_done_callback(pending.discard)
+            done.add(record["id"])  # a repeated id in the input runs once
+        if pending:
+            await asyncio.gather(*pending)
+
+    elapsed = time.perf_counter() - started
+    processed = sum(statuses.values())
+    tokens = metrics.snapshot()["counters"].get("generated_tokens_total", 0) - tokens_before
+    latencies.sort()
+    print("\n=== BATCH THROUGHPUT ===")
+    print(f"Records:      {processed} processed, {skipped} already done"
+          + "".join(f", {count} {status}" for status, count in sorted(statuses.items())))
+    print(f"Elapsed:      {elapsed:.1f} s")
+    if processed and elapsed > 0:
+        print(f"Throughput:   {processed / elapsed:.3f} records/s ({3600 * processed / elapsed:.0f} records/hour)")
+    if tokens and elapsed > 0:
+        print(f"Tokens:       {tokens} generated, {tokens / elapsed:.1f} tokens/s")
+    if latencies:
+        p50 = latencies[len(latencies) // 2]
+        p95 = latencies[min(len(latencies) - 1, int(0.95 * len(latencies)))]
+        print(f"Latency:      p50 {p50:.1f} s, p95 {p95:.1f} s per record")
+    print(f"Results:      {args.out}")
+    print(f"Diagrams:     {args.diagrams}")
+
+
+def main():
+    ap = argparse.ArgumentParser(description="Generate code, diagrams and explanations from the command line.")
+    ap.add_argument("--batch", dest="input", metavar="JSONL",
+                    help='run every {"id": ..., "prompt": ...} line of this file instead of asking for one request')
+    ap.add_argument("--out", help="results JSONL, also the resume checkpoint (default: <input>.results.jsonl)")
+    ap.add_argument("--diagrams", help="directory for per-record diagrams (default: outputs/batch/<input name>)")
+    ap.add_argument("--concurrency", type=int, default=8, help="records in flight at once")
+    ap.add_argument("--max-new-tokens", type=int, default=None, help="hard token cap (default: adaptive budget)")
+    ap.add_argument("--retries", type=int, default=3, help="retries when the queue is full")
+    ap.add_argument("--limit", type=int, default=0, help="stop after this many new records (0: all)")
+    args = ap.parse_args()
+    args.retries = max(0, args.retries)
+    args.concurrency = max(1, args.concurrency)  # Semaphore(0) would never let a record start
+
+    if not args.input:
+        run_interactive()
+        return
+    name = os.path.splitext(os.path.basename(args.input))[0]
+    args.out = args.out or os.path.splitext(args.input)[0] + ".results.jsonl"
+    args.diagrams = args.diagrams or os.path.join("outputs", "batch", name)
+    if server_client() is None:
+        get_handle().start()
+    asyncio.run(run_batch(args))
+
+
+if __name__ == "__main__":
+    main()
@@ -1,24 +1,114 @@
+import os
+import shutil
+import time
+
 import torch
 from transformers import AutoTokenizer, AutoModelForCausalLM, BitsAndBytesConfig
 
-def load_model(model_path: str):
-    print(f"[load_model] Loading model from {model_path} ...")
+QUANT_TYPES = ("nf4", "fp4", "int8", "none")
 
-    bnb_config = BitsAndBytesConfig(
-        load_in_4bit=True,
-        bnb_4bit_use_double_quant=True,
-        bnb_4bit_quant_type="nf4",
-        bnb_4bit_compute_dtype=torch.float16,
-        llm_int8_enable_fp32_cpu_offload = True
-    )
+def quantization_config(quant_type: str = "nf4"):
+    """bitsandbytes config for quant_type (nf4 | fp4 | int8), or None for plain fp16."""
+    if quant_type in ("nf4", "fp4"):
+        return BitsAndBytesConfig(
+            load_in_4bit=True,
+            bnb_4bit_use_double_quant=True,
+            bnb_4bit_quant_type=quant_type,
+            bnb_4bit_compute_dtype=torch.float16,
+            llm_int8_enable_fp32_cpu_offload = True
+        )
+    if quant_type == "int8":
+        return BitsAndBytesConfig(load_in_8bit=True, llm_int8_enable_fp32_cpu_offload=True)
+    if quant_type == "none":
+        return None
+    raise ValueError(f"Unknown quant_type {quant_type!r}; expected one of {QUANT_TYPES}")
+
+def quantized_cache_path(model_path: str, quant_type: str, cache_dir: str):
+    """Where the already-quantized copy of model_path lives; keyed by its file fingerprint."""
+    from utils.cache import fingerprint_files
+    return os.path.join(cache_dir, f"{quant_type}-{fingerprint_files(model_path)}")
+
+class LoadPhases:
+    """Wall time per load phase, printed once at the end."""
+
+    def __init__(self, out=None):
+        self.times = out if out is not None else {}
+        self._last = time.perf_counter()
+
+    def mark(self, name):
+        now = time.perf_counter()
+        self.times[name] = now - self._last
+        self._last = now
+
+    def report(self):
+        total = sum(self.times.values())
+        parts = ", ".join(f"{name} {seconds:.2f}s" for name, seconds in self.times.items())
+        print(f"[load_model] Load phases: {parts} (total {total:.2f}s)")
+
+def load_model(model_path: str, quant_type: str = "nf4", cache_dir: str = None, phases: dict = None):
+    """
+    Load tokenizer + bitsandbytes-quantized model.
+
+    With `cache_dir`, the quantized weights are saved there (safetensors) on the
+    first load. Later loads read that copy instead: safetensors files are
+    memory-mapped and the fp16 -> 4-bit pass is skipped entirely.
+    Per-phase timings are printed and, if given, written into `phases`.
+    """
+    timer = LoadPhases(phases)
+    cached = quantized_cache_path(model_path, quant_type, cache_dir) if cache_dir and quant_type != "none" else None
+    if cached and os.path.isfile(os.path.join(cached, "config.json")):
+        print(f"[load_model] Loading pre-quantized model from {cached} ...")
+        tokenizer = AutoTokenizer.from_pretrained(cached)
+        timer.mark("tokenizer")
+        model = AutoModelForCausalLM.from_pretrained(cached, device_map="auto", torch_dtype=torch.float16)
+        timer.mark("weights (mmap)")
+        timer.report()
+        return tokenizer, model
+
+    print(f"[load_model] Loading model from {model_path} ({quant_type}) ...")
 
     tokenizer = AutoTokenizer.from_pretrained(model_path)
+    timer.mark("tokenizer")
     model = AutoModelForCausalLM.from_pretrained(
         model_path,
         device_map="auto",
-        quantization_config=bnb_config,
+        quantization_config=quantization_config(quant_type),
         torch_dtype=torch.float16
     )
+    timer.mark("weights + quantize")
+
+    if cached:
+        _save_quantized(tokenizer, model, cached)
+        timer.mark("save quantized")
 
     print("[load_model] Model loaded successfully!")
+    timer.report()
     return tokenizer, model
+
+def _save_quantized(tokenizer, model, path):
+    """Write the quantized model next to its final location, then move it into place."""
+    staging = path + ".partial"
+    try:
+        shutil.rmtree(staging, ignore_errors=True)
+        model.save_pretrained(staging, safe_serialization=True)
+        tokenizer.save_pretrained(staging)
+        os.replace(staging, path)
+        print(f"[load_model] Saved quantized weights to {path}")
+    except Exception as e:
+        # e.g. a bitsandbytes/transformers pair that cannot serialize 4-bit weights
+        shutil.rmtree(staging, ignore_errors=True)
+        print(f"[WARN] Could not save quantized weights: {e}")
+
+def load_draft_model(draft_path: str, device, dtype=None):
+    """
+    Small causal LM used as the assistant for speculative decoding.
+    Must share the main model's tokenizer/vocabulary.
+    """
+    print(f"[load_model] Loading draft model from {draft_path} ...")
+    draft = AutoModelForCausalLM.from_pretrained(
+        draft_path,
+        torch_dtype=dtype or torch.float16
+    ).to(device)
+    draft.eval()
+    print("[load_model] Draft model loaded successfully!")
+    return draft
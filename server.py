@@ -0,0 +1,385 @@
+# server.py
+"""
+Local inference service. Owns the model (loaded through utils.llm and
+model_loader.load_model), so Streamlit reruns and CLI runs never load weights
+or block on generate themselves. Point them at it with
+LLM_SERVER_URL=http://127.0.0.1:8765.
+
+    python server.py                    # real model, backend from LLM_BACKEND
+    python server.py --engine fake      # deterministic canned output, no GPU
+
+Endpoints:
+    GET  /healthz   the process is up
+    GET  /readyz    model loaded and not draining (503 otherwise)
+    GET  /stats     engine and server counters
+    GET  /metrics   queue and per-stage telemetry metrics, Prometheus text format
+    POST /generate  {"prompt", "max_new_tokens" (omit for an adaptive budget),
+                    "stream", "timeout", "priority", "client"}; streamed
+                    replies are NDJSON lines {"text": ...} ending with
+                    {"done": true} (or {"error": ...}). A client
+                    that hangs up cancels its request; "timeout" ends it early
+                    at a deadline. 429 = queue full, 504 = queued too long.
+
+On SIGTERM/SIGINT the server drains: /readyz and new requests get 503,
+in-flight requests finish (up to --drain-timeout seconds), then it exits.
+"""
+import argparse
+import hashlib
+import json
+import os
+import re
+import signal
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from utils.batcher import CancelToken, MicroBatcher
+from utils.scheduler import AdmissionQueue, Overloaded, QueueTimeout
+from utils.telemetry import metrics
+
+
+# ---------- Engines ----------
+class LocalEngine:
+    """The real model, via utils.llm: response cache, then the shared micro-batcher."""
+
+    name = "local"
+
+    def __init__(self):
+        from utils import llm
+        self.llm = llm
+        self.handle = llm.get_handle().start()
+
+    def ready(self):
+        return self.handle.ready
+
+    def status(self):
+        return self.handle.status
+
+    def stream(self, prompt, max_new_tokens, cancel, priority="interactive", client=None):
+        self.handle.get()
+        yield from self.llm.stream_cancellable(prompt, max_new_tokens, cancel, priority, client)
+
+    def stats(self):
+        stats = {"backend": self.handle.backend.describe(), "batcher": self.llm.shared_batcher().stats()}
+        if self.llm.response_cache is not None:
+            stats["response_cache"] = self.llm.response_cache.stats()
+        if self.llm.token_budget is not None:
+            stats["token_budget"] = self.llm.token_budget.stats()
+        return stats
+
+    def metrics_text(self):
+        return self.llm.shared_batcher().metrics_text()
+
+
+class FakeEngine:
+    """
+    Deterministic stand-in for load tests on machines without a GPU: the same
+    prompt always yields the same well-formed ===SECTION=== response. Requests
+    go through the same MicroBatcher and admission queue as the real model;
+    each batched decode step emits one whitespace-delimited "token" per row
+    and takes `token_delay` seconds.
+    """
+
+    name = "fake"
+
+    def __init__(self, token_delay=0.005, load_delay=0.0, scheduler=None):
+        self.token_delay = token_delay
+        self.started = time.perf_counter()
+        self.load_delay = load_delay  # simulated model load, for readiness checks
+        self.requests = 0
+        self.tokens = 0
+        self._lock = threading.Lock()
+        self.batcher = MicroBatcher(self._generate, scheduler=scheduler or AdmissionQueue())
+
+    def ready(self):
+        return time.perf_counter() - self.started >= self.load_delay
+
+    def status(self):
+        return "ready" if self.ready() else "loading"
+
+    def stream(self, prompt, max_new_tokens, cancel, priority="interactive", client=None):
+        return self.batcher.stream(prompt, max_new_tokens or 1024, cancel=cancel, priority=priority, client=client)
+
+    def _generate(self, prompts, max_new_tokens, sinks, cancels):
+        """generate_fn for MicroBatcher: all rows advance one token per step."""
+        rows = [re.findall(r"\S+\s*|\s+", fake_response(p))[:max_new_tokens] for p in prompts]
+        outputs = [[] for _ in prompts]
+        with self._lock:
+            self.requests += len(prompts)
+        for step in range(max(len(tokens) for tokens in rows)):
+            live = [
+                i for i, tokens in enumerate(rows)
+                if step < len(tokens) and not (cancels[i] is not None and cancels[i].stopped())
+            ]
+            if not live:
+                break
+            if self.token_delay:
+                time.sleep(self.token_delay)
+            for i in live:
+                outputs[i].append(rows[i][step])
+                if sinks[i]:
+                    sinks[i](rows[i][step])
+            with self._lock:
+                self.tokens += len(live)
+        return ["".join(tokens) for tokens in outputs]
+
+    def stats(self):
+        with self._lock:
+            return {"backend": "fake", "requests": self.requests, "tokens": self.tokens,
+                    "batcher": self.batcher.stats()}
+
+    def metrics_text(self):
+        return self.batcher.metrics_text()
+
+
+def fake_response(prompt):
+    """Canned response whose details are derived from a hash of the prompt."""
+    digest = hashlib.sha256(prompt.encode("utf-8")).hexdigest()
+    name = f"task_{digest[:8]}"
+    limit = int(digest[8:10], 16) % 7 + 3
+    return f"""===METADATA===
+LANGUAGE: python
+FILENAME: {name}.py
+ALGORITHM: {name}
+===END METADATA===
+
+===CODE===
+```python
+def {name}(xs):
+    total = 0
+    for x in xs[:{limit}]:
+        total += x
+    return total
+
+if __name__ == "__main__":
+    print({name}([1, 2, 3]))
+```
+===END CODE===
+
+===VISUALIZATION===
+```mermaid
+flowchart TD
+Start([Start]) --> Init[total = 0]
+Init --> Loop{{More items?}}
+Loop -->|Yes| Add[total += x]
+Add --> Loop
+Loop -->|No| End([Return total])
+```
+===END VISUALIZATION===
+
+===ANNOTATED CODE===
+line 1: define {name} over a list xs
+line 2: initialize total to 0
+line 3: walk at most the first {limit} items
+line 4: add each item to total
+line 5: return the sum
+===END ANNOTATED===
+
+===COMPLEXITY===
+Time: O(n)
+Space: O(1)
+===END COMPLEXITY===
+
+===TEST CASES===
+Test 1:
+input: [1, 2, 3]
+output: 6
+Test 2:
+input: []
+output: 0
+===END TEST CASES===
+"""
+
+
+ENGINES = {"local": LocalEngine, "fake": FakeEngine}
+
+
+# ---------- HTTP ----------
+class InferenceServer(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self, address, engine):
+        super().__init__(address, _Handler)
+        self.engine = engine
+        self.draining = False
+        self.inflight = 0
+        self.served = 0
+        self.started = time.time()
+        self._idle = threading.Condition()
+
+    def admit(self):
+        with self._idle:
+            if self.draining:
+                return False
+            self.inflight += 1
+            return True
+
+    def release(self):
+        with self._idle:
+            self.inflight -= 1
+            self.served += 1
+            self._idle.notify_all()
+
+    def drain(self, timeout):
+        """Refuse new work, wait for in-flight requests, then stop serving."""
+        with self._idle:
+            self.draining = True
+            print(f"[server] Draining {self.inflight} in-flight request(s) ...")
+            self._idle.wait_for(lambda: self.inflight == 0, timeout)
+            if self.inflight:
+                print(f"[WARN] Drain timed out with {self.inflight} request(s) still running")
+        self.shutdown()
+
+    def stats(self):
+        with self._idle:
+            server = {
+                "engine": self.engine.name,
+                "inflight": self.inflight,
+                "served": self.served,
+                "draining": self.draining,
+                "uptime_seconds": time.time() - self.started,
+            }
+        return dict(server, telemetry=metrics.snapshot(), **self.engine.stats())
+
+
+class _Handler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"  # keep-alive, so clients can pool connections
+
+    def do_GET(self):
+        if self.path == "/healthz":
+            self._json(200, {"status": "ok"})
+        elif self.path == "/readyz":
+            ready = self.server.engine.ready() and not self.server.draining
+            self._json(200 if ready else 503, {
+                "ready": ready, "status": self.server.engine.status(), "draining": self.server.draining
+            })
+        elif self.path == "/stats":
+            self._json(200, self.server.stats())
+        elif self.path == "/metrics":
+            data = (self.server.engine.metrics_text() + metrics.text()).encode("utf-8")
+            self.send_response(200)
+            self.send_header("Content-Type", "text/plain; version=0.0.4")
+            self.send_header("Content-Length", str(len(data)))
+            self.end_headers()
+            self.wfile.write(data)
+        else:
+            self._json(404, {"error": f"unknown path {self.path}"})
+
+    def do_POST(self):
+        length = int(self.headers.get("Content-Length", 0))
+        body = self.rfile.read(length) if length else b""
+        if self.path != "/generate":
+            self._json(404, {"error": f"unknown path {self.path}"})
+            return
+        try:
+            request = json.loads(body or b"{}")
+            prompt = request["prompt"]
+            # None: the engine picks the budget (adaptive, see utils.llm.resolve_budget)
+            max_new_tokens = int(request["max_new_tokens"]) if request.get("max_new_tokens") else None
+            cancel = CancelToken(float(request["timeout"]) if request.get("timeout") else None)
+            priority = request.get("priority", "interactive")
+            client = request.get("client") or self.client_address[0]
+        except (ValueError, KeyError, TypeError) as e:
+            self._json(400, {"error": f"bad request: {e}"})
+            return
+        if not self.server.admit():
+            self._json(503, {"error": "server is draining"})
+            return
+        try:
+            chunks = self.server.engine.stream(prompt, max_new_tokens, cancel, priority, client)
+            try:
+                # Admission and queueing errors surface before any reply is sent
+                first = next(chunks, None)
+            except Overloaded as e:
+                self._json(429, {"error": str(e)})
+                return
+            except QueueTimeout as e:
+                self._json(504, {"error": str(e)})
+                return
+            except Exception as e:
+                self._json(500, {"error": str(e)})
+                return
+
+            if request.get("stream"):
+                self._stream(first, chunks, cancel)
+            else:
+                try:
+                    text = (first or "") + "".join(chunks)
+                except Exception as e:
+                    self._json(500, {"error": str(e)})
+                else:
+                    self._json(200, {"response": text})
+        finally:
+            self.server.release()
+
+    def _stream(self, first, chunks, cancel):
+        self.send_response(200)
+        self.send_header("Content-Type", "application/x-ndjson")
+        self.send_header("Transfer-Encoding", "chunked")
+        self.end_headers()
+        try:
+            try:
+                if first is not None:
+                    self._chunk({"text": first})
+                for chunk in chunks:
+                    self._chunk({"text": chunk})
+                self._chunk({"done": True})
+            except (BrokenPipeError, ConnectionResetError):
+                raise
+            except Exception as e:
+                self._chunk({"error": str(e)})
+            self.wfile.write(b"0\r\n\r\n")
+        except (BrokenPipeError, ConnectionResetError):
+            # Client went away mid-stream: stop its row at the next decode step
+            cancel.cancel()
+            self.close_connection = True
+
+    def _chunk(self, obj):
+        data = (json.dumps(obj) + "\n").encode("utf-8")
+        self.wfile.write(f"{len(data):X}\r\n".encode("ascii") + data + b"\r\n")
+        self.wfile.flush()
+
+    def _json(self, code, obj):
+        data = json.dumps(obj).encode("utf-8")
+        self.send_response(code)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def log_message(self, format, *args):
+        pass  # one line per request is too chatty next to the model logs
+
+
+def main():
+    ap = argparse.ArgumentParser(description="Local inference server for the code visualizer")
+    ap.add_argument("--host", default="127.0.0.1")
+    ap.add_argument("--port", type=int, default=8765)
+    ap.add_argument("--engine", default="local", choices=sorted(ENGINES))
+    ap.add_argument("--fake-token-delay", type=float, default=0.005, help="seconds per token (fake engine)")
+    ap.add_argument("--queue-depth", type=int, default=32, help="admission queue bound (fake engine)")
+    ap.add_argument("--drain-timeout", type=float, default=120.0)
+    args = ap.parse_args()
+
+    # This process *is* the server: never forward to another one
+    os.environ.pop("LLM_SERVER_URL", None)
+    if args.engine == "fake":
+        engine = FakeEngine(args.fake_token_delay, scheduler=AdmissionQueue(max_depth=args.queue_depth))
+    else:
+        engine = LocalEngine()  # queue settings come from QUEUE_* (see utils.llm)
+    server = InferenceServer((args.host, args.port), engine)
+
+    def on_signal(signum, frame):
+        # shutdown() blocks until serve_forever returns, so drain off the main thread
+        threading.Thread(target=server.drain, args=(args.drain_timeout,), daemon=True).start()
+
+    signal.signal(signal.SIGTERM, on_signal)
+    signal.signal(signal.SIGINT, on_signal)
+    print(f"[server] {engine.name} engine listening on http://{args.host}:{args.port}")
+    server.serve_forever()
+    server.server_close()
+    print("[server] Stopped")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,33 @@
+# tests/test_scheduler.py
+import threading
+import time
+
+import pytest
+
+from utils.batcher import MicroBatcher
+from utils.scheduler import BATCH, INTERACTIVE, AdmissionQueue, QueueTimeout
+
+
+def test_queued_request_expires_while_the_model_is_busy():
+    started, release = threading.Event(), threading.Event()
+
+    def generate(prompts, max_new_tokens, sinks, cancels):
+        started.set()
+        release.wait(10)  # a long generate holding the model
+        return ["done"] * len(prompts)
+
+    scheduler = AdmissionQueue(max_wait={INTERACTIVE: 0.2, BATCH: 0.2})
+    batcher = MicroBatcher(generate, max_batch_size=1, max_wait=0, scheduler=scheduler)
+    try:
+        running = batcher.submit("first")
+        assert started.wait(5)
+        queued_at = time.perf_counter()
+        queued = batcher.submit("second")
+        with pytest.raises(QueueTimeout):
+            queued.result(timeout=2)
+        assert time.perf_counter() - queued_at < 1.0
+        assert not running.done()  # failed while the first generate was still running
+        assert scheduler.stats()["counts"]["expired:interactive"] == 1
+    finally:
+        release.set()
+    assert running.result(timeout=5) == "done"
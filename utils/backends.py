@@ -0,0 +1,225 @@
+# utils/backends.py
+"""
+Inference backends behind utils.llm.
+
+A backend knows how to turn a model path into a (tokenizer, model) pair that
+supports the transformers `generate` API; everything above it (streaming,
+batching, prefix caching, section controls) is backend-agnostic.
+
+Select one with LLM_BACKEND=gpu|cpu|tiny (default: gpu when CUDA is available,
+cpu otherwise).
+"""
+import os
+
+
+def _parse_cpu_list(spec):
+    """'0-3,6' -> {0, 1, 2, 3, 6}"""
+    cpus = set()
+    for part in spec.split(','):
+        part = part.strip()
+        if not part:
+            continue
+        if '-' in part:
+            lo, hi = part.split('-', 1)
+            cpus.update(range(int(lo), int(hi) + 1))
+        else:
+            cpus.add(int(part))
+    return cpus
+
+
+class Backend:
+    """Base class: subclasses implement load()."""
+
+    name = "base"
+
+    def load(self, model_path):
+        """Return (tokenizer, model) ready for model.generate."""
+        raise NotImplementedError
+
+    def describe(self):
+        """Short identity string; part of the response/prefix cache keys."""
+        return self.name
+
+
+class TransformersGPUBackend(Backend):
+    """bitsandbytes-quantized weights on CUDA, via model_loader.load_model."""
+
+    name = "gpu"
+
+    def __init__(self, quant_type="nf4", cache_dir=None):
+        self.quant_type = quant_type
+        self.cache_dir = cache_dir  # already-quantized weights are kept here between restarts
+        self.load_phases = {}
+
+    @classmethod
+    def from_env(cls):
+        return cls(
+            quant_type=os.environ.get("LLM_GPU_QUANT", "nf4"),
+            cache_dir=os.environ.get("LLM_QUANTIZED_CACHE_DIR", os.path.join("outputs", "cache", "quantized")) or None,
+        )
+
+    def load(self, model_path):
+        from model_loader import load_model
+        return load_model(model_path, quant_type=self.quant_type, cache_dir=self.cache_dir, phases=self.load_phases)
+
+    def describe(self):
+        return f"{self.name}-{self.quant_type}"
+
+
+class TorchCPUBackend(Backend):
+    """
+    fp32 weights on CPU with torch dynamic int8 quantization of every Linear
+    layer, and explicit intra-op/inter-op thread counts and CPU affinity.
+    """
+
+    name = "cpu"
+
+    def __init__(self, threads=None, interop_threads=None, affinity=None, quantize=True):
+        self.threads = threads
+        self.interop_threads = interop_threads
+        self.affinity = affinity
+        self.quantize = quantize
+        self.load_phases = {}
+
+    @classmethod
+    def from_env(cls):
+        threads = os.environ.get("LLM_CPU_THREADS")
+        interop = os.environ.get("LLM_CPU_INTEROP_THREADS")
+        affinity = os.environ.get("LLM_CPU_AFFINITY")
+        return cls(
+            threads=int(threads) if threads else None,
+            interop_threads=int(interop) if interop else None,
+            affinity=_parse_cpu_list(affinity) if affinity else None,
+            quantize=os.environ.get("LLM_CPU_QUANTIZE", "int8") == "int8",
+        )
+
+    def configure_threads(self):
+        import torch
+
+        if self.affinity and hasattr(os, "sched_setaffinity"):
+            os.sched_setaffinity(0, self.affinity)
+        threads = self.threads or (len(self.affinity) if self.affinity else None)
+        if threads:
+            torch.set_num_threads(threads)
+        if self.interop_threads:
+            try:
+                torch.set_num_interop_threads(self.interop_threads)
+            except RuntimeError:
+                # Only settable before the first parallel op runs in this process
+                print("[WARN] Inter-op thread count already fixed for this process")
+
+    def prepare(self, model):
+        """Put a CPU model in eval mode and (optionally) int8-quantize its Linear layers."""
+        import torch
+
+        model.eval()
+        if self.quantize:
+            model = torch.ao.quantization.quantize_dynamic(model, {torch.nn.Linear}, dtype=torch.qint8)
+        return model
+
+    def load(self, model_path):
+        import torch
+        from transformers import AutoTokenizer, AutoModelForCausalLM
+
+        from model_loader import LoadPhases
+
+        timer = LoadPhases(self.load_phases)
+        self.configure_threads()
+        print(f"[load_model] Loading {model_path} on CPU (threads={torch.get_num_threads()}) ...")
+        tokenizer = AutoTokenizer.from_pretrained(model_path)
+        timer.mark("tokenizer")
+        model = AutoModelForCausalLM.from_pretrained(model_path, torch_dtype=torch.float32)
+        timer.mark("weights")
+        model = self.prepare(model)
+        timer.mark("quantize" if self.quantize else "prepare")
+        timer.report()
+        return tokenizer, model
+
+    def describe(self):
+        return f"{self.name}-{'int8' if self.quantize else 'fp32'}"
+
+
+class TinyRandomBackend(TorchCPUBackend):
+    """
+    A tiny randomly initialised Mistral-architecture model with a byte-level
+    tokenizer, built entirely offline. Output is gibberish, but every code path
+    (streaming, batching, caches, section controls) runs end-to-end on a
+    CPU-only box in seconds. The model path is ignored.
+    """
+
+    name = "tiny"
+
+    def __init__(self, seed=0, hidden_size=64, layers=2, **kwargs):
+        super().__init__(**kwargs)
+        self.seed = seed
+        self.hidden_size = hidden_size
+        self.layers = layers
+
+    @classmethod
+    def from_env(cls):
+        backend = super().from_env()
+        backend.quantize = os.environ.get("LLM_CPU_QUANTIZE", "none") == "int8"
+        return backend
+
+    def load(self, model_path=None):
+        import torch
+        from transformers import MistralConfig, MistralForCausalLM
+
+        self.configure_threads()
+        tokenizer = build_byte_tokenizer()
+        torch.manual_seed(self.seed)
+        config = MistralConfig(
+            vocab_size=len(tokenizer),
+            hidden_size=self.hidden_size,
+            intermediate_size=self.hidden_size * 2,
+            num_hidden_layers=self.layers,
+            num_attention_heads=4,
+            num_key_value_heads=2,
+            max_position_embeddings=8192,
+            bos_token_id=tokenizer.bos_token_id,
+            eos_token_id=tokenizer.eos_token_id,
+            pad_token_id=tokenizer.pad_token_id,
+        )
+        return tokenizer, self.prepare(MistralForCausalLM(config))
+
+    def describe(self):
+        return f"{self.name}-{self.seed}-{self.hidden_size}x{self.layers}"
+
+
+def build_byte_tokenizer():
+    """Byte-level BPE tokenizer with no merges: one token per byte, plus specials."""
+    from tokenizers import Tokenizer, decoders, models, pre_tokenizers
+    from transformers import PreTrainedTokenizerFast
+
+    specials = ["<unk>", "<s>", "</s>", "<pad>"]
+    alphabet = pre_tokenizers.ByteLevel.alphabet()
+    vocab = {tok: i for i, tok in enumerate(specials + sorted(alphabet))}
+    tok = Tokenizer(models.BPE(vocab=vocab, merges=[], unk_token="<unk>"))
+    tok.pre_tokenizer = pre_tokenizers.ByteLevel(add_prefix_space=False)
+    tok.decoder = decoders.ByteLevel()
+    return PreTrainedTokenizerFast(
+        tokenizer_object=tok,
+        unk_token="<unk>", bos_token="<s>", eos_token="</s>", pad_token="<pad>",
+    )
+
+
+BACKENDS = {
+    "gpu": TransformersGPUBackend,
+    "cpu": TorchCPUBackend,
+    "tiny": TinyRandomBackend,
+}
+
+
+def get_backend(name=None):
+    """Build the backend named by `name` or LLM_BACKEND."""
+    name = (name or os.environ.get("LLM_BACKEND", "auto")).lower()
+    if name == "auto":
+        try:
+            import torch
+            name = "gpu" if torch.cuda.is_available() else "cpu"
+        except ImportError:
+            name = "cpu"
+    if name not in BACKENDS:
+        raise ValueError(f"Unknown LLM_BACKEND {name!r}; expected one of {sorted(BACKENDS)}")
+    cls = BACKENDS[name]
+    return cls.from_env() if hasattr(cls, "from_env") else cls()
@@ -0,0 +1,258 @@
+# utils/batcher.py
+import queue
+import threading
+import time
+from collections import Counter, defaultdict
+from concurrent.futures import Future
+
+from utils.scheduler import INTERACTIVE, AdmissionQueue, priority_of
+
+_DONE = object()
+
+
+class CancelToken:
+    """
+    Cooperative cancellation for one request, checked by generation between
+    decode steps. With `timeout`, the token also expires at a deadline: the
+    request then ends early and keeps what it generated so far.
+    """
+
+    def __init__(self, timeout=None):
+        self._event = threading.Event()
+        self.deadline = time.monotonic() + timeout if timeout else None
+
+    def cancel(self):
+        self._event.set()
+
+    @property
+    def cancelled(self):
+        return self._event.is_set()
+
+    @property
+    def expired(self):
+        return self.deadline is not None and time.monotonic() >= self.deadline
+
+    def stopped(self):
+        return self.cancelled or self.expired
+
+    def remaining(self):
+        """Seconds left before the deadline, or None when there is none."""
+        return max(self.deadline - time.monotonic(), 0.0) if self.deadline is not None else None
+
+
+class _Request:
+    def __init__(self, prompt, max_new_tokens, sink=None, cancel=None, priority=INTERACTIVE, client=None,
+                 limit=None):
+        self.prompt = prompt
+        self.max_new_tokens = max_new_tokens
+        self.requested_tokens = max_new_tokens  # before any degradation under load
+        self.limit = limit  # new tokens a row that uses up max_new_tokens may continue to (None: stop there)
+        self.sink = sink
+        self.cancel = cancel
+        self.priority = priority
+        self.client = client
+        self.future = Future()
+        self.enqueued_at = time.perf_counter()
+
+
+class MicroBatcher:
+    """
+    Collects generate requests that arrive within `max_wait` seconds of each other,
+    buckets them by prompt length, and runs one batched generate per bucket.
+
+    `generate_fn(prompts, max_new_tokens, sinks, cancels)` must return one text
+    per prompt; `sinks` is a list of per-row chunk callbacks (or None entries)
+    for streaming, and `cancels` the matching CancelTokens (or None entries).
+    When a request was submitted with a `limit`, generate_fn is also passed
+    `limits=[...]`: how far each row may continue past max_new_tokens.
+
+    With `max_batch_tokens`, a bucket is split so each batch's KV cache
+    (rows x (longest prompt + max_new_tokens)) stays within that many tokens.
+
+    Requests wait in `scheduler` (a utils.scheduler.AdmissionQueue by default),
+    which bounds the queue, orders it by priority and client, and may reject
+    (Overloaded) or expire (QueueTimeout) requests under load.
+    Only the worker thread ever calls `generate_fn`, so sessions never run
+    concurrent generate calls on the shared device.
+    """
+
+    def __init__(self, generate_fn, max_batch_size=4, max_wait=0.05, bucket_width=128, length_fn=len,
+                 scheduler=None, max_batch_tokens=None):
+        self.generate_fn = generate_fn
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait
+        self.bucket_width = bucket_width
+        self.length_fn = length_fn
+        self.max_batch_tokens = max_batch_tokens
+
+        self._queue = scheduler if scheduler is not None else AdmissionQueue()
+        self._lock = threading.Lock()
+        self._worker = None
+
+        # --- Stats ---
+        self._batches = 0
+        self._requests = 0
+        self._batch_sizes = Counter()
+        self._total_wait = 0.0
+        self._max_queue_depth = 0
+        self._dropped = 0
+
+    # ---------- Public API ----------
+    def submit(self, prompt, max_new_tokens=1024, sink=None, cancel=None, priority="interactive", client=None,
+               limit=None):
+        """
+        Queue a prompt; returns a Future resolving to the generated text.
+        Raises utils.scheduler.Overloaded at once when the queue is full.
+        """
+        self._ensure_worker()
+        request = _Request(prompt, max_new_tokens, sink, cancel, priority_of(priority), client, limit)
+        self._queue.put(request)
+        if request.max_new_tokens < request.requested_tokens:
+            print(f"[INFO] Queue under pressure: max_new_tokens {request.requested_tokens} -> {request.max_new_tokens}")
+        with self._lock:
+            self._max_queue_depth = max(self._max_queue_depth, self._queue.qsize())
+        return request.future
+
+    def generate(self, prompt, max_new_tokens=1024):
+        """Blocking equivalent of generate_response, routed through the batch queue."""
+        return self.submit(prompt, max_new_tokens).result()
+
+    def stream(self, prompt, max_new_tokens=1024, cancel=None, priority="interactive", client=None, limit=None):
+        """
+        Yield text chunks for one prompt while it runs inside a shared batch.
+        Closing the generator early (or an error in the consumer) cancels the
+        request, so its row stops decoding at the next step.
+        """
+        cancel = cancel or CancelToken()
+        chunks = queue.Queue()
+        future = self.submit(
+            prompt, max_new_tokens, sink=chunks.put, cancel=cancel, priority=priority, client=client, limit=limit
+        )
+        future.add_done_callback(lambda _: chunks.put(_DONE))
+        try:
+            while True:
+                chunk = chunks.get()
+                if chunk is _DONE:
+                    break
+                yield chunk
+        finally:
+            if not future.done():
+                cancel.cancel()
+        future.result()  # re-raise generation errors in the caller
+
+    def stats(self):
+        """Queue depth and batch-size statistics for tuning throughput vs latency."""
+        with self._lock:
+            requests = self._requests
+            return {
+                'queue_depth': self._queue.qsize(),
+                'max_queue_depth': self._max_queue_depth,
+                'batches': self._batches,
+                'requests': requests,
+                'mean_batch_size': requests / self._batches if self._batches else 0.0,
+                'batch_size_histogram': dict(sorted(self._batch_sizes.items())),
+                'mean_queue_wait_ms': 1000 * self._total_wait / requests if requests else 0.0,
+                'dropped_before_start': self._dropped,
+                'scheduler': self._queue.stats() if hasattr(self._queue, 'stats') else None,
+            }
+
+    def metrics_text(self):
+        """Prometheus text for the scheduler's queue metrics."""
+        return self._queue.metrics_text() if hasattr(self._queue, 'metrics_text') else ""
+
+    # ---------- Worker ----------
+    def _ensure_worker(self):
+        with self._lock:
+            if self._worker is None or not self._worker.is_alive():
+                self._worker = threading.Thread(target=self._run, name="micro-batcher", daemon=True)
+                self._worker.start()
+
+    def _collect(self):
+        """Block for one request, then gather whatever else arrives within the window."""
+        batch = [self._queue.get()]
+        deadline = time.perf_counter() + self.max_wait
+        while len(batch) < self.max_batch_size:
+            remaining = deadline - time.perf_counter()
+            if remaining <= 0:
+                break
+            try:
+                batch.append(self._queue.get(timeout=remaining))
+            except queue.Empty:
+                break
+        return batch
+
+    def _buckets(self, batch):
+        """Group requests with similar prompt length and the same token budget."""
+        buckets = defaultdict(list)
+        for request in batch:
+            length = self.length_fn(request.prompt)
+            buckets[(request.max_new_tokens, length // self.bucket_width)].append((length, request))
+        for (budget, _), entries in buckets.items():
+            yield from self._fit(entries, budget)
+
+    def _fit(self, entries, budget):
+        """Split one bucket so every batch's KV cache stays within max_batch_tokens."""
+        if not self.max_batch_tokens:
+            yield [request for _, request in entries]
+            return
+        batch, longest = [], 0
+        for length, request in entries:
+            if batch and (len(batch) + 1) * (max(longest, length) + (budget or 0)) > self.max_batch_tokens:
+                yield batch
+                batch, longest = [], 0
+            batch.append(request)
+            longest = max(longest, length)
+        yield batch
+
+    def _run(self):
+        while True:
+            batch = self._collect()
+            try:
+                # length_fn may need the model (count_tokens), so a failed load raises here
+                buckets = list(self._buckets(batch))
+            except Exception as e:
+                print(f"[WARN] Could not bucket {len(batch)} request(s): {e}")
+                for request in batch:
+                    request.future.set_exception(e)
+                continue
+            for bucket in buckets:
+                self._run_bucket(bucket)
+
+    def _run_bucket(self, bucket):
+        # Requests abandoned while queued never reach the device
+        live = []
+        for request in bucket:
+            if request.cancel is not None and request.cancel.stopped():
+                request.future.set_result("")
+            else:
+                live.append(request)
+        with self._lock:
+            self._dropped += len(bucket) - len(live)
+        if not live:
+            return
+        bucket = live
+
+        started = time.perf_counter()
+        with self._lock:
+            self._batches += 1
+            self._requests += len(bucket)
+            self._batch_sizes[len(bucket)] += 1
+            self._total_wait += sum(started - r.enqueued_at for r in bucket)
+
+        # Requests in a bucket share max_new_tokens by construction
+        extra = {"limits": [r.limit for r in bucket]} if any(r.limit for r in bucket) else {}
+        try:
+            texts = self.generate_fn(
+                [r.prompt for r in bucket],
+                bucket[0].max_new_tokens,
+                [r.sink for r in bucket],
+                [r.cancel for r in bucket],
+                **extra
+            )
+        except Exception as e:
+            for request in bucket:
+                request.future.set_exception(e)
+            return
+
+        for request, text in zip(bucket, texts):
+            request.future.set_result(text)
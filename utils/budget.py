@@ -0,0 +1,137 @@
+# utils/budget.py
+"""
+Per-request max_new_tokens, predicted from the generation layer's own history.
+
+Every finished generation is logged with its prompt template, the words of the
+user's request, the ALGORITHM the response reported, the request length and
+how many tokens the response really took. A new request gets a high
+percentile of the lengths of its most similar past requests, plus headroom,
+rounded up to one of BUDGET_CLASSES so similar requests still land in the
+same batch bucket. Until there is history, every request gets `default`.
+"""
+import json
+import math
+import os
+import re
+import threading
+from collections import deque
+
+from utils.prompts import describe_prompt
+
+# Budgets are rounded up to one of these, so requests can share a batch bucket
+BUDGET_CLASSES = (256, 384, 512, 768, 1024, 1536, 2048, 3072, 4096)
+
+_WORD = re.compile(r"[a-z0-9]+")
+_STOPWORDS = {
+    "and", "the", "for", "with", "using", "that", "from", "into", "given", "write", "implement",
+    "function", "program", "code", "return", "find", "all", "its", "this", "use",
+}
+
+
+def request_words(text):
+    return frozenset(w for w in _WORD.findall(text.lower()) if len(w) > 2 and w not in _STOPWORDS)
+
+def reported_algorithm(response):
+    """ALGORITHM from the METADATA section, lowercased, or None."""
+    match = re.search(r"^\s*ALGORITHM:\s*(.+?)\s*$", response, re.MULTILINE | re.IGNORECASE)
+    return match.group(1).lower() if match else None
+
+
+class TokenBudget:
+    """
+    Predicts max_new_tokens per prompt from logged (request, output length)
+    history. Thread-safe; history is appended to `path` (JSONL) when given.
+    """
+
+    def __init__(self, path=None, default=1024, maximum=2048, neighbours=8, quantile=0.9, headroom=1.15,
+                 max_records=5000):
+        self.path = path
+        self.default = default
+        self.maximum = maximum
+        self.neighbours = neighbours
+        self.quantile = quantile
+        self.headroom = headroom
+        self.records = deque(maxlen=max_records)
+        self.predictions = 0
+        self._lock = threading.Lock()
+        if path and os.path.exists(path):
+            self._load()
+
+    # ---------- Public API ----------
+    def predict(self, prompt):
+        """Token budget for `prompt`: one of BUDGET_CLASSES, at most `maximum`."""
+        template, user = describe_prompt(prompt)
+        words = request_words(user)
+        with self._lock:
+            self.predictions += 1
+            history = [r for r in self.records if r["template"] == template]
+        if not history:
+            return self.default
+
+        scored = sorted(((self._similarity(words, len(user), r), r) for r in history), key=lambda s: s[0], reverse=True)
+        nearest = [r for score, r in scored[:self.neighbours] if score > 0]
+        if len(nearest) < 3:
+            nearest = history[-self.neighbours * 4:]  # nothing similar yet: fall back to the template's recent requests
+        # A truncated response only tells us the answer needed more than it got
+        lengths = sorted(r["new_tokens"] * (1.5 if r["truncated"] else 1.0) for r in nearest)
+        wanted = lengths[min(len(lengths) - 1, int(self.quantile * len(lengths)))] * self.headroom
+        budget = next((c for c in BUDGET_CLASSES if c >= wanted), BUDGET_CLASSES[-1])
+        return min(budget, self.maximum)
+
+    def record(self, prompt, response, new_tokens, truncated=False):
+        """Log one finished generation (not ones that were cancelled part-way)."""
+        template, user = describe_prompt(prompt)
+        entry = {
+            "template": template,
+            "words": sorted(request_words(user)),
+            "algorithm": reported_algorithm(response),
+            "request_chars": len(user),
+            "new_tokens": int(new_tokens),
+            "truncated": bool(truncated),
+        }
+        with self._lock:
+            self.records.append(dict(entry, words=frozenset(entry["words"])))
+            if not self.path:
+                return
+            try:
+                os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+                with open(self.path, "a", encoding="utf-8") as f:
+                    f.write(json.dumps(entry) + "\n")
+            except OSError as e:
+                print(f"[WARN] Could not log token budget history: {e}")
+
+    def stats(self):
+        with self._lock:
+            records = list(self.records)
+            predictions = self.predictions
+        lengths = sorted(r["new_tokens"] for r in records)
+        return {
+            "records": len(records),
+            "predictions": predictions,
+            "truncated": sum(r["truncated"] for r in records),
+            "median_new_tokens": lengths[len(lengths) // 2] if lengths else None,
+        }
+
+    # ---------- Internals ----------
+    @staticmethod
+    def _similarity(words, chars, record):
+        """Word overlap with the past request, plus its reported ALGORITHM, minus a length mismatch."""
+        union = words | record["words"]
+        score = len(words & record["words"]) / len(union) if union else 0.0
+        if record["algorithm"] and request_words(record["algorithm"]) & words:
+            score += 0.5
+        return score - 0.1 * abs(math.log((chars + 1) / (record["request_chars"] + 1)))
+
+    def _load(self):
+        try:
+            with open(self.path, encoding="utf-8") as f:
+                for line in f:
+                    try:
+                        entry = json.loads(line)
+                    except ValueError:
+                        continue  # a line cut short by a crash
+                    self.records.append(dict(entry, words=frozenset(entry["words"])))
+        except OSError as e:
+            print(f"[WARN] Could not read token budget history {self.path}: {e}")
+        else:
+            print(f"[INFO] Loaded {len(self.records)} token budget records from {self.path}")
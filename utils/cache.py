@@ -0,0 +1,141 @@
+# utils/cache.py
+import hashlib
+import json
+import os
+import re
+import sqlite3
+import threading
+import time
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS responses (
+    key       TEXT PRIMARY KEY,
+    response  TEXT NOT NULL,
+    sections  TEXT,
+    size      INTEGER NOT NULL,
+    created   REAL NOT NULL,
+    last_used REAL NOT NULL
+)
+"""
+
+
+def normalize_prompt(prompt):
+    """
+    Whitespace-insensitive form of a prompt, so reflowed text still hits.
+    Case is kept: "reverse 'ABC'" and "reverse 'abc'" need different code.
+    """
+    return re.sub(r'\s+', ' ', prompt).strip()
+
+
+def fingerprint_files(path):
+    """
+    Cheap fingerprint of a model/adapter directory: names, sizes and mtimes of
+    its weight and config files. Changes whenever the weights are replaced.
+    """
+    h = hashlib.sha256(str(path).encode("utf-8"))
+    if os.path.isdir(path):
+        for name in sorted(os.listdir(path)):
+            if name.endswith((".json", ".safetensors", ".bin", ".gguf", ".model")):
+                st = os.stat(os.path.join(path, name))
+                h.update(f"{name}:{st.st_size}:{int(st.st_mtime)}".encode("utf-8"))
+    return h.hexdigest()[:16]
+
+
+class ResponseCache:
+    """
+    On-disk (SQLite) cache of raw model responses and, optionally, their parsed
+    sections. Entries older than `max_age` seconds are dropped, and the least
+    recently used entries are evicted once the stored text exceeds `max_bytes`.
+    """
+
+    def __init__(self, path, max_bytes=256 * 1024 * 1024, max_age=30 * 24 * 3600):
+        self.path = path
+        self.max_bytes = max_bytes
+        self.max_age = max_age
+        self.hits = 0
+        self.misses = 0
+        self._conn = None
+        self._lock = threading.Lock()
+
+    # ---------- Keys ----------
+    @staticmethod
+    def make_key(prompt, params, fingerprint):
+        payload = json.dumps(
+            {"prompt": normalize_prompt(prompt), "params": params, "model": fingerprint},
+            sort_keys=True
+        )
+        return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+    # ---------- Public API ----------
+    def get(self, key):
+        """Return {'response': str, 'sections': dict | None} or None on a miss."""
+        now = time.time()
+        with self._lock:
+            row = self._db().execute(
+                "SELECT response, sections, created FROM responses WHERE key = ?", (key,)
+            ).fetchone()
+            if row is None or now - row[2] > self.max_age:
+                self.misses += 1
+                return None
+            self._db().execute("UPDATE responses SET last_used = ? WHERE key = ?", (now, key))
+            self._db().commit()
+            self.hits += 1
+        response, sections, _ = row
+        return {"response": response, "sections": json.loads(sections) if sections else None}
+
+    def put(self, key, response, sections=None):
+        now = time.time()
+        blob = json.dumps(sections) if sections is not None else None
+        size = len(response.encode("utf-8")) + (len(blob) if blob else 0)
+        with self._lock:
+            db = self._db()
+            db.execute(
+                "INSERT OR REPLACE INTO responses VALUES (?, ?, ?, ?, ?, ?)",
+                (key, response, blob, size, now, now)
+            )
+            self._evict(db, now)
+            db.commit()
+
+    def stats(self):
+        with self._lock:
+            entries, size = self._db().execute(
+                "SELECT COUNT(*), COALESCE(SUM(size), 0) FROM responses"
+            ).fetchone()
+        lookups = self.hits + self.misses
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / lookups if lookups else 0.0,
+            "entries": entries,
+            "bytes": size,
+        }
+
+    def clear(self):
+        with self._lock:
+            self._db().execute("DELETE FROM responses")
+            self._db().commit()
+
+    # ---------- Internals ----------
+    def _db(self):
+        if self._conn is None:
+            directory = os.path.dirname(self.path)
+            if directory:
+                os.makedirs(directory, exist_ok=True)
+            self._conn = sqlite3.connect(self.path, check_same_thread=False)
+            self._conn.execute(_SCHEMA)
+            self._conn.execute("CREATE INDEX IF NOT EXISTS responses_lru ON responses (last_used)")
+        return self._conn
+
+    def _evict(self, db, now):
+        db.execute("DELETE FROM responses WHERE created < ?", (now - self.max_age,))
+        total = db.execute("SELECT COALESCE(SUM(size), 0) FROM responses").fetchone()[0]
+        if total <= self.max_bytes:
+            return
+        # Walk from least to most recently used until we are back under budget
+        doomed = []
+        for key, size in db.execute("SELECT key, size FROM responses ORDER BY last_used ASC"):
+            if total <= self.max_bytes:
+                break
+            doomed.append((key,))
+            total -= size
+        db.executemany("DELETE FROM responses WHERE key = ?", doomed)
@@ -0,0 +1,144 @@
+# utils/client.py
+"""
+Pooled HTTP client for server.py. utils.llm routes generate_response and
+stream_response here when LLM_SERVER_URL is set.
+"""
+import http.client
+import json
+import queue
+from urllib.parse import urlsplit
+
+from utils.scheduler import Overloaded, QueueTimeout
+
+
+class ServerError(RuntimeError):
+    """The inference server refused or failed a request."""
+
+
+def _error(status, body):
+    """Map an error reply to the exception the in-process path would raise."""
+    message = body.get("error", f"HTTP {status}")
+    if status == 429:
+        return Overloaded(message)
+    if status == 504:
+        return QueueTimeout(message)
+    return ServerError(message)
+
+
+class InferenceClient:
+    """
+    Thread-safe client that keeps up to `pool_size` keep-alive connections to
+    the server, so requests skip the TCP handshake.
+    """
+
+    def __init__(self, url, pool_size=4, timeout=600):
+        parts = urlsplit(url)
+        self.host = parts.hostname or "127.0.0.1"
+        self.port = parts.port or 80
+        self.timeout = timeout
+        self._pool = queue.LifoQueue(maxsize=pool_size)
+
+    # ---------- Public API ----------
+    def health(self):
+        return self._get_json("/healthz")
+
+    def ready(self):
+        """True once the server has its model loaded and is accepting work."""
+        try:
+            return self._get_json("/readyz").get("ready", False)
+        except (OSError, ServerError):
+            return False
+
+    def status(self):
+        """Server readiness report, or {'status': 'unreachable'}."""
+        try:
+            return self._get_json("/readyz", allow_error=True)
+        except OSError as e:
+            return {"ready": False, "status": "unreachable", "error": str(e)}
+
+    def stats(self):
+        return self._get_json("/stats")
+
+    def generate(self, prompt, max_new_tokens=None):
+        conn, resp = self._request("POST", "/generate", {"prompt": prompt, "max_new_tokens": max_new_tokens})
+        body = json.loads(resp.read() or b"{}")
+        self._release(conn)
+        if resp.status != 200:
+            raise _error(resp.status, body)
+        return body["response"]
+
+    def stream(self, prompt, max_new_tokens=None, timeout=None, priority="interactive", client=None):
+        """
+        Yield text chunks as the server produces them. With `timeout` the server
+        stops generating at that deadline and the stream ends early. Closing
+        the generator early drops the connection, which cancels the request.
+        """
+        payload = {"prompt": prompt, "max_new_tokens": max_new_tokens, "stream": True, "priority": priority}
+        if timeout is not None:
+            payload["timeout"] = timeout
+        if client is not None:
+            payload["client"] = client
+        conn, resp = self._request("POST", "/generate", payload)
+        if resp.status != 200:
+            body = json.loads(resp.read() or b"{}")
+            self._release(conn)
+            raise _error(resp.status, body)
+
+        finished = False
+        try:
+            for line in iter(resp.readline, b""):
+                event = json.loads(line)
+                if "text" in event:
+                    yield event["text"]
+                elif "error" in event:
+                    raise ServerError(event["error"])
+                elif event.get("done"):
+                    break
+            resp.read()  # consume the terminating chunk so the connection can be reused
+            finished = True
+        finally:
+            # A stream abandoned half-way leaves unread data on the socket
+            if finished:
+                self._release(conn)
+            else:
+                conn.close()
+
+    # ---------- Internals ----------
+    def _get_json(self, path, allow_error=False):
+        conn, resp = self._request("GET", path)
+        body = json.loads(resp.read() or b"{}")
+        self._release(conn)
+        if resp.status != 200 and not allow_error:
+            raise ServerError(body.get("error", f"HTTP {resp.status}"))
+        return body
+
+    def _request(self, method, path, payload=None):
+        body = json.dumps(payload).encode("utf-8") if payload is not None else None
+        headers = {"Content-Type": "application/json"} if body else {}
+        for attempt in range(2):
+            conn, pooled = self._acquire(fresh=attempt > 0)
+            try:
+                conn.request(method, path, body=body, headers=headers)
+                return conn, conn.getresponse()
+            except (http.client.RemoteDisconnected, BrokenPipeError, ConnectionResetError):
+                conn.close()
+                # A pooled keep-alive connection may have been closed by the server; retry once fresh
+                if not pooled or attempt:
+                    raise
+            except Exception:
+                conn.close()
+                raise
+
+    def _acquire(self, fresh=False):
+        if not fresh:
+            try:
+                return self._pool.get_nowait(), True
+            except queue.Empty:
+                pass
+        return http.client.HTTPConnection(self.host, self.port, timeout=self.timeout), False
+
+    def _release(self, conn):
+        try:
+            self._pool.put_nowait(conn)
+        except queue.Full:
+            conn.close()
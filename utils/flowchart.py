@@ -0,0 +1,324 @@
+# utils/flowchart.py
+"""
+Deterministic flowcharts for Python code, built from its AST instead of
+being generated by the model.
+
+python_flowchart() walks the control flow of sections['code'] and returns
+Mermaid in the utils.mermaid IR: if/elif/else and match become decisions,
+for/while loops get back edges plus break/continue/else paths, try blocks
+branch to their except handlers, and return/raise lead to the End of their
+function. A jump out of a try block runs its finally block first. Every function (and method) is its own subgraph;
+module-level statements form the main flow.
+
+With AST_FLOWCHART=1 the prompts in utils.prompts leave out the
+VISUALIZATION section, so the model spends no decode tokens on it, and
+utils.parser fills the section in from the code.
+"""
+import ast
+import os
+import re
+from functools import lru_cache
+
+from utils.mermaid import Graph, IdAllocator, Subgraph, clean_label
+
+AST_FLOWCHART = os.environ.get("AST_FLOWCHART", "0").lower() in ("1", "true", "yes")
+FLOWCHART_LABEL_CHARS = 48  # longer statement labels are cut with "..."
+
+PYTHON_LANGUAGES = ("python", "python3", "py")
+
+TERMINAL = ("([", "])")
+PROCESS = ("[", "]")
+DECISION = ("{", "}")
+BLOCK = ("{{", "}}")  # try / with
+
+_FUNCTIONS = (ast.FunctionDef, ast.AsyncFunctionDef)
+_SKIPPED = (ast.Import, ast.ImportFrom, ast.Pass, ast.Global, ast.Nonlocal)
+_COMMENT = re.compile(r"%(?=%)")  # %% would start a Mermaid comment
+
+
+# ---------- Helpers ----------
+def _short(text):
+    text = _COMMENT.sub("% ", clean_label(text)).replace("`", "'")  # ``` would read as a fence
+    if len(text) > FLOWCHART_LABEL_CHARS:
+        text = text[:FLOWCHART_LABEL_CHARS - 3].rstrip() + "..."
+    return text
+
+def _source(node):
+    try:
+        return ast.unparse(node)
+    except Exception:
+        return type(node).__name__
+
+def _is_docstring(stmt):
+    return isinstance(stmt, ast.Expr) and isinstance(stmt.value, ast.Constant) and isinstance(stmt.value.value, str)
+
+def _always_true(test):
+    return isinstance(test, ast.Constant) and bool(test.value)
+
+def _handler_label(handler):
+    if handler.type is None:
+        return "except"
+    return f"except {_source(handler.type)}" + (f" as {handler.name}" if handler.name else "")
+
+def _statement_label(stmt):
+    """One line for a simple statement: the code itself, without bodies."""
+    if isinstance(stmt, ast.Return):
+        return "return " + _source(stmt.value) if stmt.value is not None else "return"
+    return _source(stmt).split("\n", 1)[0]
+
+
+class _Frame:
+    """Where jumps go inside the function being built."""
+
+    def __init__(self, end):
+        self.end = end         # the function's End node
+        self.loops = []        # (header id, break exits, finally depth) for each enclosing loop
+        self.handlers = []     # (except-handler node ids, finally depth) for each enclosing try
+        self.finals = []       # {jump kind: exits} waiting for each enclosing finally
+
+
+# ---------- CFG builder ----------
+class _Builder:
+    """
+    Builds the graph one block at a time. A block takes the exits that lead
+    into it, as (node id, edge label) pairs, and returns the exits leaving it;
+    an empty list means control never falls through (return, raise, break).
+    """
+
+    def __init__(self):
+        self.graph = Graph("TD")
+        self.ids = IdAllocator()
+        self.subgraph = None
+        self.frame = None
+
+    def node(self, kind, label, shape=PROCESS):
+        id = self.ids.take(kind)
+        self.graph.add_node(id, _short(label), shape, self.subgraph)
+        return id
+
+    def link(self, exits, target):
+        for source, label in exits:
+            self.graph.add_edge(source, target, label=label)
+
+    def step(self, exits, kind, label, shape=PROCESS):
+        """A node reached from `exits`; returns its single exit."""
+        id = self.node(kind, label, shape)
+        self.link(exits, id)
+        return [(id, None)]
+
+    def flow(self, title, body, entry, subgraph=None):
+        """A Start -> body -> End flow, inside `subgraph` when given."""
+        self.subgraph = subgraph
+        start = self.node("start", entry, TERMINAL)
+        self.frame = _Frame(self.ids.take("end"))
+        exits = self.block(body, [(start, None)])
+        self.graph.add_node(self.frame.end, "End" if subgraph is None else f"End {title}", TERMINAL, subgraph)
+        self.link(exits, self.frame.end)
+
+    def block(self, stmts, exits):
+        simple = []
+        for stmt in stmts:
+            if not exits:
+                break  # unreachable code after return/raise/break/continue
+            if isinstance(stmt, _SKIPPED) or _is_docstring(stmt):
+                continue
+            handler = getattr(self, "_" + type(stmt).__name__.lower(), None)
+            if handler is None:
+                simple.append(_statement_label(stmt))
+                continue
+            if simple:
+                exits = self.step(exits, "step", "; ".join(simple))
+                simple = []
+            exits = handler(stmt, exits)
+        if simple and exits:
+            exits = self.step(exits, "step", "; ".join(simple))
+        return exits
+
+    # --- definitions: drawn as their own flows, not as steps ---
+    def _functiondef(self, stmt, exits):
+        return exits
+
+    _asyncfunctiondef = _functiondef
+    _classdef = _functiondef
+
+    # --- branches ---
+    def _if(self, stmt, exits):
+        test = self.node("if", _source(stmt.test) + "?", DECISION)
+        self.link(exits, test)
+        out = self.block(stmt.body, [(test, "Yes")])
+        if stmt.orelse:
+            return out + self.block(stmt.orelse, [(test, "No")])
+        return out + [(test, "No")]
+
+    def _match(self, stmt, exits):
+        subject = self.node("match", "match " + _source(stmt.subject), DECISION)
+        self.link(exits, subject)
+        out, exhaustive = [], False
+        for case in stmt.cases:
+            pattern = _source(case.pattern)
+            if case.guard is not None:
+                pattern += " if " + _source(case.guard)
+            # "|" would end the edge label; in a pattern it means "or"
+            out += self.block(case.body, [(subject, _short(pattern.replace(" | ", " or ").replace("|", "/")))])
+            exhaustive = exhaustive or (isinstance(case.pattern, ast.MatchAs) and case.pattern.pattern is None
+                                        and case.guard is None)
+        return out if exhaustive else out + [(subject, "no match")]
+
+    # --- loops ---
+    def _loop(self, exits, label, body, orelse, enter, done):
+        header = self.node("loop", label, DECISION)
+        self.link(exits, header)
+        breaks = []
+        self.frame.loops.append((header, breaks, len(self.frame.finals)))
+        self.link(self.block(body, [(header, enter)]), header)
+        self.frame.loops.pop()
+        out = [] if done is None else [(header, done)]
+        if orelse and out:
+            out = self.block(orelse, out)
+        return out + breaks
+
+    def _for(self, stmt, exits):
+        label = f"for {_source(stmt.target)} in {_source(stmt.iter)}"
+        return self._loop(exits, label, stmt.body, stmt.orelse, "next", "done")
+
+    _asyncfor = _for
+
+    def _while(self, stmt, exits):
+        done = None if _always_true(stmt.test) else "No"
+        return self._loop(exits, f"while {_source(stmt.test)}?", stmt.body, stmt.orelse, "Yes", done)
+
+    def _break(self, stmt, exits):
+        self.jump("break", exits)
+        return []
+
+    def _continue(self, stmt, exits):
+        self.jump("continue", exits)
+        return []
+
+    # --- exits ---
+    def _return(self, stmt, exits):
+        self.jump("return", self.step(exits, "return", _statement_label(stmt), TERMINAL))
+        return []
+
+    def _raise(self, stmt, exits):
+        self.jump("raise", self.step(exits, "raise", _statement_label(stmt)))
+        return []
+
+    def jump(self, kind, exits):
+        """
+        Send a return / raise / break / continue on to its target. A finally
+        block between the jump and its target runs first: the exits wait in
+        frame.finals until _try draws that block for them.
+        """
+        frame = self.frame
+        handlers, depth = next(((h, d) for h, d in reversed(frame.handlers) if h), ((), 0))
+        if kind in ("break", "continue"):
+            if not frame.loops:
+                return  # outside a loop: a SyntaxError once compiled
+            header, breaks, depth = frame.loops[-1]
+        elif kind == "return":
+            depth = 0
+        if len(frame.finals) > depth:
+            frame.finals[-1].setdefault(kind, []).extend(exits)
+        elif kind == "break":
+            breaks.extend(exits)
+        elif kind == "continue":
+            self.link(exits, header)
+        elif kind == "raise" and handlers:
+            for handler in handlers:
+                self.link(exits, handler)
+        elif kind == "raise":
+            self.link([(source, label or "error") for source, label in exits], frame.end)
+        else:
+            self.link(exits, frame.end)
+
+    # --- blocks ---
+    def _try(self, stmt, exits):
+        entry = self.node("try", "try", BLOCK)
+        self.link(exits, entry)
+        handlers = [self.node("except", _handler_label(h)) for h in stmt.handlers]
+        jumps = {}
+        if stmt.finalbody:
+            self.frame.finals.append(jumps)
+        self.frame.handlers.append((handlers, len(self.frame.finals)))
+        out = self.block(stmt.body, [(entry, None)])
+        self.frame.handlers.pop()
+        for handler in handlers:
+            self.graph.add_edge(entry, handler, arrow="-.->", label="raises")
+        if stmt.orelse:
+            out = self.block(stmt.orelse, out)
+        for h, handler in zip(stmt.handlers, handlers):
+            out += self.block(h.body, [(handler, None)])
+        if stmt.finalbody:
+            self.frame.finals.pop()
+            for kind, jumped in jumps.items():
+                # Each kind of jump gets its own copy of the finally block, then carries on
+                self.jump(kind, self.block(stmt.finalbody, jumped))
+            out = self.block(stmt.finalbody, out) if out else []
+        return out
+
+    _trystar = _try
+
+    def _with(self, stmt, exits):
+        label = "with " + ", ".join(_source(item) for item in stmt.items)
+        return self.block(stmt.body, self.step(exits, "with", label, BLOCK))
+
+    _asyncwith = _with
+
+
+def _bodies(stmt):
+    """Every statement list nested in a compound statement: body, else, handlers, finally, cases."""
+    bodies = [getattr(stmt, field, None) or [] for field in ("body", "orelse", "finalbody")]
+    bodies += [handler.body for handler in getattr(stmt, "handlers", ())]
+    bodies += [case.body for case in getattr(stmt, "cases", ())]
+    return bodies
+
+def _functions(stmts, prefix=""):
+    """(qualified name, def node) for every function and method, outermost first."""
+    found = []
+    for stmt in stmts:
+        if isinstance(stmt, _FUNCTIONS):
+            name = prefix + stmt.name
+            found.append((name, stmt))
+            found += _functions(stmt.body, name + ".")
+        elif isinstance(stmt, ast.ClassDef):
+            found += _functions(stmt.body, prefix + stmt.name + ".")
+        else:
+            # e.g. defs under `if TYPE_CHECKING:` or `except ImportError:`
+            for body in _bodies(stmt):
+                found += _functions(body, prefix)
+    return found
+
+
+# ---------- Public API ----------
+@lru_cache(maxsize=64)
+def python_flowchart(code):
+    """
+    Mermaid flowchart of the control flow in Python `code`, or None when it
+    does not parse (e.g. the model answered in another language).
+    """
+    if not code or not code.strip():
+        return None
+    try:
+        tree = ast.parse(code)
+    except (SyntaxError, ValueError):
+        return None
+
+    builder = _Builder()
+    for name, func in _functions(tree.body):
+        sid = builder.ids.take("fn_" + name.replace(".", "_"))
+        builder.graph.subgraphs[sid] = Subgraph(sid, _short(f"def {name}"))
+        args = ", ".join(arg.arg for arg in func.args.args)
+        builder.flow(name, func.body, f"{name}({args})", sid)
+    module = [stmt for stmt in tree.body if not isinstance(stmt, _FUNCTIONS + (ast.ClassDef,) + _SKIPPED)
+              and not _is_docstring(stmt)]
+    if module or not builder.graph.nodes:
+        builder.flow("main", module, "Start")
+    return builder.graph.to_mermaid()
+
+
+def code_flowchart(code, language=None):
+    """python_flowchart for code the metadata says is Python (or that has no language)."""
+    if language and language.lower() not in PYTHON_LANGUAGES:
+        return None
+    return python_flowchart(code)
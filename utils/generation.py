@@ -0,0 +1,408 @@
+# utils/generation.py
+"""
+Logits processors and stopping criteria shared by the utils.llm entry points.
+Imported lazily by utils.llm, since it pulls in torch and transformers.
+"""
+import os
+import time
+
+import torch
+from transformers import LogitsProcessor, LogitsProcessorList, StoppingCriteria, StoppingCriteriaList
+
+from utils.flowchart import AST_FLOWCHART
+from utils.grammar import BODY_START, LINE_START, mermaid_run, vocab_grammar
+from utils.parser import SECTIONS, TEST_END
+
+# Max tokens a section may run before its end marker is forced (0 = no cap).
+# SECTION_TOKEN_BUDGETS overrides them: "code=2048,visualization=0", or "off" for none.
+# ANNOTATED re-prints the whole program and TEST CASES ends the response, so
+# both are left to max_new_tokens: a fixed cap would cut them on long code.
+DEFAULT_SECTION_TOKEN_BUDGETS = {
+    'metadata': 64,
+    'code': 1024,
+    'visualization': 256,
+    'complexity': 64,
+}
+
+_SECTION_KEYS = {key for key, _, _ in SECTIONS}
+
+def _section_budgets(spec):
+    if spec.strip().lower() in ("off", "none", "0"):
+        return {}
+    budgets = dict(DEFAULT_SECTION_TOKEN_BUDGETS)
+    for item in filter(None, (part.strip() for part in spec.split(","))):
+        key, _, value = item.partition("=")
+        key = key.strip().lower()
+        if key not in _SECTION_KEYS or not value.strip().isdigit():
+            print(f"[WARN] Ignoring SECTION_TOKEN_BUDGETS entry {item!r}")
+            continue
+        budgets[key] = int(value)
+    return {key: value for key, value in budgets.items() if value > 0}
+
+SECTION_TOKEN_BUDGETS = _section_budgets(os.environ.get("SECTION_TOKEN_BUDGETS", ""))
+
+# Sections whose body sits inside a ``` fence that must be closed first
+_FENCED = {'code', 'visualization'}
+
+# Sections the prompt leaves out, so constrained mode must not open them
+_UNPROMPTED = {'visualization'} if AST_FLOWCHART else set()
+
+
+class _RowState:
+    def __init__(self):
+        self.line = []       # token ids of the current (unfinished) output line
+        self.section = None  # key of the section currently open, if any
+        self.count = 0       # tokens spent inside the open section
+        self.forced = ()     # token ids still to emit (closing a runaway section, or grammar)
+        self.done = False    # final end marker seen
+        self.expect = 0      # index into SECTIONS of the next section to open
+        self.fence_open = False  # inside a ``` fence in the open section
+        self.dfa = None      # Mermaid DFA state while in VISUALIZATION (constrained mode)
+        self.spent = {}      # section key -> tokens generated inside it (telemetry)
+
+    def copy(self):
+        clone = _RowState()
+        clone.line = list(self.line)
+        clone.section, clone.count, clone.forced, clone.done = self.section, self.count, self.forced, self.done
+        clone.expect, clone.fence_open, clone.dfa = self.expect, self.fence_open, self.dfa
+        clone.spent = dict(self.spent)
+        return clone
+
+
+class SectionTracker:
+    """
+    Follows the ===SECTION=== structure of each generated row, line by line.
+    Shared by SectionBudgetProcessor and StopOnFinalMarker so every new token
+    is decoded exactly once per row.
+
+    Assisted/speculative decoding calls the processors on candidate tokens that
+    may later be rejected, so the tracker keeps a short window of per-position
+    snapshots and rolls back whenever the sequence it is shown diverges.
+    """
+
+    SNAPSHOT_WINDOW = 128
+
+    def __init__(self, tokenizer, batch_size, budgets=None, final_marker=TEST_END, constrained=False,
+                 open_sections=None):
+        self.tokenizer = tokenizer
+        self.budgets = SECTION_TOKEN_BUDGETS if budgets is None else budgets
+        # One marker for every row, or one per row (section fan-out)
+        markers = [final_marker] * batch_size if isinstance(final_marker, str) else final_marker
+        self.final_markers = [m.upper() for m in markers]
+        self.rows = [_RowState() for _ in range(batch_size)]
+        self.prompt_len = None
+        self.tokens = []     # processed token columns, one list per generated position
+        self.snapshots = {}  # position -> row states before that position was processed
+        self._closers = {}
+        # Constrained mode: sections are opened by force, in order, and the
+        # VISUALIZATION body is held to the Mermaid subset in utils.grammar
+        self.grammar = vocab_grammar(tokenizer) if constrained else None
+        # Rows whose prompt already ends with a section's start marker
+        starts = {key: start for key, start, _ in SECTIONS}
+        for row, key in zip(self.rows, open_sections or ()):
+            if key:
+                self._on_line(row, starts[key])
+
+    @property
+    def seen(self):
+        return self.prompt_len + len(self.tokens)
+
+    def update(self, input_ids):
+        if self.prompt_len is None:
+            self.prompt_len = input_ids.shape[1]  # everything before this is prompt
+            if self.grammar:
+                for row in self.rows:
+                    # Rows resumed mid-response (resume_controls) already opened sections
+                    if row.section is None and row.expect == 0:
+                        row.forced = self._opener(0)
+        length = input_ids.shape[1]
+
+        # Roll back over any tail that no longer matches what we processed
+        check_from = max(self.prompt_len, min(self.seen, length) - self.SNAPSHOT_WINDOW)
+        recent = input_ids[:, check_from:min(self.seen, length)].T.tolist()
+        diverge = min(self.seen, length)
+        for offset, column in enumerate(recent):
+            if column != self.tokens[check_from - self.prompt_len + offset]:
+                diverge = check_from + offset
+                break
+        if diverge < self.seen:
+            self._rollback(diverge)
+
+        for pos in range(self.seen, length):
+            column = input_ids[:, pos].tolist()
+            self.snapshots[pos] = [row.copy() for row in self.rows]
+            self.snapshots.pop(pos - self.SNAPSHOT_WINDOW, None)
+            for row, marker, token in zip(self.rows, self.final_markers, column):
+                self._advance(row, token, marker)
+            self.tokens.append(column)
+
+    def _rollback(self, pos):
+        self.rows = self.snapshots[pos]
+        del self.tokens[pos - self.prompt_len:]
+        for stale in [p for p in self.snapshots if p >= pos]:
+            del self.snapshots[stale]
+
+    def _advance(self, row, token, final_marker):
+        if row.done:
+            return
+        if row.forced and token == row.forced[0]:
+            row.forced = row.forced[1:]
+        row.line.append(token)
+        if row.section is not None:
+            row.count += 1
+            row.spent[row.section] = row.spent.get(row.section, 0) + 1
+        if self.grammar and row.section == 'visualization':
+            row.dfa = self._advance_dfa(row.dfa, token)
+
+        text = self.tokenizer.decode(row.line, skip_special_tokens=True)
+        if final_marker in text.upper():
+            row.done = True
+            return
+        if '\n' in text:
+            for line in text.split('\n')[:-1]:
+                self._on_line(row, line.strip())
+            row.line = []
+            if self.grammar and row.section is None and not row.forced and row.expect < len(SECTIONS):
+                row.forced = self._opener(row.expect)
+
+        if row.section is not None and not row.forced and row.count >= self.budgets.get(row.section, float('inf')):
+            # The section is cut short; say so rather than hand back a silently truncated answer
+            print(f"[WARN] {row.section} section hit its {row.count}-token budget and was truncated "
+                  f"(raise it with SECTION_TOKEN_BUDGETS={row.section}=N)")
+            row.forced = tuple(self._closer(row.section))
+            row.section = None
+
+    def _on_line(self, row, line):
+        upper = line.upper()
+        for index, (key, start, end) in enumerate(SECTIONS):
+            if end.upper() in upper:
+                row.section = None
+                return
+            if start.upper() in upper:
+                row.section = key
+                row.count = 0
+                row.expect = index + 1
+                while row.expect < len(SECTIONS) and SECTIONS[row.expect][0] in _UNPROMPTED:
+                    row.expect += 1
+                row.fence_open = False
+                row.dfa = LINE_START if key == 'visualization' else None
+                return
+        if row.section is not None and line.startswith("```"):
+            row.fence_open = not row.fence_open
+
+    def _advance_dfa(self, state, token):
+        text = self.grammar.texts[token] if token < self.grammar.vocab_size else None
+        if text is None:
+            return None
+        if state is not None:
+            state = mermaid_run(state, text)
+        if state is None and '\n' in text:
+            # Recover at the next line, e.g. after a forced end marker
+            state = mermaid_run(BODY_START, text.rsplit('\n', 1)[1])
+        return state
+
+    def _opener(self, index):
+        """Token ids that open section SECTIONS[index] (constrained mode)."""
+        key = ('open', index)
+        if key not in self._closers:
+            self._closers[key] = self.tokenizer(SECTIONS[index][1] + "\n", add_special_tokens=False).input_ids
+        return tuple(self._closers[key])
+
+    def end_line(self, row):
+        """Token ids that end the open section from the start of a line (constrained mode)."""
+        end = next(end for k, _, end in SECTIONS if k == row.section)
+        text = ("```\n" if row.fence_open else "") + end + "\n"
+        key = ('end', text)
+        if key not in self._closers:
+            self._closers[key] = self.tokenizer(text, add_special_tokens=False).input_ids
+        return tuple(self._closers[key])
+
+    def _closer(self, key):
+        """Token ids that close section `key` (fence first, when it has one)."""
+        if key not in self._closers:
+            end = next(end for k, _, end in SECTIONS if k == key)
+            text = ("\n```\n" if key in _FENCED else "\n") + end + "\n"
+            self._closers[key] = self.tokenizer(text, add_special_tokens=False).input_ids
+        return self._closers[key]
+
+
+class SectionBudgetProcessor(LogitsProcessor):
+    """Forces a section's end marker once it exceeds its token budget."""
+
+    def __init__(self, tracker):
+        self.tracker = tracker
+
+    def __call__(self, input_ids, scores):
+        self.tracker.update(input_ids)
+        for i, row in enumerate(self.tracker.rows):
+            if row.forced and not row.done:
+                token = row.forced[0]
+                scores[i, :] = -float('inf')
+                scores[i, token] = 0.0
+        return scores
+
+
+class SectionGrammarProcessor(LogitsProcessor):
+    """
+    Constrained decoding: keeps every row inside the section grammar.
+    Sections are opened in order by the tracker; inside a section a line may
+    only start with '=' by ending that section (the model's preference between
+    the end marker and more content is read off the scores), EOS is masked
+    until the final marker, and VISUALIZATION tokens must keep the Mermaid DFA
+    alive.
+    """
+
+    def __init__(self, tracker, eos_token_id=None):
+        self.tracker = tracker
+        self.grammar = tracker.grammar
+        self.eos_token_id = eos_token_id
+
+    def __call__(self, input_ids, scores):
+        self.tracker.update(input_ids)
+        equals = self.grammar.equals_ids
+        for i, row in enumerate(self.tracker.rows):
+            if row.done or row.forced or row.section is None:
+                continue
+            if self.eos_token_id is not None:
+                scores[i, self.eos_token_id] = -float('inf')
+
+            if not row.line:  # at the start of a line
+                best_equals = scores[i, equals].max()
+                others = scores[i].clone()
+                others[equals] = -float('inf')
+                if best_equals > others.max():
+                    row.forced = self.tracker.end_line(row)
+                    scores[i, :] = -float('inf')
+                    scores[i, row.forced[0]] = 0.0
+                    continue
+                scores[i, equals] = -float('inf')
+
+            if row.section == 'visualization' and row.dfa is not None:
+                allowed = self.grammar.allowed_mask(row.dfa, scores.device)
+                scores[i] = scores[i].masked_fill(~allowed, -float('inf'))
+        return scores
+
+
+class StopOnFinalMarker(StoppingCriteria):
+    """Ends a row as soon as its final marker (by default ===END TEST CASES===) has been generated."""
+
+    def __init__(self, tracker):
+        self.tracker = tracker
+
+    def __call__(self, input_ids, scores, **kwargs):
+        self.tracker.update(input_ids)
+        return torch.tensor([row.done for row in self.tracker.rows], dtype=torch.bool, device=input_ids.device)
+
+
+class StopOnCancel(StoppingCriteria):
+    """Ends each row whose CancelToken (utils.batcher) was cancelled or ran past its deadline."""
+
+    def __init__(self, cancels):
+        self.cancels = cancels
+
+    def __call__(self, input_ids, scores, **kwargs):
+        stopped = [cancel is not None and cancel.stopped() for cancel in self.cancels]
+        return torch.tensor(stopped, dtype=torch.bool, device=input_ids.device)
+
+
+def section_controls(tokenizer, batch_size, budgets=None, constrained=False, final_marker=TEST_END,
+                     open_sections=None, cancels=None):
+    """
+    generate() kwargs that stop at the final marker and cap every section;
+    with constrained=True the output is also held to the section grammar.
+    `final_marker` may be one marker per row, and `open_sections` names the
+    section each row's prompt has already opened (see utils.llm.generate_fanout).
+    `cancels` holds an optional CancelToken per row.
+    """
+    tracker = SectionTracker(tokenizer, batch_size, budgets, final_marker, constrained, open_sections)
+    processors = [SectionBudgetProcessor(tracker)]
+    if constrained:
+        processors.append(SectionGrammarProcessor(tracker, tokenizer.eos_token_id))
+    criteria = [StopOnFinalMarker(tracker)]
+    if cancels and any(cancel is not None for cancel in cancels):
+        criteria.append(StopOnCancel(cancels))
+    return dict(
+        logits_processor=LogitsProcessorList(processors),
+        stopping_criteria=StoppingCriteriaList(criteria),
+    )
+
+
+def resume_controls(controls, indices, cancels=None):
+    """
+    section_controls for continuing rows `indices` of a generate that ran with
+    `controls`, with each row's section state (open section, budgets spent,
+    grammar state) carried over.
+    """
+    old = controls["stopping_criteria"][0].tracker
+    resumed = section_controls(
+        old.tokenizer, len(indices), old.budgets, old.grammar is not None,
+        [old.final_markers[i] for i in indices], cancels=cancels
+    )
+    resumed["stopping_criteria"][0].tracker.rows = [old.rows[i].copy() for i in indices]
+    return resumed
+
+
+def row_done(controls, row):
+    """True once `row` has produced its final marker."""
+    return controls["stopping_criteria"][0].tracker.rows[row].done
+
+
+def section_token_counts(controls):
+    """Per-row {section: tokens generated} for a generate call run with section_controls()."""
+    tracker = controls["stopping_criteria"][0].tracker
+    return [dict(row.spent) for row in tracker.rows]
+
+
+class DecodeMeter:
+    """
+    Counts target-model forward passes during one generate call, to report
+    speculative-decoding acceptance and decode throughput.
+
+    Every target forward yields exactly one token of its own plus however many
+    proposed (draft / prompt-lookup) tokens it accepted, so
+    accepted = new_tokens - forwards. Proposed tokens are the extra inputs each
+    forward verifies beyond the prompt it still had to prefill.
+    """
+
+    def __init__(self, model, prefill_len):
+        self.model = model
+        self.prefill_len = prefill_len  # prompt tokens not already covered by a KV cache
+        self.forwards = 0
+        self.proposed = 0
+        self.started = None
+        self.prefill_done = None
+        self.finished = None
+        self._hook = None
+
+    def __enter__(self):
+        def hook(module, args, kwargs, output):
+            input_ids = kwargs.get("input_ids", args[0] if args else None)
+            if input_ids is not None:
+                self.proposed += input_ids.shape[1] - (1 if self.forwards else self.prefill_len)
+            if not self.forwards:
+                self.prefill_done = time.perf_counter()
+            self.forwards += 1
+
+        self.started = time.perf_counter()
+        self._hook = self.model.register_forward_hook(hook, with_kwargs=True)
+        return self
+
+    def __exit__(self, *exc):
+        self.finished = time.perf_counter()
+        self._hook.remove()
+        return False
+
+    def stats(self, new_tokens):
+        accepted = max(new_tokens - self.forwards, 0)
+        decode_seconds = self.finished - (self.prefill_done or self.started)
+        return {
+            "new_tokens": new_tokens,
+            "target_forwards": self.forwards,
+            "proposed_tokens": self.proposed,
+            "accepted_tokens": accepted,
+            "acceptance_rate": accepted / self.proposed if self.proposed else 0.0,
+            "tokens_per_forward": new_tokens / self.forwards if self.forwards else 0.0,
+            "prefill_seconds": (self.prefill_done or self.finished) - self.started,
+            "decode_seconds": decode_seconds,
+            "decode_tokens_per_sec": (new_tokens - 1) / decode_seconds if decode_seconds > 0 and new_tokens > 1 else 0.0,
+        }
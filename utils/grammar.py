@@ -0,0 +1,220 @@
+# utils/grammar.py
+"""
+Character-level grammar for the Mermaid subset the prompt's CRITICAL MERMAID
+RULES allow, plus per-tokenizer vocab tables so utils.generation can mask
+logits with it:
+
+    ```mermaid
+    flowchart TD
+    Start([Begin]) --> Init[Initialize variables]
+    Init --> Check{Is x > 0?}
+    Check -->|Yes| End([Finish])
+    ```
+
+Words Mermaid reserves (utils.mermaid.RESERVED_IDS, e.g. `end`) are refused
+as node IDs, so a conforming diagram always renders. The `flowchart TD`
+header is allowed only on the first line, with TD, TB, LR, RL or BT.
+
+Masks are computed lazily, once per (tokenizer, DFA state), so constrained
+steps cost a dict lookup after warm-up.
+"""
+import re
+import string
+
+from utils.mermaid import RESERVED_IDS
+
+# Characters allowed inside [..], ([..]), (..), {..} and |..| labels
+LABEL_CHARS = frozenset(string.ascii_letters + string.digits + " _?.,:=+-*/%!'<>&^~#@$")
+ID_START = frozenset(string.ascii_letters + "_")
+ID_CHARS = frozenset(string.ascii_letters + string.digits + "_")
+
+# --- DFA states ---
+LINE_START = "line_start"      # start of the diagram, before any node line: the header may come here
+BODY_START = "body_start"      # start of any later line
+FENCE_1, FENCE_2, FENCE_3 = "fence_1", "fence_2", "fence_3"
+NODE_ID = "node_id"
+ROUND_OPEN = "round_open"      # saw '(' : either '([' stadium or '(' round
+LABEL_SQUARE = "label_square"  # inside [..]
+LABEL_STADIUM = "label_stadium"  # inside ([..]
+STADIUM_CLOSE = "stadium_close"  # saw ']' of '])'
+LABEL_ROUND = "label_round"    # inside (..)
+LABEL_CURLY = "label_curly"    # inside {..}
+AFTER_NODE = "after_node"
+ARROW_1, ARROW_2, ARROW_3 = "arrow_1", "arrow_2", "arrow_3"
+EDGE_LABEL = "edge_label"      # inside -->|..|
+HEADER_GAP = "header_gap"      # after "flowchart " / "graph ": only the direction may follow
+HEADER_END = "header_end"      # after the direction: only spaces, then the line ends
+
+STATES = (
+    LINE_START, BODY_START, FENCE_1, FENCE_2, FENCE_3, NODE_ID, ROUND_OPEN, LABEL_SQUARE,
+    LABEL_STADIUM, STADIUM_CLOSE, LABEL_ROUND, LABEL_CURLY, AFTER_NODE,
+    ARROW_1, ARROW_2, ARROW_3, EDGE_LABEL, HEADER_GAP, HEADER_END,
+)
+
+# While a node ID still spells a prefix of a word Mermaid reserves (`end`,
+# `style`, ...), the DFA is in state "id:<prefix>" ("hd:<prefix>" on the first
+# line), so the reserved word itself can be refused where the ID ends.
+# "flowchart"/"graph" pass only as the header, i.e. from an "hd:" state.
+# The direction is spelled in "dir:<prefix>" states.
+HEADER_WORDS = ("flowchart", "graph")
+DIRECTIONS = ("TD", "TB", "LR", "RL", "BT")
+_RESERVED_PREFIXES = {word[:i] for word in RESERVED_IDS for i in range(1, len(word) + 1)}
+_DIRECTION_PREFIXES = {word[:i] for word in DIRECTIONS for i in range(1, len(word) + 1)}
+
+
+def _id_state(text, first_line=False):
+    if text not in _RESERVED_PREFIXES:
+        return NODE_ID
+    return ("hd:" if first_line else "id:") + text
+
+
+def mermaid_step(state, ch):
+    """Next DFA state after character `ch`, or None if `ch` is not allowed."""
+    if state[:3] in ("id:", "hd:"):
+        word = state[3:]
+        if ch in ID_CHARS:
+            return _id_state(word + ch, state[:3] == "hd:")
+        if word in RESERVED_IDS:
+            return HEADER_GAP if ch == " " and word in HEADER_WORDS and state[:3] == "hd:" else None
+        state = NODE_ID  # a prefix only, e.g. "en": an ordinary ID
+    if state[:4] == "dir:":
+        word = state[4:]
+        if word + ch in _DIRECTION_PREFIXES:
+            return "dir:" + word + ch
+        if word not in DIRECTIONS:
+            return None
+        state = HEADER_END
+    if ch == "\n":
+        # A line may end anywhere outside an open label or half-written arrow
+        if state in (LINE_START, FENCE_3):
+            return LINE_START  # blank lines and the opening fence come before the header
+        return BODY_START if state in (BODY_START, NODE_ID, AFTER_NODE, HEADER_END) else None
+
+    if state in (LINE_START, BODY_START):
+        if ch == " ":
+            return state
+        if ch == "`":
+            return FENCE_1
+        return _id_state(ch, state == LINE_START) if ch in ID_START else None
+    if state == FENCE_1:
+        return FENCE_2 if ch == "`" else None
+    if state == FENCE_2:
+        return FENCE_3 if ch == "`" else None
+    if state == FENCE_3:
+        return FENCE_3 if ch in string.ascii_letters else None
+    if state == NODE_ID:
+        if ch in ID_CHARS:
+            return NODE_ID
+        return {" ": AFTER_NODE, "[": LABEL_SQUARE, "(": ROUND_OPEN, "{": LABEL_CURLY, "-": ARROW_1}.get(ch)
+    if state == ROUND_OPEN:
+        if ch == "[":
+            return LABEL_STADIUM
+        return LABEL_ROUND if ch in LABEL_CHARS else None
+    if state == LABEL_SQUARE:
+        return AFTER_NODE if ch == "]" else LABEL_SQUARE if ch in LABEL_CHARS else None
+    if state == LABEL_STADIUM:
+        return STADIUM_CLOSE if ch == "]" else LABEL_STADIUM if ch in LABEL_CHARS else None
+    if state == STADIUM_CLOSE:
+        return AFTER_NODE if ch == ")" else None
+    if state == LABEL_ROUND:
+        return AFTER_NODE if ch == ")" else LABEL_ROUND if ch in LABEL_CHARS else None
+    if state == LABEL_CURLY:
+        return AFTER_NODE if ch == "}" else LABEL_CURLY if ch in LABEL_CHARS else None
+    if state == AFTER_NODE:
+        if ch == " ":
+            return AFTER_NODE
+        if ch == "-":
+            return ARROW_1
+        return _id_state(ch) if ch in ID_START else None
+    if state == ARROW_1:
+        return ARROW_2 if ch == "-" else None
+    if state == ARROW_2:
+        return ARROW_3 if ch == ">" else ARROW_2 if ch == "-" else None
+    if state == ARROW_3:
+        if ch == " ":
+            return ARROW_3
+        if ch == "|":
+            return EDGE_LABEL
+        return _id_state(ch) if ch in ID_START else None
+    if state == HEADER_GAP:
+        return HEADER_GAP if ch == " " else "dir:" + ch if ch in _DIRECTION_PREFIXES else None
+    if state == HEADER_END:
+        return HEADER_END if ch == " " else None
+    if state == EDGE_LABEL:
+        return ARROW_3 if ch == "|" else EDGE_LABEL if ch in LABEL_CHARS else None
+    return None
+
+
+def mermaid_run(state, text):
+    """Run `text` through the DFA; returns the final state or None."""
+    for ch in text:
+        state = mermaid_step(state, ch)
+        if state is None:
+            return None
+    return state
+
+
+# ---------- Vocab tables ----------
+_BYTE_PIECE = re.compile(r"<0x([0-9A-Fa-f]{2})>")
+
+
+def token_texts(tokenizer):
+    """
+    Surface text of every vocab entry, in isolation. Handles SentencePiece
+    ('▁' spaces, <0xNN> byte fallback) and byte-level BPE vocabularies.
+    Special tokens and non-ASCII byte pieces map to None.
+    """
+    special = set(tokenizer.all_special_ids)
+    texts = []
+    for token_id in range(len(tokenizer)):
+        piece = tokenizer.convert_ids_to_tokens(token_id)
+        if piece is None or token_id in special:
+            texts.append(None)
+            continue
+        m = _BYTE_PIECE.fullmatch(piece)
+        if m:
+            byte = int(m.group(1), 16)
+            texts.append(chr(byte) if byte < 128 else None)
+        elif "▁" in piece:
+            texts.append(piece.replace("▁", " "))
+        else:
+            text = tokenizer.convert_tokens_to_string([piece])
+            texts.append(None if "�" in text else text)
+    return texts
+
+
+class VocabGrammar:
+    """Token-level view of the section grammar and the Mermaid DFA for one tokenizer."""
+
+    def __init__(self, tokenizer):
+        self.texts = token_texts(tokenizer)
+        self.vocab_size = len(self.texts)
+        # Tokens that begin a '===' marker line
+        self.equals_ids = [i for i, t in enumerate(self.texts) if t and t.lstrip(" ").startswith("=")]
+        self._masks = {}
+
+    def allowed_mask(self, state, device):
+        """Bool tensor over the vocab: True where the token keeps the DFA alive from `state`."""
+        import torch
+
+        key = (state, str(device))
+        if key not in self._masks:
+            allowed = [t is not None and t != "" and mermaid_run(state, t) is not None for t in self.texts]
+            self._masks[key] = torch.tensor(allowed, dtype=torch.bool, device=device)
+        return self._masks[key]
+
+    def advance(self, state, token_id):
+        text = self.texts[token_id] if token_id < self.vocab_size else None
+        if text is None:
+            return None
+        return mermaid_run(state, text)
+
+
+_grammars = {}
+
+def vocab_grammar(tokenizer):
+    """Process-wide VocabGrammar per tokenizer (building one scans the whole vocab)."""
+    key = id(tokenizer)
+    if key not in _grammars:
+        _grammars[key] = VocabGrammar(tokenizer)
+    return _grammars[key]
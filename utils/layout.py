@@ -0,0 +1,535 @@
+# utils/layout.py
+"""
+Server-side flowchart layout and SVG rendering for the utils.mermaid graph IR,
+so diagrams draw without downloading mermaid.js.
+
+layout_graph() is a layered (Sugiyama-style) layout:
+1. Cycles are broken by reversing the back edges a depth-first search finds.
+2. Ranks: longest path from the sources, then sources are pulled down next to
+   their successors.
+3. Edges spanning several ranks get a dummy node per rank crossed.
+4. Crossings: alternating barycenter sweeps. The ordering with the fewest
+   crossings is kept (counted per layer pair with a Fenwick tree).
+5. Coordinates: each layer is pulled toward the mean position of its
+   neighbours, then packed to the closest positions that keep node order and
+   spacing (weighted isotonic regression). Dummies weigh more, so long edges
+   run straight.
+render_svg() draws the result with Mermaid's default theme.
+"""
+import html
+import math
+
+FONT_SIZE = 14
+CHAR_WIDTH = 7.6  # average glyph width at FONT_SIZE, for sizing boxes without a font engine
+LINE_HEIGHT = 18
+WRAP = 28  # characters per label line
+PAD_X, PAD_Y = 14, 9
+NODE_SEP = 28  # between neighbouring nodes in a layer
+DUMMY_SEP = 12  # between an edge bend and its neighbours
+RANK_SEP = 52  # between layers
+MARGIN = 16
+CROSSING_SWEEPS = 8
+PLACEMENT_SWEEPS = 8
+
+
+class Layout:
+    """Positions in SVG user units: node centers and sizes, edge polylines, cluster boxes."""
+
+    def __init__(self):
+        self.nodes = {}  # id -> (x, y, width, height)
+        self.lines = {}  # id -> wrapped label lines
+        self.edges = []  # (Edge, [(x, y), ...]) from source to target
+        self.clusters = []  # (Subgraph, x0, y0, x1, y1), outermost first
+        self.width = 0
+        self.height = 0
+
+
+# ---------- Text ----------
+def wrap_label(text, width=WRAP):
+    """Label lines: explicit <br> breaks, then word wrap at `width` characters."""
+    lines = []
+    for part in text.replace("<br/>", "\n").replace("<br>", "\n").split("\n"):
+        line = ""
+        for word in part.split():
+            while len(word) > width:
+                if line:
+                    lines.append(line)
+                    line = ""
+                lines.append(word[:width])
+                word = word[width:]
+            if line and len(line) + 1 + len(word) > width:
+                lines.append(line)
+                line = word
+            else:
+                line = f"{line} {word}" if line else word
+        lines.append(line)
+    return [line for line in lines if line] or [""]
+
+def node_size(lines, shape):
+    """(width, height) of a node drawn in `shape` around its label."""
+    w = max(len(line) for line in lines) * CHAR_WIDTH + 2 * PAD_X
+    h = len(lines) * LINE_HEIGHT + 2 * PAD_Y
+    opener = shape[0]
+    if opener == "{":
+        return 1.8 * w, 2.25 * h
+    if opener == "{{":
+        return w + h, h
+    if opener in ("((", "((("):
+        d = math.hypot(w, h)
+        return d, d
+    if opener in ("(", "([", ">", "[/", "[\\"):
+        return w + h * 0.6, h
+    if opener == "[(":
+        return w, h + 16
+    if opener == "[[":
+        return w + 16, h
+    return w, h
+
+
+# ---------- Layout ----------
+def _break_cycles(order, succ):
+    """Edges (u, v) a DFS in node order finds going back up the stack."""
+    state = dict.fromkeys(order, 0)  # 0 new, 1 on stack, 2 done
+    back = set()
+    for root in order:
+        if state[root]:
+            continue
+        state[root] = 1
+        stack = [(root, iter(succ[root]))]
+        while stack:
+            node, children = stack[-1]
+            for child in children:
+                if state[child] == 1:
+                    back.add((node, child))
+                elif state[child] == 0:
+                    state[child] = 1
+                    stack.append((child, iter(succ[child])))
+                    break
+            else:
+                state[node] = 2
+                stack.pop()
+    return back
+
+def _ranks(order, succ, pred):
+    """Longest-path ranks, with sources moved down to just above their first successor."""
+    indegree = {v: len(pred[v]) for v in order}
+    topo = [v for v in order if not indegree[v]]
+    for v in topo:
+        for w in succ[v]:
+            indegree[w] -= 1
+            if not indegree[w]:
+                topo.append(w)
+    rank = dict.fromkeys(order, 0)
+    for v in topo:
+        for w in succ[v]:
+            rank[w] = max(rank[w], rank[v] + 1)
+    for v in reversed(topo):
+        if not pred[v] and succ[v]:
+            rank[v] = min(rank[w] for w in succ[v]) - 1
+    return rank
+
+def _crossings(upper, lower, down):
+    """Edge crossings between two adjacent layers (Barth-Juenger-Mutzel, O(E log V))."""
+    position = {v: i for i, v in enumerate(lower)}
+    targets = []
+    for v in upper:
+        targets.extend(sorted(position[w] for w in down[v]))
+    size = len(lower)
+    tree = [0] * (size + 1)
+    crossings = 0
+    for seen, p in enumerate(targets):
+        # edges already added that end strictly right of p cross this one
+        i, below = p + 1, 0
+        while i:
+            below += tree[i]
+            i -= i & -i
+        crossings += seen - below
+        i = p + 1
+        while i <= size:
+            tree[i] += 1
+            i += i & -i
+    return crossings
+
+def _total_crossings(layers, down):
+    return sum(_crossings(layers[r], layers[r + 1], down) for r in range(len(layers) - 1))
+
+def _order_layers(layers, down, up):
+    """Barycenter sweeps; returns the ordering with the fewest crossings seen."""
+    best, best_crossings = [list(layer) for layer in layers], _total_crossings(layers, down)
+    for sweep in range(CROSSING_SWEEPS):
+        if not best_crossings:
+            break
+        downward = sweep % 2 == 0
+        rows = range(1, len(layers)) if downward else range(len(layers) - 2, -1, -1)
+        for r in rows:
+            fixed = layers[r - 1] if downward else layers[r + 1]
+            neighbours = up if downward else down
+            position = {v: i for i, v in enumerate(fixed)}
+            layer = layers[r]
+
+            def barycenter(item):
+                i, v = item
+                adjacent = neighbours[v]
+                if not adjacent:
+                    return i * len(fixed) / max(1, len(layer))
+                return sum(position[w] for w in adjacent) / len(adjacent)
+
+            layers[r] = [v for _, v in sorted(enumerate(layer), key=barycenter)]
+        crossings = _total_crossings(layers, down)
+        if crossings < best_crossings:
+            best, best_crossings = [list(layer) for layer in layers], crossings
+    return best
+
+def _pack(desired, weights, gaps):
+    """
+    Positions closest to `desired` (weighted least squares) with x[i] - x[i-1] >= gaps[i],
+    by pool-adjacent-violators on the gap-shifted targets.
+    """
+    offsets, total = [], 0.0
+    for gap in gaps:
+        total += gap
+        offsets.append(total)
+    blocks = []  # [weighted sum, weight, count]
+    for d, w, off in zip(desired, weights, offsets):
+        blocks.append([(d - off) * w, w, 1])
+        while len(blocks) > 1 and blocks[-2][0] / blocks[-2][1] > blocks[-1][0] / blocks[-1][1]:
+            s, w2, c = blocks.pop()
+            blocks[-1][0] += s
+            blocks[-1][1] += w2
+            blocks[-1][2] += c
+    positions = []
+    for s, w, c in blocks:
+        positions.extend([s / w] * c)
+    return [p + off for p, off in zip(positions, offsets)]
+
+def _place(layers, width, down, up, dummy):
+    """Cross-axis centers for every vertex."""
+    x = {}
+    gaps_by_layer = []
+    for layer in layers:
+        gaps, prev = [], None
+        for v in layer:
+            if prev is None:
+                gaps.append(0.0)
+            else:
+                sep = DUMMY_SEP if dummy(prev) or dummy(v) else NODE_SEP
+                gaps.append((width[prev] + width[v]) / 2 + sep)
+            prev = v
+        gaps_by_layer.append(gaps)
+        for v, p in zip(layer, _pack([0.0] * len(layer), [1.0] * len(layer), gaps)):
+            x[v] = p
+    for sweep in range(PLACEMENT_SWEEPS):
+        downward = sweep % 2 == 0
+        rows = range(len(layers)) if downward else range(len(layers) - 1, -1, -1)
+        for r in rows:
+            layer = layers[r]
+            desired, weights = [], []
+            for v in layer:
+                # Dummies follow both ends so long edges straighten; real nodes follow the sweep side
+                adjacent = up[v] + down[v] if dummy(v) else (up[v] if downward else down[v]) or up[v] + down[v]
+                desired.append(sum(x[w] for w in adjacent) / len(adjacent) if adjacent else x[v])
+                weights.append(4.0 if dummy(v) else 1.0)
+            for v, p in zip(layer, _pack(desired, weights, gaps_by_layer[r])):
+                x[v] = p
+    return x
+
+def _clip(center, size, shape, toward):
+    """Where the segment from a node's center toward `toward` leaves its outline."""
+    (cx, cy), (w, h) = center, size
+    dx, dy = toward[0] - cx, toward[1] - cy
+    if not dx and not dy:
+        return center
+    if shape[0] in ("((", "((("):
+        t = (w / 2) / math.hypot(dx, dy)
+    elif shape[0] == "{":
+        t = 1 / (abs(dx) / (w / 2) + abs(dy) / (h / 2))
+    else:
+        t = min((w / 2) / abs(dx) if dx else math.inf, (h / 2) / abs(dy) if dy else math.inf)
+    t = min(t, 1.0)
+    return cx + dx * t, cy + dy * t
+
+def layout_graph(graph):
+    """Layered layout of a utils.mermaid Graph, honouring its direction."""
+    result = Layout()
+    order = list(graph.nodes)
+    horizontal = graph.direction in ("LR", "RL")
+    size = {}
+    for nid, node in graph.nodes.items():
+        lines = wrap_label(node.label if node.label is not None else nid)
+        result.lines[nid] = lines
+        size[nid] = node_size(lines, node.shape)
+    # Layout runs top-down; for LR/RL the axes swap, so a node's "width" is its height
+    width = {v: (size[v][1] if horizontal else size[v][0]) for v in order}
+    depth = {v: (size[v][0] if horizontal else size[v][1]) for v in order}
+
+    succ = {v: [] for v in order}
+    for edge in graph.edges:
+        if edge.source != edge.target and edge.target not in succ[edge.source]:
+            succ[edge.source].append(edge.target)
+    back = _break_cycles(order, succ)
+    dag_succ = {v: [] for v in order}
+    dag_pred = {v: [] for v in order}
+    for u in order:
+        for v in succ[u]:
+            a, b = (v, u) if (u, v) in back else (u, v)
+            if b not in dag_succ[a]:
+                dag_succ[a].append(b)
+                dag_pred[b].append(a)
+    rank = _ranks(order, dag_succ, dag_pred)
+    low = min(rank.values(), default=0)
+    for v in order:
+        rank[v] -= low
+
+    # Split long edges into one-rank hops through dummy vertices
+    down = {v: [] for v in order}
+    up = {v: [] for v in order}
+    chains = {}  # (a, b) in DAG orientation -> [a, dummy..., b]
+    dummies = 0
+    for a in order:
+        for b in dag_succ[a]:
+            chain, prev = [a], a
+            for r in range(rank[a] + 1, rank[b]):
+                dummies += 1
+                d = ("dummy", dummies)
+                rank[d], width[d], depth[d] = r, 0.0, 0.0
+                down[d], up[d] = [], []
+                down[prev].append(d)
+                up[d].append(prev)
+                chain.append(d)
+                prev = d
+            down[prev].append(b)
+            up[b].append(prev)
+            chain.append(b)
+            chains[(a, b)] = chain
+
+    layers = [[] for _ in range(max(rank.values(), default=-1) + 1)]
+    for v in order:
+        layers[rank[v]].append(v)
+    for chain in chains.values():
+        for d in chain[1:-1]:
+            layers[rank[d]].append(d)
+    layers = _order_layers(layers, down, up)
+    x = _place(layers, width, down, up, lambda v: isinstance(v, tuple))
+
+    # Rank axis: each layer as deep as its deepest node
+    y, cursor = {}, 0.0
+    for layer in layers:
+        thickness = max((depth[v] for v in layer), default=0.0)
+        for v in layer:
+            y[v] = cursor + thickness / 2
+        cursor += thickness + RANK_SEP
+    left = min((x[v] - width[v] / 2 for v in x), default=0.0)
+    right = max((x[v] + width[v] / 2 for v in x), default=0.0)
+    extent = (right - left, max(cursor - RANK_SEP, 0.0))
+
+    def point(v):
+        """Final (x, y) of a layout vertex, turned to the graph's direction."""
+        across, along = x[v] - left, y[v]
+        if graph.direction in ("BT", "RL"):
+            along = extent[1] - along
+        return (along, across) if horizontal else (across, along)
+
+    for v in order:
+        px, py = point(v)
+        result.nodes[v] = (px, py, size[v][0], size[v][1])
+
+    for edge in graph.edges:
+        if edge.source == edge.target:
+            cx, cy, w, h = result.nodes[edge.source]
+            r = min(w, h) / 2
+            result.edges.append((edge, [(cx + w / 2, cy - r / 2), (cx + w / 2 + r, cy - r / 2),
+                                        (cx + w / 2 + r, cy + r / 2), (cx + w / 2, cy + r / 2)]))
+            continue
+        key = (edge.source, edge.target)
+        chain = chains.get(key) or list(reversed(chains[(edge.target, edge.source)]))
+        points = [point(v) for v in chain]
+        source, target = graph.nodes[edge.source], graph.nodes[edge.target]
+        points[0] = _clip(points[0], size[edge.source], source.shape, points[1])
+        points[-1] = _clip(points[-1], size[edge.target], target.shape, points[-2])
+        result.edges.append((edge, points))
+
+    # Cluster boxes around their members and nested clusters, innermost computed first
+    boxes = {}
+    children = {}
+    for sub in graph.subgraphs.values():
+        children.setdefault(sub.parent, []).append(sub.id)
+    members = {}
+    for nid, node in graph.nodes.items():
+        if node.subgraph is not None:
+            members.setdefault(node.subgraph, []).append(nid)
+
+    def box(sid):
+        if sid in boxes:
+            return boxes[sid]
+        rects = []
+        for nid in members.get(sid, ()):
+            cx, cy, w, h = result.nodes[nid]
+            rects.append((cx - w / 2, cy - h / 2, cx + w / 2, cy + h / 2))
+        rects.extend(b for b in (box(child) for child in children.get(sid, ())) if b)
+        if not rects:
+            boxes[sid] = None
+            return None
+        pad = 12
+        boxes[sid] = (min(r[0] for r in rects) - pad, min(r[1] for r in rects) - pad - LINE_HEIGHT,
+                      max(r[2] for r in rects) + pad, max(r[3] for r in rects) + pad)
+        return boxes[sid]
+
+    def nest(sid):
+        b = box(sid)
+        if b:
+            result.clusters.append((graph.subgraphs[sid],) + b)
+        for child in children.get(sid, ()):
+            nest(child)
+
+    for sid in children.get(None, ()):
+        nest(sid)
+
+    # Shift everything into view with a margin
+    xs = [cx - w / 2 for cx, _, w, _ in result.nodes.values()] + [c[1] for c in result.clusters]
+    ys = [cy - h / 2 for _, cy, _, h in result.nodes.values()] + [c[2] for c in result.clusters]
+    xe = [cx + w / 2 for cx, _, w, _ in result.nodes.values()] + [c[3] for c in result.clusters]
+    ye = [cy + h / 2 for _, cy, _, h in result.nodes.values()] + [c[4] for c in result.clusters]
+    for _, points in result.edges:
+        xs.extend(p[0] for p in points)
+        ys.extend(p[1] for p in points)
+        xe.extend(p[0] for p in points)
+        ye.extend(p[1] for p in points)
+    dx, dy = MARGIN - min(xs, default=0.0), MARGIN - min(ys, default=0.0)
+    result.nodes = {v: (cx + dx, cy + dy, w, h) for v, (cx, cy, w, h) in result.nodes.items()}
+    result.edges = [(edge, [(px + dx, py + dy) for px, py in points]) for edge, points in result.edges]
+    result.clusters = [(sub, x0 + dx, y0 + dy, x1 + dx, y1 + dy) for sub, x0, y0, x1, y1 in result.clusters]
+    result.width = math.ceil(max(xe, default=0.0) + dx + MARGIN)
+    result.height = math.ceil(max(ye, default=0.0) + dy + MARGIN)
+    return result
+
+
+# ---------- SVG ----------
+_STYLE = (
+    "text{font-family:'trebuchet ms',verdana,arial,sans-serif;font-size:%dpx;fill:#333;text-anchor:middle;"
+    "dominant-baseline:central}"
+    ".node{fill:#ECECFF;stroke:#9370DB;stroke-width:1.3}"
+    ".cluster{fill:#ffffde;stroke:#aaaa33;stroke-width:1}"
+    ".edge{fill:none;stroke:#333;stroke-width:1.5;stroke-linejoin:round}"
+    ".thick{stroke-width:3.2}.dotted{stroke-dasharray:3 3}"
+    ".elabel{fill:#e8e8e8;opacity:0.9}"
+    ".marker{fill:#333;stroke:#333}"
+    ".link{cursor:pointer}.link .node{fill:#fff4dd;stroke:#d4a017}" % FONT_SIZE
+)
+_DEFS = (
+    '<marker id="arrow" viewBox="0 0 10 10" refX="9" refY="5" markerWidth="8" markerHeight="8" orient="auto">'
+    '<path d="M0,0L10,5L0,10z" class="marker"/></marker>'
+    '<marker id="arrow-start" viewBox="0 0 10 10" refX="1" refY="5" markerWidth="8" markerHeight="8" '
+    'orient="auto"><path d="M10,0L0,5L10,10z" class="marker"/></marker>'
+    '<marker id="circle" viewBox="0 0 10 10" refX="9" refY="5" markerWidth="8" markerHeight="8" orient="auto">'
+    '<circle cx="5" cy="5" r="4" class="marker"/></marker>'
+    '<marker id="cross" viewBox="0 0 10 10" refX="9" refY="5" markerWidth="9" markerHeight="9" orient="auto">'
+    '<path d="M1,1L9,9M1,9L9,1" class="marker" stroke-width="2"/></marker>'
+)
+
+
+def _fmt(v):
+    return f"{v:.1f}".rstrip("0").rstrip(".")
+
+def _shape_svg(shape, cx, cy, w, h):
+    """SVG element for a node outline (Mermaid flowchart shapes)."""
+    x0, y0, x1, y1 = cx - w / 2, cy - h / 2, cx + w / 2, cy + h / 2
+    opener = shape[0]
+
+    def polygon(points):
+        return '<polygon class="node" points="%s"/>' % " ".join(f"{_fmt(px)},{_fmt(py)}" for px, py in points)
+
+    if opener == "{":
+        return polygon([(cx, y0), (x1, cy), (cx, y1), (x0, cy)])
+    if opener == "{{":
+        s = h / 2
+        return polygon([(x0 + s, y0), (x1 - s, y0), (x1, cy), (x1 - s, y1), (x0 + s, y1), (x0, cy)])
+    if opener in ("((", "((("):
+        circle = f'<circle class="node" cx="{_fmt(cx)}" cy="{_fmt(cy)}" r="{_fmt(w / 2)}"/>'
+        if opener == "(((":
+            circle += f'<circle class="node" cx="{_fmt(cx)}" cy="{_fmt(cy)}" r="{_fmt(w / 2 - 4)}"/>'
+        return circle
+    if opener == ">":
+        return polygon([(x0, y0), (x1, y0), (x1, y1), (x0, y1), (x0 + h / 3, cy)])
+    if opener in ("[/", "[\\"):
+        s = h * 0.3
+        # [/ /] and [\ \] lean right and left; [/ \] and [\ /] are trapezoids
+        left = (x0 + s, x0) if opener == "[/" else (x0, x0 + s)
+        right = (x1, x1 - s) if shape[1] == "/]" else (x1 - s, x1)
+        return polygon([(left[0], y0), (right[0], y0), (right[1], y1), (left[1], y1)])
+    if opener == "[(":
+        ry = 7
+        return (f'<path class="node" d="M{_fmt(x0)},{_fmt(y0 + ry)} a{_fmt(w / 2)},{ry} 0 0,0 {_fmt(w)},0 '
+                f'a{_fmt(w / 2)},{ry} 0 0,0 {_fmt(-w)},0 l0,{_fmt(h - 2 * ry)} a{_fmt(w / 2)},{ry} 0 0,0 '
+                f'{_fmt(w)},0 l0,{_fmt(-(h - 2 * ry))}"/>')
+    rx = {"(": 10, "([": h / 2}.get(opener, 0)
+    rect = (f'<rect class="node" x="{_fmt(x0)}" y="{_fmt(y0)}" width="{_fmt(w)}" height="{_fmt(h)}" '
+            f'rx="{_fmt(rx)}"/>')
+    if opener == "[[":
+        rect += (f'<path class="node" d="M{_fmt(x0 + 8)},{_fmt(y0)}v{_fmt(h)}M{_fmt(x1 - 8)},{_fmt(y0)}'
+                 f'v{_fmt(h)}"/>')
+    return rect
+
+def _text_svg(lines, cx, cy):
+    first = cy - (len(lines) - 1) * LINE_HEIGHT / 2
+    return "".join(
+        f'<text x="{_fmt(cx)}" y="{_fmt(first + i * LINE_HEIGHT)}">{html.escape(line)}</text>'
+        for i, line in enumerate(lines)
+    )
+
+def _edge_svg(edge, points):
+    arrow = edge.arrow
+    classes = "edge"
+    if arrow.lstrip("<").startswith("=="):
+        classes += " thick"
+    elif "." in arrow:
+        classes += " dotted"
+    markers = ""
+    if arrow.endswith(">"):
+        markers += ' marker-end="url(#arrow)"'
+    elif arrow.endswith("o"):
+        markers += ' marker-end="url(#circle)"'
+    elif arrow.endswith("x"):
+        markers += ' marker-end="url(#cross)"'
+    if arrow.startswith("<"):
+        markers += ' marker-start="url(#arrow-start)"'
+    d = "M" + "L".join(f"{_fmt(px)},{_fmt(py)}" for px, py in points)
+    out = f'<path class="{classes}" d="{d}"{markers}/>'
+    if edge.label:
+        lines = wrap_label(edge.label)
+        mid = len(points) // 2
+        (ax, ay), (bx, by) = points[mid - 1], points[mid]
+        cx, cy = (ax + bx) / 2, (ay + by) / 2
+        w = max(len(line) for line in lines) * CHAR_WIDTH + 8
+        h = len(lines) * LINE_HEIGHT + 2
+        out += (f'<rect class="elabel" x="{_fmt(cx - w / 2)}" y="{_fmt(cy - h / 2)}" width="{_fmt(w)}" '
+                f'height="{_fmt(h)}"/>' + _text_svg(lines, cx, cy))
+    return out
+
+def render_svg(graph, layout=None, links=None):
+    """
+    Standalone inline <svg> for a utils.mermaid Graph. `links` maps node IDs to
+    (href, tooltip) to make those nodes clickable.
+    """
+    links = links or {}
+    layout = layout or layout_graph(graph)
+    parts = [
+        f'<svg xmlns="http://www.w3.org/2000/svg" width="{layout.width}" height="{layout.height}" '
+        f'viewBox="0 0 {layout.width} {layout.height}" role="img">',
+        f"<style>{_STYLE}</style><defs>{_DEFS}</defs>",
+    ]
+    for sub, x0, y0, x1, y1 in layout.clusters:
+        parts.append(f'<rect class="cluster" x="{_fmt(x0)}" y="{_fmt(y0)}" width="{_fmt(x1 - x0)}" '
+                     f'height="{_fmt(y1 - y0)}"/>')
+        parts.append(_text_svg([sub.title or sub.id], (x0 + x1) / 2, y0 + LINE_HEIGHT / 2 + 4))
+    for edge, points in layout.edges:
+        parts.append(_edge_svg(edge, points))
+    for nid, node in graph.nodes.items():
+        cx, cy, w, h = layout.nodes[nid]
+        drawn = _shape_svg(node.shape, cx, cy, w, h) + _text_svg(layout.lines[nid], cx, cy)
+        if nid in links:
+            href, tooltip = links[nid]
+            drawn = (f'<a href="{html.escape(href)}" class="link"><title>{html.escape(tooltip)}</title>'
+                     f"{drawn}</a>")
+        parts.append(drawn)
+    parts.append("</svg>")
+    return "".join(parts)
@@ -1,23 +1,911 @@
-from transformers import AutoTokenizer, AutoModelForCausalLM, BitsAndBytesConfig
-import torch
+import asyncio
+import copy
+import hashlib
+import os
+import queue
+import time
+from threading import Thread, Lock, Event
 
-# Load model once at startup
-model_id = r"C:\Users\NIHAL 2\PycharmProjects\MajorProject\mistral_7b_instruct_v2_4bit"
+from utils.backends import get_backend
+from utils.batcher import CancelToken, MicroBatcher
+from utils.budget import TokenBudget
+from utils.cache import ResponseCache, fingerprint_files
+from utils.flowchart import AST_FLOWCHART
+from utils.parser import CODE_END, SECTIONS, TEST_END, is_complete, parse_response
+from utils.prompts import PREFIXES, TEMPLATES
+from utils.scheduler import BATCH, INTERACTIVE, AdmissionQueue
+from utils.telemetry import record_generation, timed
 
-print("[INFO] Loading Mistral 7B Instruct (4-bit)...")
+# Weights are loaded lazily (see get_handle), so importing this module is cheap
+MODEL_PATH = os.environ.get(
+    "MISTRAL_MODEL_PATH",
+    r"C:\Users\NIHAL 2\PycharmProjects\MajorProject\mistral_7b_instruct_v2_4bit"
+)
+# Prefilled prompt-prefix KV caches are persisted here so restarted workers start warm;
+# set PREFIX_CACHE_DIR="" to turn prefix reuse off
+PREFIX_CACHE_DIR = os.environ.get("PREFIX_CACHE_DIR", os.path.join("outputs", "cache"))
+# Finished responses are cached here; set RESPONSE_CACHE_PATH="" to disable
+RESPONSE_CACHE_PATH = os.environ.get("RESPONSE_CACHE_PATH", os.path.join("outputs", "cache", "responses.sqlite3"))
+RESPONSE_CACHE_MAX_MB = float(os.environ.get("RESPONSE_CACHE_MAX_MB", "256"))
+RESPONSE_CACHE_MAX_AGE_DAYS = float(os.environ.get("RESPONSE_CACHE_MAX_AGE_DAYS", "30"))
+# Speculative decoding for single-prompt generation: off | prompt_lookup | draft
+SPECULATIVE = os.environ.get("SPECULATIVE", "off").lower()
+SPECULATIVE_DRAFT_PATH = os.environ.get("SPECULATIVE_DRAFT_PATH")
+PROMPT_LOOKUP_TOKENS = int(os.environ.get("PROMPT_LOOKUP_TOKENS", "10"))
+# Grammar-constrained decoding (utils.grammar): sections forced in order, Mermaid
+# VISUALIZATION held to the supported subset. Opt-in: CONSTRAINED_DECODING=1
+CONSTRAINED_DECODING = os.environ.get("CONSTRAINED_DECODING", "0").lower() in ("1", "true", "yes")
+# sequential: one pass over all sections | fanout: CODE first, then the other
+# sections as parallel rows of one batched generate (see generate_fanout)
+SECTION_PIPELINE = os.environ.get("SECTION_PIPELINE", "sequential").lower()
+# Out-of-process inference (server.py): when set, generate_response and
+# stream_response are forwarded there and this process never loads the model
+LLM_SERVER_URL = os.environ.get("LLM_SERVER_URL", "")
+# Per-request deadline in seconds for app.py/main.py (0 = none); when it hits,
+# generation stops and the sections completed so far are returned
+GENERATION_TIMEOUT = float(os.environ.get("GENERATION_TIMEOUT", "0")) or None
+# Admission control for the shared batcher (utils.scheduler)
+QUEUE_MAX_DEPTH = int(os.environ.get("QUEUE_MAX_DEPTH", "32"))
+QUEUE_MAX_WAIT_INTERACTIVE = float(os.environ.get("QUEUE_MAX_WAIT_INTERACTIVE", "60"))
+QUEUE_MAX_WAIT_BATCH = float(os.environ.get("QUEUE_MAX_WAIT_BATCH", "900"))
+QUEUE_DEGRADE_AT = float(os.environ.get("QUEUE_DEGRADE_AT", "0.5"))
+QUEUE_MIN_NEW_TOKENS = int(os.environ.get("QUEUE_MIN_NEW_TOKENS", "256"))
+# Adaptive token budgets (utils.budget): callers that pass no max_new_tokens get
+# one predicted from past requests, and a row that uses it up before its final
+# marker continues from its KV cache in BUDGET_EXTEND-token steps, up to
+# BUDGET_MAX new tokens. ADAPTIVE_BUDGET=0 restores a fixed DEFAULT_MAX_NEW_TOKENS
+ADAPTIVE_BUDGET = os.environ.get("ADAPTIVE_BUDGET", "1").lower() in ("1", "true", "yes")
+DEFAULT_MAX_NEW_TOKENS = 1024
+BUDGET_MAX = int(os.environ.get("BUDGET_MAX", "2048"))
+BUDGET_EXTEND = int(os.environ.get("BUDGET_EXTEND", "256"))
+BUDGET_HISTORY_PATH = os.environ.get("BUDGET_HISTORY_PATH", os.path.join("outputs", "cache", "budget_history.jsonl"))
+# KV-cache plan for the shared batcher: rows x (prompt + budget) tokens per batch (0 = no cap)
+BATCH_MAX_TOKENS = int(os.environ.get("BATCH_MAX_TOKENS", "0"))
 
-bnb_config = BitsAndBytesConfig(load_in_4bit=True, bnb_4bit_compute_dtype=torch.float16)
 
-tokenizer = AutoTokenizer.from_pretrained(model_id)
-model = AutoModelForCausalLM.from_pretrained(
-    model_id,
-    device_map="auto",
-    quantization_config=bnb_config,
-    dtype=torch.float16
-)
+class ModelHandle:
+    """
+    Process-wide (tokenizer, model) pair, loaded by the configured backend
+    (see utils.backends; the GPU backend wraps model_loader.load_model).
+    Loading runs on a background thread so callers (e.g. the Streamlit UI)
+    stay responsive; get() blocks until the weights are ready.
+    """
+
+    def __init__(self, model_path, backend=None):
+        self.model_path = model_path
+        self._backend = backend
+        self.status = "idle"  # idle -> loading -> ready | failed
+        self.error = None
+        self.load_seconds = None
+        self.load_phases = {}  # phase name -> seconds, as reported by the backend
+        self._tokenizer = None
+        self._model = None
+        self._draft = None
+        self._ready = Event()
+        self._lock = Lock()
+
+    @property
+    def backend(self):
+        # Resolved on first use: "auto" selection has to import torch
+        if self._backend is None:
+            self._backend = get_backend()
+        return self._backend
+
+    @property
+    def ready(self):
+        return self.status == "ready"
+
+    def start(self):
+        """Kick off the background load (no-op if already started)."""
+        with self._lock:
+            if self.status != "idle":
+                return self
+            self.status = "loading"
+        Thread(target=self._load, name="model-loader", daemon=True).start()
+        return self
+
+    def get(self, timeout=None):
+        """Return (tokenizer, model), waiting for the background load if needed."""
+        self.start()
+        if not self._ready.wait(timeout):
+            raise TimeoutError(f"Model not ready after {timeout} s")
+        if self.status == "failed":
+            raise RuntimeError(f"Model failed to load: {self.error}")
+        return self._tokenizer, self._model
+
+    def draft(self, draft_path=None):
+        """Small assistant model for speculative decoding, loaded on first use."""
+        _, model = self.get()
+        with self._lock:
+            if self._draft is None:
+                draft_path = draft_path or SPECULATIVE_DRAFT_PATH
+                if not draft_path:
+                    raise RuntimeError("SPECULATIVE=draft needs SPECULATIVE_DRAFT_PATH")
+                from model_loader import load_draft_model
+                self._draft = load_draft_model(draft_path, model.device, model.dtype)
+            return self._draft
+
+    def _load(self):
+        started = time.perf_counter()
+        try:
+            self._tokenizer, self._model = self.backend.load(self.model_path)
+            self.load_phases = dict(getattr(self.backend, "load_phases", {}))
+            self.status = "ready"
+        except Exception as e:
+            self.error = e
+            self.status = "failed"
+            print(f"[ERROR] Model load failed: {e}")
+        finally:
+            self.load_seconds = time.perf_counter() - started
+            self._ready.set()
+
+
+_handle = None
+_handle_lock = Lock()
+
+def get_handle():
+    """The process-wide model handle (created on first use, not loaded until started)."""
+    global _handle
+    with _handle_lock:
+        if _handle is None:
+            _handle = ModelHandle(MODEL_PATH)
+        return _handle
+
+
+class PrefixCache:
+    """
+    Prefilled KV cache for the fixed instruction prefixes in utils.prompts.
+    Each prefix is prefilled once per process (or loaded from PREFIX_CACHE_DIR)
+    and copied per request, so a request only prefills its own TASK suffix.
+    """
+
+    def __init__(self, prefixes, cache_dir):
+        # Longest first, so a prefix that extends another one wins
+        self.prefixes = sorted(prefixes, key=len, reverse=True)
+        self.cache_dir = cache_dir
+        self._entries = {}  # prefix -> (prefix input_ids, DynamicCache)
+        self._lock = Lock()
+
+    def match(self, prompt):
+        for prefix in self.prefixes:
+            if prompt.startswith(prefix):
+                return prefix
+        return None
+
+    def get(self, tokenizer, model, prefix):
+        """Return (prefix input_ids, private copy of its KV cache)."""
+        with self._lock:
+            if prefix not in self._entries:
+                self._entries[prefix] = self._load(model, prefix) or self._build(tokenizer, model, prefix)
+            prefix_ids, past = self._entries[prefix]
+        return prefix_ids, copy.deepcopy(past)
+
+    def _path(self, prefix):
+        digest = hashlib.sha256(f"{model_fingerprint()}\0{prefix}".encode("utf-8")).hexdigest()[:16]
+        return os.path.join(self.cache_dir, f"prefix-{digest}.pt")
+
+    def _build(self, tokenizer, model, prefix):
+        import torch
+
+        started = time.perf_counter()
+        prefix_ids = tokenizer(prefix, return_tensors="pt").input_ids.to(model.device)
+        with torch.no_grad():
+            past = model(input_ids=prefix_ids, use_cache=True).past_key_values
+        print(f"[INFO] Prefilled {prefix_ids.shape[1]}-token prompt prefix in {time.perf_counter() - started:.2f} s")
+
+        try:
+            os.makedirs(self.cache_dir, exist_ok=True)
+            torch.save({
+                "input_ids": prefix_ids.cpu(),
+                "past_key_values": [(k.cpu(), v.cpu()) for k, v in past.to_legacy_cache()],
+            }, self._path(prefix))
+        except OSError as e:
+            print(f"[WARN] Could not persist prefix cache: {e}")
+        return prefix_ids, past
+
+    def _load(self, model, prefix):
+        import torch
+        from transformers import DynamicCache
+
+        path = self._path(prefix)
+        if not os.path.exists(path):
+            return None
+        try:
+            saved = torch.load(path, map_location=model.device, weights_only=True)
+        except Exception as e:
+            print(f"[WARN] Ignoring unreadable prefix cache {path}: {e}")
+            return None
+        print(f"[INFO] Loaded prompt prefix cache from {path}")
+        return saved["input_ids"], DynamicCache.from_legacy_cache(tuple(saved["past_key_values"]))
+
+
+_prefix_cache = PrefixCache(PREFIXES if PREFIX_CACHE_DIR else (), PREFIX_CACHE_DIR)
+
+def _encode(tokenizer, prompts):
+    """
+    Token ids for each prompt, plus how many of them are the template prefix
+    (None if unknown). Prompts built by a utils.prompts template only tokenize
+    the user's request, batched; the template's fixed text is pre-tokenized.
+    """
+    with timed("tokenize"):
+        ids = [None] * len(prompts)
+        prefix_lens = [None] * len(prompts)
+        for template in TEMPLATES:
+            rows = [(i, template.user_part(p)) for i, p in enumerate(prompts) if ids[i] is None]
+            rows = [(i, user) for i, user in rows if user is not None]
+            if not rows:
+                continue
+            for (i, _), row_ids in zip(rows, template.encode(tokenizer, [user for _, user in rows])):
+                ids[i] = row_ids
+                prefix_lens[i] = template.prefix_tokens(tokenizer)
+        rest = [i for i, row_ids in enumerate(ids) if row_ids is None]
+        if rest:
+            for i, row_ids in zip(rest, tokenizer([prompts[i] for i in rest]).input_ids):
+                ids[i] = row_ids
+    return ids, prefix_lens
+
+def _suffix_ids(tokenizer, prompts, prefix, prefix_len, ids, prefix_lens):
+    """Per-prompt ids after a cached `prefix_len`-token prefix, reusing _encode output where it lines up."""
+    suffixes = [row[prefix_len:] if n == prefix_len else None for row, n in zip(ids, prefix_lens)]
+    slow = [i for i, row in enumerate(suffixes) if row is None]
+    if slow:
+        with timed("tokenize"):
+            extra = tokenizer([prompts[i][len(prefix):] for i in slow], add_special_tokens=False).input_ids
+        for i, row in zip(slow, extra):
+            suffixes[i] = row
+    return suffixes
+
+def _prepare_inputs(tokenizer, model, prompt):
+    """Tokenize a prompt, reusing the prefilled KV cache when it starts with a known prefix."""
+    import torch
+
+    ids, prefix_lens = _encode(tokenizer, [prompt])
+    prefix = _prefix_cache.match(prompt)
+    if prefix is None:
+        input_ids = torch.tensor(ids, device=model.device)
+        return dict(input_ids=input_ids, attention_mask=torch.ones_like(input_ids))
+
+    prefix_ids, past = _prefix_cache.get(tokenizer, model, prefix)
+    suffix = _suffix_ids(tokenizer, [prompt], prefix, prefix_ids.shape[1], ids, prefix_lens)
+    input_ids = torch.cat([prefix_ids, torch.tensor(suffix, device=model.device)], dim=1)
+    return dict(input_ids=input_ids, attention_mask=torch.ones_like(input_ids), past_key_values=past)
+
+def _prepare_batch_inputs(tokenizer, model, prompts):
+    """
+    Left-padded batch inputs. When every prompt shares one cached prefix, the
+    padding goes between prefix and suffix instead, so the prefix cache can be
+    repeated across the batch and only the suffixes are prefilled.
+    """
+    import torch
+
+    ids, prefix_lens = _encode(tokenizer, prompts)
+    prefix = _prefix_cache.match(prompts[0])
+    if prefix is None or any(not p.startswith(prefix) for p in prompts):
+        width = max(len(row) for row in ids)
+        return dict(
+            input_ids=torch.tensor([[tokenizer.pad_token_id] * (width - len(row)) + row for row in ids], device=model.device),
+            attention_mask=torch.tensor([[0] * (width - len(row)) + [1] * len(row) for row in ids], device=model.device),
+        )
+
+    prefix_ids, past = _prefix_cache.get(tokenizer, model, prefix)
+    suffixes = _suffix_ids(tokenizer, prompts, prefix, prefix_ids.shape[1], ids, prefix_lens)
+    return _mid_padded(tokenizer, model, prefix_ids, past, suffixes)
+
+def _mid_padded(tokenizer, model, prefix_ids, past, suffixes):
+    """
+    Batch inputs of one shared prefix (already in `past`) followed by per-row
+    suffix token ids, padded between the two. The cache is repeated across rows.
+    """
+    import torch
+
+    width = max(len(ids) for ids in suffixes)
+    rows, masks = [], []
+    for ids in suffixes:
+        pad = width - len(ids)
+        rows.append([tokenizer.pad_token_id] * pad + ids)
+        masks.append([0] * pad + [1] * len(ids))
+
+    n = len(suffixes)
+    input_ids = torch.cat([prefix_ids.repeat(n, 1), torch.tensor(rows, device=model.device)], dim=1)
+    attention_mask = torch.cat([
+        torch.ones_like(prefix_ids).repeat(n, 1),
+        torch.tensor(masks, device=model.device)
+    ], dim=1)
+    past.batch_repeat_interleave(n)
+    return dict(input_ids=input_ids, attention_mask=attention_mask, past_key_values=past)
+
+
+response_cache = ResponseCache(
+    RESPONSE_CACHE_PATH,
+    max_bytes=int(RESPONSE_CACHE_MAX_MB * 1024 * 1024),
+    max_age=RESPONSE_CACHE_MAX_AGE_DAYS * 24 * 3600
+) if RESPONSE_CACHE_PATH and not LLM_SERVER_URL else None  # the server keeps its own
+
+_fingerprint = None
+
+def model_fingerprint():
+    """Identifies the backend and the weights/adapter on disk without loading them."""
+    global _fingerprint
+    if _fingerprint is None:
+        _fingerprint = f"{get_handle().backend.describe()}:{fingerprint_files(MODEL_PATH)}"
+    return _fingerprint
+
+def _cache_key(prompt, max_new_tokens):
+    params = {
+        "max_new_tokens": max_new_tokens, "stop_at": TEST_END,
+        "constrained": CONSTRAINED_DECODING, "pipeline": SECTION_PIPELINE,
+    }
+    return ResponseCache.make_key(prompt, params, model_fingerprint())
+
+def lookup_cached(prompt, max_new_tokens=None):
+    """Cached {'response', 'sections'} for this prompt, or None. Never touches the model."""
+    if response_cache is None:
+        return None
+    return response_cache.get(_cache_key(prompt, max_new_tokens))
+
+def store_response(prompt, response, sections=None, max_new_tokens=None):
+    """Remember a finished response (and optionally its parse_response sections)."""
+    if response_cache is not None:
+        response_cache.put(_cache_key(prompt, max_new_tokens), response, sections)
+
+
+token_budget = TokenBudget(
+    BUDGET_HISTORY_PATH or None, default=DEFAULT_MAX_NEW_TOKENS, maximum=BUDGET_MAX
+) if ADAPTIVE_BUDGET and not LLM_SERVER_URL else None  # the server predicts its own
+
+def resolve_budget(prompt, max_new_tokens=None):
+    """
+    (max_new_tokens, limit) for a request. An explicit max_new_tokens is a hard
+    cap; otherwise the budget is predicted and may be continued up to `limit`.
+    """
+    if max_new_tokens is not None:
+        return max_new_tokens, None
+    if token_budget is None:
+        return DEFAULT_MAX_NEW_TOKENS, None
+    return token_budget.predict(prompt), BUDGET_MAX
+
+def _learn(tokenizer, prompt, text, cancel=None):
+    """Log a finished response's real length for future budget predictions."""
+    if token_budget is None or (cancel is not None and cancel.stopped()):
+        return  # a cancelled or timed-out response says nothing about the length needed
+    new_tokens = len(tokenizer(text, add_special_tokens=False).input_ids)
+    token_budget.record(prompt, text, new_tokens, truncated=not is_complete(text))
+
+
+# Running totals across requests, per speculative mode
+_decode_totals = {}
+_decode_lock = Lock()
+
+def _speculative_kwargs(mode):
+    if mode == "prompt_lookup":
+        # n-gram drafting from the prompt and the text generated so far
+        # (ANNOTATED CODE largely repeats CODE, so long spans get accepted)
+        return {"prompt_lookup_num_tokens": PROMPT_LOOKUP_TOKENS}
+    if mode == "draft":
+        return {"assistant_model": get_handle().draft()}
+    if mode not in (None, "off"):
+        raise ValueError(f"Unknown speculative mode {mode!r}")
+    return {}
+
+def _record_decode(mode, stats):
+    with _decode_lock:
+        totals = _decode_totals.setdefault(mode, dict.fromkeys(
+            ("requests", "new_tokens", "target_forwards", "proposed_tokens", "accepted_tokens",
+             "prefill_seconds", "decode_seconds"), 0
+        ))
+        totals["requests"] += 1
+        for key in ("new_tokens", "target_forwards", "proposed_tokens", "accepted_tokens", "prefill_seconds"):
+            totals[key] += stats[key]
+        if stats["decode_tokens_per_sec"]:
+            totals["decode_seconds"] += (stats["new_tokens"] - 1) / stats["decode_tokens_per_sec"]
+    print(
+        f"[INFO] decode[{mode}] {stats['new_tokens']} tokens, "
+        f"{stats['decode_tokens_per_sec']:.1f} tok/s, acceptance {stats['acceptance_rate']:.0%}"
+    )
+
+def speculation_stats():
+    """Aggregate acceptance rate and decode throughput per speculative mode."""
+    with _decode_lock:
+        report = {}
+        for mode, t in _decode_totals.items():
+            report[mode] = dict(
+                t,
+                acceptance_rate=t["accepted_tokens"] / t["proposed_tokens"] if t["proposed_tokens"] else 0.0,
+                tokens_per_forward=t["new_tokens"] / t["target_forwards"] if t["target_forwards"] else 0.0,
+                decode_tokens_per_sec=(t["new_tokens"] - t["requests"]) / t["decode_seconds"] if t["decode_seconds"] else 0.0,
+            )
+        return report
 
-def generate_response(prompt, max_new_tokens=1024):
-    inputs = tokenizer(prompt, return_tensors="pt").to("cuda")
-    output = model.generate(**inputs, max_new_tokens=max_new_tokens)
-    text = tokenizer.decode(output[0], skip_special_tokens=True)
+def _generate_extending(tokenizer, model, inputs, max_new_tokens, controls, cancels=None, sinks=None, limits=None,
+                        **kwargs):
+    """
+    model.generate under section `controls`, continuing rows that use up
+    max_new_tokens before their final marker: they resume from the KV cache the
+    call left behind (nothing is re-prefilled or regenerated) in BUDGET_EXTEND
+    steps, up to `limits[row]` new tokens. Returns (new token ids per row,
+    {section: tokens} per row).
+    """
+    import torch
+    from utils.generation import resume_controls, row_done, section_token_counts
+
+    n = inputs["input_ids"].shape[0]
+    limits = limits or [None] * n
+    cancels = cancels or [None] * n
+    finished_ids = {t for t in (tokenizer.eos_token_id, tokenizer.pad_token_id) if t is not None}
+
+    streamer = _RowStreamer(tokenizer, sinks) if sinks and any(sinks) else None
+    out = model.generate(
+        **inputs, max_new_tokens=max_new_tokens, streamer=streamer, return_dict_in_generate=True,
+        **controls, **kwargs
+    )
+    start = inputs["input_ids"].shape[1]
+    new_ids = list(out.sequences[:, start:])
+    sections = section_token_counts(controls)
+    rows = list(range(n))  # original index of each row in the latest call
+    sequences, past, mask, step = out.sequences, out.past_key_values, inputs["attention_mask"], max_new_tokens
+
+    while sequences.shape[1] - start >= step:  # otherwise every row stopped on its own
+        keep = [
+            j for j, row in enumerate(rows)
+            if limits[row] and len(new_ids[row]) < limits[row]
+            and not row_done(controls, j)
+            and not (cancels[row] is not None and cancels[row].stopped())
+            and not finished_ids.intersection(sequences[j, start:].tolist())
+        ]
+        if not keep:
+            break
+        rows = [rows[j] for j in keep]
+        index = torch.tensor(keep, device=sequences.device)
+        past.batch_select_indices(index)
+        sequences = sequences[index]
+        mask = mask[index]
+        mask = torch.cat([mask, mask.new_ones(len(keep), sequences.shape[1] - mask.shape[1])], dim=1)
+        controls = resume_controls(controls, keep, [cancels[row] for row in rows])
+        step = min(BUDGET_EXTEND, min(limits[row] - len(new_ids[row]) for row in rows))
+        print(f"[INFO] {len(rows)} row(s) used their token budget; continuing for up to {step} more tokens")
+
+        start = sequences.shape[1]
+        row_sinks = [sinks[row] for row in rows] if sinks else None
+        streamer = _RowStreamer(tokenizer, row_sinks) if row_sinks and any(row_sinks) else None
+        out = model.generate(
+            input_ids=sequences, attention_mask=mask, past_key_values=past, max_new_tokens=step,
+            streamer=streamer, return_dict_in_generate=True, **controls, **kwargs
+        )
+        sequences, past = out.sequences, out.past_key_values
+        for j, (row, counts) in enumerate(zip(rows, section_token_counts(controls))):
+            new_ids[row] = torch.cat([new_ids[row], sequences[j, start:]])
+            sections[row] = counts
+    return new_ids, sections
+
+def _generate_one(tokenizer, model, inputs, max_new_tokens, sink=None, speculative=None, final_marker=TEST_END,
+                  cancel=None, limit=None):
+    """Single-prompt generate with section controls, speculation and metrics; returns new token ids."""
+    from utils.generation import DecodeMeter, section_controls
+
+    mode = speculative or SPECULATIVE
+    past = inputs.get("past_key_values")
+    prompt_len = inputs["input_ids"].shape[1]
+    prefill_len = prompt_len - (past.get_seq_length() if past is not None else 0)
+
+    controls = section_controls(
+        tokenizer, 1, constrained=CONSTRAINED_DECODING, final_marker=final_marker, cancels=[cancel]
+    )
+    with DecodeMeter(model, prefill_len) as meter:
+        (new_ids,), sections = _generate_extending(
+            tokenizer, model, inputs, max_new_tokens, controls, [cancel], [sink], [limit],
+            **_speculative_kwargs(mode)
+        )
+    stats = meter.stats(len(new_ids))
+    _record_decode(mode, stats)
+    record_generation(
+        [prompt_len], [len(new_ids)], stats["prefill_seconds"], stats["decode_seconds"],
+        sections, mode=mode, cached_prompt_tokens=prompt_len - prefill_len
+    )
+    return new_ids
+
+def _record_batch(tokenizer, inputs, cached, new_ids, meter, sections, **fields):
+    """
+    Telemetry for a batched generate: real (unpadded) prompt and new tokens per
+    row. `cached` is how many leading positions a KV cache covered beforehand.
+    """
+    prompt_tokens = [cached + int(n) for n in inputs["attention_mask"][:, cached:].sum(dim=1).tolist()]
+    new_tokens = [int((ids != tokenizer.pad_token_id).sum()) for ids in new_ids]
+    stats = meter.stats(max(len(ids) for ids in new_ids) if new_ids else 0)
+    record_generation(
+        prompt_tokens, new_tokens, stats["prefill_seconds"], stats["decode_seconds"],
+        sections, cached_prompt_tokens=cached, **fields
+    )
+
+
+_client = None
+_client_lock = Lock()
+
+def server_client():
+    """Pooled client for LLM_SERVER_URL, or None when inference runs in this process."""
+    global _client
+    if not LLM_SERVER_URL:
+        return None
+    with _client_lock:
+        if _client is None:
+            from utils.client import InferenceClient
+            _client = InferenceClient(LLM_SERVER_URL)
+        return _client
+
+
+def generate_response(prompt, max_new_tokens=None, speculative=None):
+    """Full response text. Without max_new_tokens the budget is predicted (see resolve_budget)."""
+    if LLM_SERVER_URL:
+        return server_client().generate(prompt, max_new_tokens)
+    cached = lookup_cached(prompt, max_new_tokens)
+    if cached:
+        return cached["response"]
+
+    budget, limit = resolve_budget(prompt, max_new_tokens)
+    tokenizer, model = get_handle().get()
+    if SECTION_PIPELINE == "fanout":
+        text = generate_fanout(prompt, budget, speculative=speculative, limit=limit)
+    else:
+        inputs = _prepare_inputs(tokenizer, model, prompt)
+        new_ids = _generate_one(tokenizer, model, inputs, budget, speculative=speculative, limit=limit)
+        # Decode only the new tokens, so callers never see the prompt echoed back
+        text = tokenizer.decode(new_ids, skip_special_tokens=True)
+    _learn(tokenizer, prompt, text)
+    if is_complete(text):  # only cache answers that were not cut short
+        store_response(prompt, text, max_new_tokens=max_new_tokens)
     return text
+
+def stream_response(prompt, max_new_tokens=None, speculative=None):
+    """
+    Same generation as generate_response, but yields decoded text chunks as
+    soon as the model produces them. The prompt itself is not echoed.
+    """
+    if LLM_SERVER_URL:
+        yield from server_client().stream(prompt, max_new_tokens)
+        return
+    cached = lookup_cached(prompt, max_new_tokens)
+    if cached:
+        yield cached["response"]
+        return
+
+    budget, limit = resolve_budget(prompt, max_new_tokens)
+    tokenizer, model = get_handle().get()
+    pending = queue.Queue()
+    errors = []
+    cancel = CancelToken()
+
+    def run():
+        try:
+            if SECTION_PIPELINE == "fanout":
+                generate_fanout(
+                    prompt, budget, sink=pending.put, speculative=speculative, cancel=cancel, limit=limit
+                )
+            else:
+                inputs = _prepare_inputs(tokenizer, model, prompt)
+                _generate_one(
+                    tokenizer, model, inputs, budget,
+                    sink=pending.put, speculative=speculative, cancel=cancel, limit=limit
+                )
+        except Exception as e:
+            errors.append(e)
+        finally:
+            pending.put(None)  # unblock the consumer loop below
+
+    worker = Thread(target=run, daemon=True)
+    worker.start()
+    chunks = []
+    try:
+        for chunk in iter(pending.get, None):
+            chunks.append(chunk)
+            yield chunk
+    finally:
+        # A consumer that stops early (closed generator, error) frees the model at the next step
+        cancel.cancel()
+    worker.join()
+    if errors:
+        raise errors[0]
+    response = "".join(chunks)
+    _learn(tokenizer, prompt, response)
+    if is_complete(response):  # only cache answers that were not cut short
+        store_response(prompt, response, max_new_tokens=max_new_tokens)
+
+
+class _RowStreamer:
+    """
+    Fans the tokens of a batched generate out to one text callback per row.
+    Implements the put/end protocol of transformers' BaseStreamer.
+    """
+
+    def __init__(self, tokenizer, sinks):
+        self.tokenizer = tokenizer
+        self.sinks = sinks
+        self.tokens = [[] for _ in sinks]
+        self.printed = [0] * len(sinks)
+        self.prompt_seen = False
+
+    def put(self, value):
+        # The first call carries the (padded) prompt ids, which are not streamed
+        if not self.prompt_seen:
+            self.prompt_seen = True
+            return
+        # One token per row per step, or (assisted decoding) several accepted at once
+        rows = value.tolist()
+        if value.dim() == 1:
+            rows = [[token] for token in rows]
+        for row, tokens in enumerate(rows):
+            self.tokens[row].extend(tokens)
+            self._emit(row, final=False)
+
+    def end(self):
+        for row in range(len(self.sinks)):
+            self._emit(row, final=True)
+
+    def _emit(self, row, final):
+        if self.sinks[row] is None:
+            return
+        text = self.tokenizer.decode(self.tokens[row], skip_special_tokens=True)
+        # Wait for the rest of a multi-byte character before flushing
+        if text.endswith("\ufffd") and not final:
+            return
+        delta = text[self.printed[row]:]
+        if text.endswith("\n") or final:
+            # Restart the decode window at line boundaries to keep re-decoding cheap
+            self.tokens[row] = []
+            self.printed[row] = 0
+        else:
+            self.printed[row] = len(text)
+        if delta:
+            self.sinks[row](delta)
+
+
+def count_tokens(prompt):
+    tokenizer, _ = get_handle().get()
+    return len(_encode(tokenizer, [prompt])[0][0])
+
+def generate_batch(prompts, max_new_tokens=1024, sinks=None, cancels=None, limits=None):
+    """
+    Runs one batched generate over several prompts (left-padded) and returns one
+    decoded text per prompt, in the same form as generate_response.
+    `sinks` optionally holds a chunk callback per prompt for streaming, and
+    `cancels` a CancelToken per prompt; a cancelled row stops at the next step.
+    `limits` lets a row that uses up max_new_tokens continue to that many.
+    """
+    from utils.generation import DecodeMeter, section_controls
+
+    tokenizer, model = get_handle().get()
+    sinks = sinks or [None] * len(prompts)
+    cancels = cancels or [None] * len(prompts)
+    limits = limits or [None] * len(prompts)
+    if len(prompts) == 1 and SECTION_PIPELINE == "fanout":
+        # A lone request fans its own sections out across the batch instead
+        texts = [generate_fanout(prompts[0], max_new_tokens, sink=sinks[0], cancel=cancels[0], limit=limits[0])]
+    elif len(prompts) == 1 and SPECULATIVE != "off":
+        # Assisted generation is single-sequence only; a lone request can still use it
+        inputs = _prepare_inputs(tokenizer, model, prompts[0])
+        new_ids = _generate_one(
+            tokenizer, model, inputs, max_new_tokens, sink=sinks[0], cancel=cancels[0], limit=limits[0]
+        )
+        texts = [tokenizer.decode(new_ids, skip_special_tokens=True)]
+    else:
+        if tokenizer.pad_token is None:
+            tokenizer.pad_token = tokenizer.eos_token
+        tokenizer.padding_side = "left"
+
+        inputs = _prepare_batch_inputs(tokenizer, model, list(prompts))
+        controls = section_controls(tokenizer, len(prompts), constrained=CONSTRAINED_DECODING, cancels=cancels)
+        past = inputs.get("past_key_values")
+        cached = past.get_seq_length() if past is not None else 0
+        with DecodeMeter(model, inputs["input_ids"].shape[1] - cached) as meter:
+            new_ids, sections = _generate_extending(
+                tokenizer, model, inputs, max_new_tokens, controls, cancels, sinks, limits,
+                pad_token_id=tokenizer.pad_token_id
+            )
+        _record_batch(tokenizer, inputs, cached, new_ids, meter, sections, mode="batch")
+        texts = [tokenizer.decode(ids, skip_special_tokens=True) for ids in new_ids]
+
+    for prompt, text, cancel in zip(prompts, texts, cancels):
+        _learn(tokenizer, prompt, text, cancel)
+    return texts
+
+# ---------- Async API ----------
+def stream_cancellable(prompt, max_new_tokens, cancel, priority="interactive", client=None):
+    """
+    Chunk stream behind the async API and server.py; stops as soon as `cancel`
+    does. `priority` ('interactive' | 'batch') and `client` feed the scheduler.
+    """
+    if LLM_SERVER_URL:
+        # The server enforces the deadline; a cancel closes the connection, which
+        # the server notices on its next write
+        stream = server_client().stream(
+            prompt, max_new_tokens, timeout=cancel.remaining(), priority=priority, client=client
+        )
+        for chunk in stream:
+            if cancel.cancelled:
+                return
+            yield chunk
+        return
+
+    cached = lookup_cached(prompt, max_new_tokens)
+    if cached:
+        yield cached["response"]
+        return
+    budget, limit = resolve_budget(prompt, max_new_tokens)
+    chunks = []
+    stream = shared_batcher().stream(prompt, budget, cancel=cancel, priority=priority, client=client, limit=limit)
+    for chunk in stream:
+        chunks.append(chunk)
+        yield chunk
+    response = "".join(chunks)
+    if is_complete(response):  # only cache answers that were not cut short
+        store_response(prompt, response, max_new_tokens=max_new_tokens)
+
+async def stream_response_async(prompt, max_new_tokens=None, timeout=None, priority="interactive", client=None):
+    """
+    asyncio version of stream_response, routed through the shared batcher.
+    Cancelling the consuming task or closing this generator early stops the
+    request's row between decode steps. With `timeout` (seconds) the stream
+    simply ends at the deadline, so callers keep the sections completed so far.
+    Raises utils.scheduler.Overloaded / QueueTimeout when admission control
+    turns the request away.
+    """
+    loop = asyncio.get_running_loop()
+    cancel = CancelToken(timeout)
+    chunks = asyncio.Queue()
+    done = object()
+
+    def deliver(item):
+        try:
+            loop.call_soon_threadsafe(chunks.put_nowait, item)
+        except RuntimeError:
+            cancel.cancel()  # the event loop is gone: nobody is listening any more
+
+    def run():
+        try:
+            for chunk in stream_cancellable(prompt, max_new_tokens, cancel, priority, client):
+                deliver(chunk)
+        except Exception as e:
+            deliver(e)
+        finally:
+            deliver(done)
+
+    # A plain thread, not run_in_executor: asyncio.run would wait on abandoned work at exit
+    Thread(target=run, name="generate-async", daemon=True).start()
+    try:
+        while True:
+            item = await chunks.get()
+            if item is done:
+                break
+            if isinstance(item, Exception):
+                raise item
+            yield item
+    finally:
+        cancel.cancel()  # no-op once generation has finished
+
+async def generate_response_async(prompt, max_new_tokens=None, timeout=None, priority="interactive", client=None):
+    """
+    Await a full response. Returns {'response', 'sections', 'status'} where
+    status is 'complete', 'deadline' (timeout hit: sections holds only those
+    finished in time) or 'truncated' (token budget ran out).
+    """
+    started = time.monotonic()
+    chunks = []
+    async for chunk in stream_response_async(prompt, max_new_tokens, timeout, priority, client):
+        chunks.append(chunk)
+    response = "".join(chunks)
+    if is_complete(response):
+        status = "complete"
+    elif timeout and time.monotonic() - started >= timeout:
+        status = "deadline"
+    else:
+        status = "truncated"
+    return {"response": response, "sections": parse_response(response), "status": status}
+
+
+# ---------- Section fan-out ----------
+# Once CODE exists these depend only on it, so they decode side by side
+FANOUT_SECTIONS = ('visualization', 'annotated', 'complexity', 'test_cases')
+if AST_FLOWCHART:
+    FANOUT_SECTIONS = FANOUT_SECTIONS[1:]  # drawn from the code by utils.flowchart
+
+def _prefill(model, input_ids, past=None):
+    """Extend `past` (or a fresh cache) over the tokens of input_ids it does not cover yet."""
+    import torch
+
+    done = past.get_seq_length() if past is not None else 0
+    with torch.no_grad():
+        return model(input_ids=input_ids[:, done:], past_key_values=past, use_cache=True).past_key_values
+
+def generate_fanout(prompt, max_new_tokens=1024, sink=None, speculative=None, cancel=None, limit=None):
+    """
+    Pipeline mode: generate METADATA and CODE, stopping at ===END CODE===, then
+    every section in FANOUT_SECTIONS as its own row of one batched generate.
+    The rows share the prompt+code prefix, which is prefilled once and repeated
+    across the batch. Returns a response in the usual ===SECTION=== layout, so
+    parse_response reads it unchanged.
+
+    `sink` optionally receives text chunks: METADATA/CODE as they stream, the
+    fanned-out sections once the batch finishes. With `limit`, the head and
+    each section row may continue past max_new_tokens up to that many tokens.
+    """
+    import torch
+    from utils.generation import DecodeMeter, section_controls
+
+    tokenizer, model = get_handle().get()
+    if tokenizer.pad_token is None:
+        tokenizer.pad_token = tokenizer.eos_token
+
+    inputs = _prepare_inputs(tokenizer, model, prompt)
+    head_ids = _generate_one(
+        tokenizer, model, inputs, max_new_tokens,
+        sink=sink, speculative=speculative, final_marker=CODE_END, cancel=cancel, limit=limit
+    )
+    head = tokenizer.decode(head_ids, skip_special_tokens=True)
+    budget = max_new_tokens - len(head_ids)
+    room = (limit or max_new_tokens) - len(head_ids)
+    if budget <= 0 < room:
+        budget = min(BUDGET_EXTEND, room)  # the head ran over its budget but may still continue
+    if cancel is not None and cancel.stopped():
+        return head
+    if CODE_END.upper() not in head.upper() or budget <= 0:
+        print("[WARN] No ===END CODE=== within budget; skipping section fan-out")
+        return head
+
+    # The head's generate extended the prefix cache in place; keep only the
+    # positions that belong to prompt + head and prefill whatever is missing
+    prefix_ids = torch.cat([inputs["input_ids"], head_ids.unsqueeze(0)], dim=1)
+    past = inputs.get("past_key_values")
+    if past is not None:
+        past.crop(min(past.get_seq_length(), prefix_ids.shape[1]))
+    past = _prefill(model, prefix_ids, past)
+
+    starts = {key: (start, end) for key, start, end in SECTIONS}
+    suffixes = [
+        tokenizer("\n\n" + starts[key][0] + "\n", add_special_tokens=False).input_ids
+        for key in FANOUT_SECTIONS
+    ]
+    batch = _mid_padded(tokenizer, model, prefix_ids, past, suffixes)
+    controls = section_controls(
+        tokenizer, len(FANOUT_SECTIONS), constrained=CONSTRAINED_DECODING,
+        final_marker=[starts[key][1] for key in FANOUT_SECTIONS], open_sections=FANOUT_SECTIONS,
+        cancels=[cancel] * len(FANOUT_SECTIONS)
+    )
+    started = time.perf_counter()
+    rows = len(FANOUT_SECTIONS)
+    with DecodeMeter(model, batch["input_ids"].shape[1] - prefix_ids.shape[1]) as meter:
+        new_ids, sections = _generate_extending(
+            tokenizer, model, batch, budget, controls, [cancel] * rows, limits=[room if limit else None] * rows,
+            pad_token_id=tokenizer.pad_token_id
+        )
+    _record_batch(tokenizer, batch, prefix_ids.shape[1], new_ids, meter, sections, mode="fanout")
+    print(f"[INFO] Fanned out {rows} sections in {time.perf_counter() - started:.2f} s")
+
+    parts = []
+    for key, row_ids in zip(FANOUT_SECTIONS, new_ids):
+        start, end = starts[key]
+        body = tokenizer.decode(row_ids, skip_special_tokens=True)
+        cut = body.upper().find(end.upper())
+        body = body[:cut + len(end)] if cut != -1 else body.rstrip() + "\n" + end
+        parts.append(start + "\n" + body)
+    rest = "\n\n" + "\n\n".join(parts)
+    if sink:
+        sink(rest)
+    return head + rest
+
+
+# Shared across Streamlit sessions so concurrent requests are batched, not raced
+_batcher = None
+_batcher_lock = Lock()
+
+def shared_batcher():
+    global _batcher
+    with _batcher_lock:
+        if _batcher is None:
+            scheduler = AdmissionQueue(
+                max_depth=QUEUE_MAX_DEPTH,
+                max_wait={INTERACTIVE: QUEUE_MAX_WAIT_INTERACTIVE, BATCH: QUEUE_MAX_WAIT_BATCH},
+                degrade_at=QUEUE_DEGRADE_AT,
+                min_new_tokens=QUEUE_MIN_NEW_TOKENS,
+            )
+            _batcher = MicroBatcher(
+                generate_batch, length_fn=count_tokens, scheduler=scheduler, max_batch_tokens=BATCH_MAX_TOKENS or None
+            )
+        return _batcher
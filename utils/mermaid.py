@@ -0,0 +1,492 @@
+# utils/mermaid.py
+"""
+Graph IR for Mermaid flowcharts, and a single-pass parser that builds it
+from messy LLM output.
+
+parse_mermaid() reads the source once, statement by statement. It keeps
+node IDs, shapes, labels, edge labels, arrow kinds, subgraphs and every
+branch, and repairs the usual LLM slips along the way:
+- code fences and "mermaid version" noise;
+- labels split across lines, and arrows left dangling at the end of a line;
+- `->` written for `-->`;
+- label-only nodes (`[Start] --> [Read input]`) and bare text nodes;
+- IDs Mermaid rejects (`end`, non-ASCII, punctuation);
+- duplicate declarations and edges.
+Graph.to_mermaid() prints the clean diagram. Both are linear in the input size.
+"""
+import re
+import unicodedata
+
+DIRECTIONS = ("TD", "TB", "LR", "RL", "BT")
+
+# Node shapes as (opener, closers), longest openers first
+SHAPES = (
+    ("(((", (")))",)), ("((", ("))",)), ("([", ("])",)), ("[[", ("]]",)), ("[(", (")]",)),
+    ("[/", ("/]", "\\]")), ("[\\", ("\\]", "/]")), ("{{", ("}}",)),
+    ("[", ("]",)), ("(", (")",)), ("{", ("}",)), (">", ("]",)),
+)
+DEFAULT_SHAPE = ("[", "]")
+_SHAPES_BY_CHAR = {}
+for _opener, _closers in SHAPES:
+    _SHAPES_BY_CHAR.setdefault(_opener[0], []).append((_opener, _closers))
+
+# Words Mermaid treats as keywords when used as a node ID
+RESERVED_IDS = {"end", "graph", "flowchart", "subgraph", "style", "class", "classDef", "click", "linkStyle",
+                "direction", "default"}
+
+_HEADER = re.compile(r"[ \t]*(?:flowchart|graph)(?:[ \t]+(TD|TB|LR|RL|BT)\b|[ \t]*(?=;|$))[ \t]*;?", re.IGNORECASE)
+_DROPPED = re.compile(r"[ \t]*(?:classDef|class|style|linkStyle|click|direction)\b", re.IGNORECASE)
+_NOISE = re.compile(r"```\w*|mermaid\s+version\s+[0-9.]+|%%.*", re.IGNORECASE)
+_SUBGRAPH = re.compile(r"[ \t]*subgraph\b[ \t]*(.*)$", re.IGNORECASE)
+_SUBGRAPH_TITLED = re.compile(r"([A-Za-z0-9_]+)[ \t]*\[(.*)\][ \t]*$")
+_END = re.compile(r"[ \t]*end[ \t]*;?[ \t]*$")
+_ID = re.compile(r"\w+")
+_SAFE_ID = re.compile(r"[A-Za-z0-9_]+")
+_UNSAFE = re.compile(r"[^A-Za-z0-9_]+")
+# Links: -->, --->, --o, --x, ---, ==>, ===, -.->, -.-, <-->, and the common slip ->
+_LINK = re.compile(r"(<?)(-{2,}>|-{2,}[ox](?!\w)|-{3,}|={2,}>|={3,}|-\.+->|-\.+-|->)")
+# Links with text in the middle: -- text -->, == text ==>, -. text .->
+_TEXT_LINK = re.compile(r"(<?)(--|==|-\.)[ \t]+([^\n]{1,80}?)[ \t]*(-{2,}>|={2,}>|\.-+>|-{3,}|={3,}|\.-)")
+_EDGE_LABEL = re.compile(r"[ \t]*\|([^|\n]*)\|")
+_DANGLING = ("-->", "---", "==>", "->", "-.->", "|")
+
+
+class Node:
+    def __init__(self, id, label=None, shape=DEFAULT_SHAPE, subgraph=None):
+        self.id = id
+        self.label = label
+        self.shape = shape
+        self.subgraph = subgraph
+
+    def declaration(self):
+        if self.label is None:
+            return self.id
+        opener, closer = self.shape
+        return f'{self.id}{opener}"{self.label}"{closer}'
+
+
+class Edge:
+    def __init__(self, source, target, arrow="-->", label=None):
+        self.source = source
+        self.target = target
+        self.arrow = arrow
+        self.label = label
+
+    def line(self):
+        label = f'|"{self.label}"|' if self.label else ""
+        return f"{self.source} {self.arrow}{label} {self.target}"
+
+
+class Subgraph:
+    def __init__(self, id, title=None, parent=None):
+        self.id = id
+        self.title = title
+        self.parent = parent
+
+
+class Graph:
+    """A flowchart: nodes and subgraphs in first-seen order, deduplicated edges."""
+
+    def __init__(self, direction="TD"):
+        self.direction = direction
+        self.nodes = {}
+        self.edges = []
+        self.subgraphs = {}
+        self._edge_keys = set()
+
+    def add_node(self, id, label=None, shape=None, subgraph=None):
+        """Declare or re-reference a node; the first label and shape given win."""
+        node = self.nodes.get(id)
+        if node is None:
+            node = self.nodes[id] = Node(id, label, shape or DEFAULT_SHAPE, subgraph)
+        elif label is not None and node.label is None:
+            node.label = label
+            node.shape = shape or node.shape
+        return node
+
+    def add_edge(self, source, target, arrow="-->", label=None):
+        key = (source, target, arrow, label)
+        if key not in self._edge_keys:
+            self._edge_keys.add(key)
+            self.edges.append(Edge(source, target, arrow, label))
+
+    def to_mermaid(self):
+        lines = [f"flowchart {self.direction}"]
+        members, children = {}, {}
+        for node in self.nodes.values():
+            if node.subgraph is None:
+                lines.append(node.declaration())
+            else:
+                members.setdefault(node.subgraph, []).append(node)
+        for subgraph in self.subgraphs.values():
+            children.setdefault(subgraph.parent, []).append(subgraph)
+
+        def emit(subgraph, depth):
+            indent = "    " * depth
+            title = f' ["{subgraph.title}"]' if subgraph.title else ""
+            lines.append(f"{indent}subgraph {subgraph.id}{title}")
+            for child in children.get(subgraph.id, ()):
+                emit(child, depth + 1)
+            for node in members.get(subgraph.id, ()):
+                lines.append(f"{indent}    {node.declaration()}")
+            lines.append(f"{indent}end")
+
+        for subgraph in children.get(None, ()):
+            emit(subgraph, 0)
+        lines.extend(edge.line() for edge in self.edges)
+        return "\n".join(lines)
+
+
+# ---------- Helpers ----------
+def clean_label(label):
+    """Normalize a label for display inside quotes."""
+    if label is None:
+        return ""
+    s = " ".join(str(label).split())
+    if len(s) >= 2 and s[0] == s[-1] and s[0] in "\"'`":
+        s = s[1:-1].strip()
+    return s.replace('"', "'")
+
+
+class IdAllocator:
+    """Unique, Mermaid-safe IDs. A colliding base gets the next free `_N` suffix in O(1) amortized."""
+
+    def __init__(self):
+        self.used = set()
+        self._next = {}
+
+    @staticmethod
+    def base(text):
+        text = unicodedata.normalize("NFKD", text).encode("ascii", "ignore").decode()
+        base = _UNSAFE.sub("_", text).strip("_")[:40].rstrip("_") or "node"
+        if base[0].isdigit():
+            base = "n_" + base
+        return base + "_" if base in RESERVED_IDS else base
+
+    def take(self, text):
+        base = self.base(text)
+        if base not in self.used:
+            self.used.add(base)
+            return base
+        i = self._next.get(base, 1)
+        while f"{base}_{i}" in self.used:
+            i += 1
+        self._next[base] = i + 1
+        self.used.add(f"{base}_{i}")
+        return f"{base}_{i}"
+
+
+# ---------- Parser ----------
+def _bracket_depth(line, depth):
+    if '"' not in line:
+        return depth + sum(map(line.count, "[({")) - sum(map(line.count, "])}"))
+    quoted = False
+    for ch in line:
+        if ch == '"':
+            quoted = not quoted
+        elif not quoted:
+            if ch in "[({":
+                depth += 1
+            elif ch in "])}":
+                depth -= 1
+    return depth
+
+def _logical_lines(text):
+    """Lines with split labels and dangling arrows joined back (at most 3 physical lines each)."""
+    pending, depth = [], 0
+    for raw in text.splitlines():
+        line = raw.strip()
+        if not line:
+            continue
+        pending.append(line)
+        depth = _bracket_depth(line, depth)
+        if (depth > 0 or line.endswith(_DANGLING)) and len(pending) < 3:
+            continue
+        yield " ".join(pending)
+        pending, depth = [], 0
+    if pending:
+        yield " ".join(pending)
+
+
+class _Parser:
+    def __init__(self):
+        self.graph = Graph()
+        self.ids = IdAllocator()
+        self.explicit = {}  # ID as written -> safe ID
+        self.by_label = {}  # label -> ID, so label-only references reuse a node
+        self.stack = []  # open subgraphs
+        self.scan = None  # _Scan of the line being read
+        self.seen_header = False
+
+    # --- statements ---
+    def line(self, line):
+        line = _NOISE.sub("", line).strip()
+        if not line or _DROPPED.match(line):
+            return
+        header = _HEADER.match(line)
+        if header:
+            if not self.seen_header and header.group(1):
+                self.graph.direction = header.group(1).upper()
+            self.seen_header = True
+            line = line[header.end():]
+            if not line.strip():
+                return
+        if _END.match(line):
+            if self.stack:
+                self.stack.pop()
+            return
+        subgraph = _SUBGRAPH.match(line)
+        if subgraph:
+            self.open_subgraph(subgraph.group(1).strip())
+            return
+        if not _LINK.search(line) and not any(ch in line for ch in "[({") and not _SAFE_ID.fullmatch(line.strip(" ;")):
+            return  # prose: no link, no shape, not a lone node ID
+        self.chain(line)
+
+    def open_subgraph(self, rest):
+        titled = _SUBGRAPH_TITLED.match(rest)
+        if titled:
+            raw, title = titled.group(1), clean_label(titled.group(2))
+        elif _SAFE_ID.fullmatch(rest):
+            raw, title = rest, None
+        else:
+            raw, title = rest or "subgraph", clean_label(rest) or None
+        sid = self.ids.take(raw)
+        self.graph.subgraphs[sid] = Subgraph(sid, title, self.stack[-1] if self.stack else None)
+        self.stack.append(sid)
+
+    def chain(self, s):
+        """`A[..] -->|x| B & C -- y --> D; E --> F`: nodes joined by links, statements split by ';'."""
+        pos, n = 0, len(s)
+        sources, link = None, None
+        self.scan = _Scan(s)
+        while pos < n:
+            pos = _skip(s, pos)
+            if pos >= n:
+                break
+            if s[pos] == ";":
+                sources, link = None, None
+                pos += 1
+                continue
+            refs, pos = self.group(s, pos)
+            if not refs:
+                # A link with no node before it (`--> B`, `A --> --> B`): skip it, keep the chain
+                dangling, after = self.link(s, pos)
+                link, pos = (dangling or link), (after if dangling else pos + 1)
+                continue
+            if sources and link:
+                for source in sources:
+                    for target in refs:
+                        self.graph.add_edge(source, target, *link)
+            sources = refs
+            # No link after a node (`A --> B C --> D` from a collapsed diagram): the next node starts a new chain
+            link, pos = self.link(s, pos)
+
+    def group(self, s, pos):
+        """`A & B & C`: one or more node references."""
+        refs = []
+        while True:
+            ref, pos = self.node(s, pos)
+            if ref is None:
+                return refs, pos
+            refs.append(ref)
+            after = _skip(s, pos)
+            if after < len(s) and s[after] == "&":
+                pos = after + 1
+            else:
+                return refs, pos
+
+    def link(self, s, pos):
+        """((arrow, label), new position) for a link at `pos`, or (None, pos)."""
+        start = _skip(s, pos)
+        text = _TEXT_LINK.match(s, start)
+        if text:
+            arrow = _arrow(text.group(1), text.group(2) + text.group(4))
+            return (arrow, clean_label(text.group(3)) or None), text.end()
+        m = _LINK.match(s, start)
+        if not m:
+            return None, pos
+        arrow, pos = _arrow(m.group(1), m.group(2)), m.end()
+        label = _EDGE_LABEL.match(s, pos)
+        if label:
+            return (arrow, clean_label(label.group(1)) or None), label.end()
+        return (arrow, None), pos
+
+    # --- nodes ---
+    def node(self, s, pos):
+        """(node ID, new position) for the node reference at `pos`, or (None, pos)."""
+        pos = _skip(s, pos)
+        if pos >= len(s) or s[pos] in ";&":
+            return None, pos
+        shaped = _shape_at(s, pos)
+        if shaped:
+            return self.labelled(None, *_read_shape(s, pos, *shaped, self.scan))
+        m = _ID.match(s, pos)
+        if m:
+            end, after = m.end(), _skip(s, m.end())
+            # `A[x]`, or `A [x]` (only the bracket shapes may be spaced off)
+            at, shaped = end, _shape_at(s, end)
+            if not shaped:
+                at, shaped = after, _shape_at(s, after, spaced=True)
+            if shaped:
+                return self.labelled(m.group(), *_read_shape(s, at, *shaped, self.scan))
+            if after >= len(s) or s[after] in ";&" or _link_at(s, after):
+                return self.named(m.group()), end
+        return self.text(s, pos)
+
+    def text(self, s, pos):
+        """Bare words up to the next link, ';' or '&' become a label-only node."""
+        i, n = pos, len(s)
+        while i < n:
+            ch = s[i]
+            if ch in ";&":
+                break
+            if ch in "-=<" and _link_at(s, i):
+                break
+            if ch in "-=":
+                # A failed run of dashes: only its last character can still start a link
+                j = i
+                while j + 1 < n and s[j + 1] == ch:
+                    j += 1
+                i = j if j > i else i + 1
+                continue
+            i += 1
+        label = clean_label(s[pos:i])
+        if not any(ch.isalnum() for ch in label):
+            return None, max(i, pos + 1)
+        if _SAFE_ID.fullmatch(label):
+            return self.named(label), i
+        return self.labelled(None, label, DEFAULT_SHAPE, i)
+
+    def named(self, raw):
+        nid = self.explicit.get(raw)
+        if nid is None:
+            nid = raw if _SAFE_ID.fullmatch(raw) and raw not in RESERVED_IDS else None
+            if nid is None or (nid in self.ids.used and nid not in self.graph.nodes):
+                nid = self.ids.take(raw)
+            else:
+                self.ids.used.add(nid)
+            self.explicit[raw] = nid
+        self.graph.add_node(nid, subgraph=self.stack[-1] if self.stack else None)
+        return nid
+
+    def labelled(self, raw, label, shape, pos):
+        label = clean_label(label)
+        if raw is not None:
+            nid = self.named(raw)
+        elif label in self.by_label:
+            nid = self.by_label[label]
+        else:
+            nid = self.ids.take(label)
+        self.graph.add_node(nid, label or None, shape, self.stack[-1] if self.stack else None)
+        self.by_label.setdefault(label, nid)
+        return nid, pos
+
+
+def _skip(s, pos):
+    n = len(s)
+    while pos < n and s[pos] in " \t":
+        pos += 1
+    return pos
+
+def _link_at(s, pos):
+    return bool(_LINK.match(s, pos) or _TEXT_LINK.match(s, pos))
+
+def _arrow(reverse, body):
+    """Canonical Mermaid link for what was written (`->` becomes `-->`, long dashes shrink)."""
+    if body == "->":
+        body = "-->"
+    elif body.startswith("--") and body.endswith(">"):
+        body = "-->"
+    elif body.startswith("==") and body.endswith(">"):
+        body = "==>"
+    elif body.startswith("-.") or body.startswith("-") and "." in body:
+        body = "-.->" if body.endswith(">") else "-.-"
+    elif set(body) == {"-"}:
+        body = "---"
+    elif set(body) == {"="}:
+        body = "==="
+    elif body[-1] in "ox":
+        body = "--" + body[-1]
+    return "<" + body if reverse and body.endswith(">") else body
+
+def _shape_at(s, pos, spaced=False):
+    for opener, closers in _SHAPES_BY_CHAR.get(s[pos:pos + 1], ()):
+        if s.startswith(opener, pos) and not (spaced and opener == ">"):
+            return opener, closers
+    return None
+
+class _Scan:
+    """
+    Forward searches over one line, remembered so that the nodes of a long
+    single-line diagram never rescan the same text: each search resumes
+    where the previous one for the same target stopped.
+    """
+
+    def __init__(self, s):
+        self.s = s
+        self._hits = {}  # target -> (searched from, first hit or -1)
+
+    def _search(self, target, start, search):
+        cached = self._hits.get(target)
+        if cached and cached[0] <= start and (cached[1] == -1 or start <= cached[1]):
+            return cached[1]
+        hit = search(start)
+        self._hits[target] = (start, hit)
+        return hit
+
+    def find(self, sub, start):
+        """str.find(sub, start) on the line."""
+        return self._search(sub, start, lambda at: self.s.find(sub, at))
+
+    def link(self, start):
+        """Where the next link at or after `start` begins, or the line's length."""
+        def search(at):
+            m = _LINK.search(self.s, at)
+            return m.start() if m else -1
+        hit = self._search(_LINK, start, search)
+        return len(self.s) if hit == -1 else hit
+
+
+def _read_shape(s, pos, opener, closers, scan):
+    """(label, (opener, closer), end) for the shape starting at `pos`; unclosed shapes run to the next link."""
+    start = pos + len(opener)
+    n = len(s)
+    if start < n and s[start] == '"':
+        quote = scan.find('"', start + 1)
+        if quote != -1:
+            after = _skip(s, quote + 1)
+            for closer in closers:
+                if s.startswith(closer, after):
+                    return s[start + 1:quote], (opener, closer), after + len(closer)
+    # The first closer, unless the label nests brackets of the same kind (`[arr[i] > 0]`)
+    ends = [(scan.find(closer, start), closer) for closer in closers]
+    end, closer = min(((end, closer) for end, closer in ends if end != -1), default=(-1, None))
+    inner_open = opener[-1] if opener[-1] in "[({" else None
+    if end != -1 and (inner_open is None or not start <= scan.find(inner_open, start) < end):
+        return s[start:end], (opener, closer), end + len(closer)
+    stop = scan.link(start)
+    if end != -1:
+        # Nested brackets: match them up to the next link, so the walks of
+        # successive nodes never overlap and a line is parsed in linear time
+        inner_close = {"[": "]", "(": ")", "{": "}"}[inner_open]
+        depth = 0
+        for i in range(start, stop):
+            if depth == 0:
+                for closer in closers:
+                    if s.startswith(closer, i):
+                        return s[start:i], (opener, closer), i + len(closer)
+            if s[i] == inner_open:
+                depth += 1
+            elif s[i] == inner_close and depth > 0:
+                depth -= 1
+    # Never closed: the label stops at the next link
+    return s[start:stop], (opener, closers[0]), stop
+
+
+def parse_mermaid(src):
+    """Graph IR for a (possibly messy) Mermaid flowchart."""
+    parser = _Parser()
+    for line in _logical_lines(str(src or "")):
+        parser.line(line)
+    return parser.graph
@@ -1,5 +1,8 @@
 import re
 
+from utils.flowchart import AST_FLOWCHART, code_flowchart
+from utils.telemetry import timed
+
 # --- Define Strict Markers (These MUST match the prompt in app.py) ---
 METADATA_START = "===METADATA==="
 METADATA_END = "===END METADATA==="
@@ -14,49 +17,113 @@ COMPLEXITY_END = "===END COMPLEXITY==="
 TEST_START = "===TEST CASES==="
 TEST_END = "===END TEST CASES==="
 
+# (key, start marker, end marker) in the order the model emits them
+SECTIONS = [
+    ('metadata', METADATA_START, METADATA_END),
+    ('code', CODE_START, CODE_END),
+    ('visualization', VIZ_START, VIZ_END),
+    ('annotated', ANNOTATED_START, ANNOTATED_END),
+    ('complexity', COMPLEXITY_START, COMPLEXITY_END),
+    ('test_cases', TEST_START, TEST_END),
+]
+_MAX_MARKER_LEN = max(len(marker) for _, start, end in SECTIONS for marker in (start, end))
 
-def parse_response(response: str):
+# All twelve markers as one case-insensitive pattern. The shared "===" prefix
+# lets the regex engine skip ahead with a literal search, and the lookahead on
+# the next letter rejects runs of "=" cheaply. Group i names _MARKER_KINDS[i - 1].
+_MARKER_KINDS = [(key, is_end) for key, _, _ in SECTIONS for is_end in (False, True)]
+_MARKER_NAMES = [marker[3:-3] for _, start, end in SECTIONS for marker in (start, end)]
+_MARKER_RE = re.compile(
+    "===(?=[" + "".join(sorted({name[0] for name in _MARKER_NAMES})) + "])(?:"
+    + "|".join(f"({re.escape(name)})" for name in _MARKER_NAMES) + ")===",
+    re.IGNORECASE
+)
+
+
+class SectionStreamParser:
     """
-    Parses the LLM's structured response into a dictionary of sections.
-    Now simplified — assumes model no longer echoes the prompt,
-    but still robust to accidental repetitions.
+    Incremental, single-pass parser for the ===SECTION=== response format.
+
+    feed() scans only the newly arrived text (plus a marker's length of
+    overlap) and returns the keys of the sections whose end marker just
+    arrived; sections() returns what parse_response would return for the
+    text so far. Total work is linear in the response length, however the
+    text is chunked.
     """
 
-    sections = {}
-
-    # --- Step 1: Remove accidental prompt echoes (if still happen) ---
-    # If the model repeated your prompt, trim before the first METADATA_START
-    if response.count(METADATA_START) > 1:
-        first = response.find(METADATA_START)
-        second = response.find(METADATA_START, first + len(METADATA_START))
-        response = response[second:].strip()
-
-    # If somehow the model included "TASK:" or similar instruction before output,
-    # this ensures we start right at the first real marker.
-    first_metadata_index = response.find(METADATA_START)
-    if first_metadata_index != -1:
-        response = response[first_metadata_index:].strip()
-
-    # --- Step 2: Helper function to extract text between markers ---
-    def extract_section(start_marker, end_marker):
-        match = re.search(
-            f'{re.escape(start_marker)}(.*?){re.escape(end_marker)}',
-            response,
-            re.DOTALL | re.IGNORECASE
-        )
-        if match:
-            return match.group(1).strip()
-        return None
-
-    # --- Step 3: Extract all sections ---
-    sections['metadata'] = extract_section(METADATA_START, METADATA_END)
-    sections['code'] = extract_section(CODE_START, CODE_END)
-    sections['visualization'] = extract_section(VIZ_START, VIZ_END)
-    sections['annotated'] = extract_section(ANNOTATED_START, ANNOTATED_END)
-    sections['complexity'] = extract_section(COMPLEXITY_START, COMPLEXITY_END)
-    sections['test_cases'] = extract_section(TEST_START, TEST_END)
-
-    # --- Step 4: Normalize content ---
+    def __init__(self):
+        self._parts = []
+        self._length = 0
+        self._tail = ""  # last _MAX_MARKER_LEN - 1 characters, where a split marker may start
+        self._scan_from = 0  # no marker starts before this position that has not been seen
+        self._origin = None  # position of the first exact METADATA_START; text before it is preamble
+        self._starts = {}  # key -> position right after its first start marker
+        self._bodies = {}  # key -> stripped text between its markers, once the end marker arrived
+        self._reported = set()  # keys feed() already returned
+
+    @property
+    def text(self):
+        """Everything fed so far."""
+        if len(self._parts) > 1:
+            self._parts = ["".join(self._parts)]
+        return self._parts[0] if self._parts else ""
+
+    def feed(self, chunk):
+        """Add a chunk of text; returns the keys of sections completed by it."""
+        if not chunk:
+            return []
+        window = self._tail + chunk
+        offset = self._length - len(self._tail)
+        self._parts.append(chunk)
+        self._length += len(chunk)
+
+        finished = []
+        pos = max(self._scan_from - offset, 0)
+        while True:
+            match = _MARKER_RE.search(window, pos)
+            if match is None:
+                break
+            key = self._hit(match, offset)
+            if key is not None and key not in self._reported:
+                self._reported.add(key)
+                finished.append(key)
+            # Markers can share their "===" edges, so look again one character on
+            pos = match.start() + 1
+            self._scan_from = offset + pos
+
+        if AST_FLOWCHART and 'code' in finished and 'visualization' not in self._reported:
+            # The prompt leaves VISUALIZATION out; it is drawn from the code instead
+            self._reported.add('visualization')
+            finished.insert(finished.index('code') + 1, 'visualization')
+
+        self._scan_from = max(self._scan_from, self._length - _MAX_MARKER_LEN + 1)
+        self._tail = window[-(_MAX_MARKER_LEN - 1):]
+        return finished
+
+    def sections(self):
+        """The parse_response dict for the text fed so far."""
+        sections = {key: self._bodies.get(key) for key, _, _ in SECTIONS}
+        return _normalize(sections)
+
+    def _hit(self, match, offset):
+        key, is_end = _MARKER_KINDS[match.lastindex - 1]
+        start, end = offset + match.start(), offset + match.end()
+        if self._origin is None and match.group() == METADATA_START:
+            # The real answer starts here; markers seen so far were preamble
+            self._origin = start
+            self._starts.clear()
+            self._bodies.clear()
+        if not is_end:
+            self._starts.setdefault(key, end)
+            return None
+        body_start = self._starts.get(key)
+        if body_start is None or key in self._bodies or start < body_start:
+            return None
+        self._bodies[key] = self.text[body_start:start].strip()
+        return key
+
+
+def _normalize(sections):
     # Metadata
     if sections['metadata']:
         metadata_dict = {}
@@ -85,4 +152,136 @@ def parse_response(response: str):
             .strip()
         )
 
+    # AST_FLOWCHART: Python code gets its exact control-flow diagram (utils.flowchart)
+    if AST_FLOWCHART and sections['code']:
+        flowchart = code_flowchart(sections['code'], sections.get('language'))
+        sections['visualization'] = flowchart or sections['visualization']
+
     return sections
+
+
+def is_complete(response):
+    """Whether a response reached its final marker, i.e. was not cut short by a budget or deadline."""
+    return TEST_END.lower() in response.lower()
+
+
+@timed("parse_response")
+def parse_response(response: str):
+    """
+    Parses the LLM's structured response into a dictionary of sections.
+    utils.llm decodes only newly generated tokens, so the prompt is never
+    echoed back and no echo stripping is needed here.
+
+    Text before the first METADATA marker (e.g. "Sure, here is...") is
+    ignored. Each section is the text between the first occurrence of its
+    start marker and the next occurrence of its end marker, matched
+    case-insensitively.
+    """
+    parser = SectionStreamParser()
+    parser.feed(response)
+    return parser.sections()
+
+
+class _SectionWatcher:
+    """Feeds streamed text to a SectionStreamParser and reports which sections just finished."""
+
+    def __init__(self):
+        self.parser = SectionStreamParser()
+
+    def feed(self, chunk):
+        finished = self.parser.feed(chunk)
+        if not finished:
+            return []
+        sections = self.parser.sections()
+        response = self.parser.text
+        return [(key, sections, response) for key in finished]
+
+    def finish(self):
+        return None, self.parser.sections(), self.parser.text
+
+
+def iter_sections(chunks):
+    """
+    Consumes streamed text chunks (e.g. from utils.llm.stream_response) and
+    yields (key, sections, response) every time a section's end marker arrives,
+    so callers can render that section without waiting for the whole answer.
+    A final (None, sections, response) is yielded once the stream is exhausted.
+    """
+    watcher = _SectionWatcher()
+    for chunk in chunks:
+        yield from watcher.feed(chunk)
+    yield watcher.finish()
+
+
+async def aiter_sections(chunks):
+    """iter_sections over an async chunk stream (e.g. utils.llm.stream_response_async)."""
+    watcher = _SectionWatcher()
+    try:
+        async for chunk in chunks:
+            for item in watcher.feed(chunk):
+                yield item
+    finally:
+        # A consumer that bails out early should stop the producer now, not at GC
+        if hasattr(chunks, "aclose"):
+            await chunks.aclose()
+    yield watcher.finish()
+
+
+# ---------- TEST CASES ----------
+_CASE_HEADER = re.compile(
+    r"^[ \t]*(?:[-*]\s*)?\**(?:test(?:\s*case)?|case|example)\s*#?\s*(\d+)\**\s*[:.)-]?[ \t]*",
+    re.IGNORECASE | re.MULTILINE
+)
+_CASE_FIELD = re.compile(r"\b(inputs?|expected(?:\s+output)?|output|returns?|result)\**\s*[:=][ \t]*", re.IGNORECASE)
+_CASE_ARROW = re.compile(r"^\s*(?:[-*]\s*|\d+[.)]\s*)?(.+?)\s*(?:->|=>|→|==|\breturns\b)\s*(.+?)\s*$", re.IGNORECASE)
+
+
+def _clean_case_text(text):
+    text = text.strip().strip("*").strip()
+    while text.endswith((",", ";", "|", "->", "=>", "→", "-")):
+        text = text.rstrip(",;|->=→").rstrip().rstrip("*").rstrip()
+    return text.strip("`").strip()
+
+
+def _case_pairs(block):
+    """(input, expected) pairs in one test case block: labelled fields, else `call -> result` lines."""
+    fields = list(_CASE_FIELD.finditer(block))
+    inputs, expected = [], []
+    for i, field in enumerate(fields):
+        value = _clean_case_text(block[field.end():fields[i + 1].start() if i + 1 < len(fields) else len(block)])
+        (inputs if field.group(1).lower().startswith("input") else expected).append(value)
+    if inputs and expected:
+        return list(zip(inputs, expected))
+    pairs = []
+    for line in block.splitlines():
+        match = _CASE_ARROW.match(line)
+        if match:
+            pairs.append((_clean_case_text(match.group(1)), _clean_case_text(match.group(2))))
+    return pairs
+
+
+def parse_test_cases(text):
+    """
+    Structured test cases from a TEST CASES section: a list of
+    {"name", "input", "expected"} dicts. Understands "Test 1: / input: /
+    output:" blocks (also "Example 2", "Expected Output:", "Returns:") and
+    one-line "add(1, 2) -> 3" cases. Free text that fits neither is skipped.
+    """
+    if not text:
+        return []
+    headers = list(_CASE_HEADER.finditer(text))
+    if headers:
+        ends = [header.start() for header in headers[1:]] + [len(text)]
+        blocks = [(f"Test {header.group(1)}", text[header.end():end]) for header, end in zip(headers, ends)]
+    else:
+        blocks = [(None, text)]
+
+    cases = []
+    for name, block in blocks:
+        pairs = _case_pairs(block)
+        for j, (given, expected) in enumerate(pairs):
+            if not given or not expected:
+                continue
+            label = name if name and len(pairs) == 1 else f"{name}.{j + 1}" if name else f"Test {len(cases) + 1}"
+            cases.append({"name": label, "input": given, "expected": expected})
+    return cases
@@ -0,0 +1,259 @@
+# utils/prompts.py
+"""
+Prompt templates shared by app.py and main.py.
+
+Each template is a fixed instruction PREFIX followed by the per-request TASK
+line. Keeping the variable part last lets utils.llm prefill the prefix once
+and reuse its KV cache for every request, and PromptTemplate tokenizes the
+fixed text once so each request only tokenizes the user's own words.
+
+With AST_FLOWCHART=1 both prefixes drop the VISUALIZATION section and its
+Mermaid rules: the diagram is drawn from the generated code (utils.flowchart).
+"""
+import re
+
+from utils.flowchart import AST_FLOWCHART
+
+# --- Streamlit UI template (app.py) ---
+APP_PREFIX = """
+Generate the mermaid syntax according to the rules
+You are an expert software engineer. Follow this format strictly:
+
+===METADATA===
+LANGUAGE: <language>
+FILENAME: <filename>
+ALGORITHM: <algorithm>
+===END METADATA===
+
+===CODE===
+```<language>
+<code>
+```
+===END CODE===
+
+===VISUALIZATION===
+```mermaid
+flowchart TD
+Start([Start]) --> Step1[Do something]
+Step1 --> End([End])
+```
+===END VISUALIZATION===
+
+===ANNOTATED CODE===
+Detailed line-by-line explanation.
+===END ANNOTATED===
+
+===COMPLEXITY===
+Time: O(n)
+Space: O(1)
+===END COMPLEXITY===
+
+===TEST CASES===
+Test 1: 
+input:
+output:
+===END TEST CASES===
+"""
+
+# --- CLI template (main.py), with strict Mermaid syntax guidelines ---
+MAIN_PREFIX = """
+You are an expert senior software engineer, code reviewer, and teacher. Respond precisely in the format requested below.
+
+OUTPUT FORMAT — Generate **only** the sections below in this exact order and format:
+
+===METADATA===
+LANGUAGE: <lowercase language, e.g. java, python, cpp>
+FILENAME: <suggested filename with extension, e.g. MaxSubsetSum.java>
+ALGORITHM: <short id, e.g. kadane | non_adjacent | sum_of_positives>
+===END METADATA===
+
+===CODE===
+```<language>
+<Complete runnable source code only. Include imports and a minimal main/test harness. No extra prose inside this fenced code block.>
+```
+===END CODE===
+
+===VISUALIZATION===
+```mermaid
+flowchart TD
+    Start([Start]) --> Step1[Step description]
+    Step1 --> Decision{Condition?}
+    Decision -->|Yes| Step2[Action if true]
+    Decision -->|No| Step3[Action if false]
+    Step2 --> End([End])
+    Step3 --> End
+```
+
+CRITICAL MERMAID RULES:
+1. ALWAYS start with "flowchart TD" on the first line
+2. Node IDs must be alphanumeric only (no spaces, no special chars except underscore)
+3. Use these shapes ONLY:
+   - Start/End: ([Text])
+   - Process: [Text]
+   - Decision: {Text}
+4. Arrow syntax: NodeA --> NodeB or NodeA -->|Label| NodeB
+5. Every node must have a unique ID
+6. All node IDs must be defined before use
+7. Keep descriptions short and clear
+8. NO line breaks inside node text
+9. Example valid nodes:
+   - Start([Begin])
+   - Init[Initialize variables]
+   - Check{Is x > 0?}
+   - End([Finish])
+
+===END VISUALIZATION===
+
+===ANNOTATED CODE===
+Provide the same code again with line numbers and a detailed step-by-step explanation of each line or logical block.
+Numbered steps must reference line numbers (e.g., "line 3: initialize sum...").
+No code fences here — explanation text only.
+===END ANNOTATED===
+
+===COMPLEXITY===
+Time: O(...)
+Space: O(...)
+===END COMPLEXITY===
+
+===TEST CASES===
+List at least 3 test inputs and expected outputs, including edge cases.
+===END TEST CASES===
+
+RULES:
+- The Mermaid diagram MUST be syntactically correct
+- Test your Mermaid syntax mentally before outputting
+- Use simple, clear node names
+- Every path must lead to an end node
+- Keep the diagram focused on main logic flow
+
+"""
+
+
+def _without_visualization(prefix):
+    """`prefix` without the VISUALIZATION section and the instructions about its Mermaid."""
+    prefix = prefix.replace("Generate the mermaid syntax according to the rules\n", "")
+    prefix = re.sub(r"===VISUALIZATION===\n.*?===END VISUALIZATION===\n\n", "", prefix, flags=re.DOTALL)
+    return re.sub(r"\nRULES:\n.*", "\n", prefix, flags=re.DOTALL)
+
+if AST_FLOWCHART:
+    APP_PREFIX = _without_visualization(APP_PREFIX)
+    MAIN_PREFIX = _without_visualization(MAIN_PREFIX)
+
+TASK_SUFFIX = "TASK: {user_prompt}\n"
+
+# Typical requests used to check that split tokenization is exact
+_PROBES = (
+    "Write a function to find the maximum subarray sum using Kadane's algorithm",
+    "Implement Dijkstra's algorithm (with a binary heap) in C++.",
+    "2-sum: return the indices of two numbers adding up to target",
+    "Sort a list of names like Zoë, Émile and Ana alphabetically",
+)
+
+
+class PromptTemplate:
+    """
+    A fixed PREFIX plus TASK_SUFFIX. The fixed text around {user_prompt} is
+    tokenized once per tokenizer; encode() then tokenizes only the user's text
+    (batched across requests) and concatenates token ids.
+
+    Tokenizers do not always split text the same way in pieces as in one go, so
+    the split is checked against full tokenization of a few probe prompts.
+    Tokenizers (or requests) where it is not exact fall back to tokenizing the
+    whole prompt, so the ids always match tokenizer(prompt).input_ids.
+    """
+
+    def __init__(self, name, prefix, task=TASK_SUFFIX):
+        task_head, self.tail = task.split("{user_prompt}")
+        self.name = name
+        self.prefix = prefix
+        self.head = prefix + task_head  # fixed text before the user's request
+        self._segments = {}  # id(tokenizer) -> (tokenizer, segments or None)
+
+    def render(self, user_prompt):
+        return self.head + user_prompt + self.tail
+
+    def user_part(self, prompt):
+        """The user's request if `prompt` was rendered from this template, else None."""
+        if prompt.startswith(self.head) and prompt.endswith(self.tail) and len(prompt) >= len(self.head) + len(self.tail):
+            return prompt[len(self.head):len(prompt) - len(self.tail)]
+        return None
+
+    def encode(self, tokenizer, user_prompts):
+        """One list of token ids per request, equal to tokenizing each rendered prompt."""
+        segments = self.segments(tokenizer)
+        ids = [None] * len(user_prompts)
+        fast = [i for i, user in enumerate(user_prompts) if segments and self._splittable(user)]
+        if fast:
+            head, lead, tail, _ = segments
+            bodies = tokenizer([lead + user_prompts[i] for i in fast], add_special_tokens=False).input_ids
+            for i, body in zip(fast, bodies):
+                ids[i] = head + body + tail
+        slow = [i for i, found in enumerate(ids) if found is None]
+        if slow:
+            for i, full in zip(slow, tokenizer([self.render(user_prompts[i]) for i in slow]).input_ids):
+                ids[i] = full
+        return ids
+
+    def prefix_tokens(self, tokenizer):
+        """How many leading ids of encode() are tokenizer(prefix).input_ids, or None if they differ."""
+        segments = self.segments(tokenizer)
+        return segments[3] if segments else None
+
+    def segments(self, tokenizer):
+        """
+        (head ids, text to put before the user's request, tail ids, prefix
+        token count or None), or None when splitting is not exact.
+        """
+        cached = self._segments.get(id(tokenizer))
+        if cached is None or cached[0] is not tokenizer:
+            cached = self._segments[id(tokenizer)] = (tokenizer, self._split(tokenizer))
+        return cached[1]
+
+    @staticmethod
+    def _splittable(user):
+        # Leading/trailing whitespace may merge with the fixed text around it
+        return bool(user) and not user[0].isspace() and not user[-1].isspace()
+
+    def _split(self, tokenizer):
+        # Where the boundary space goes depends on the tokenizer: kept in the
+        # head, moved onto the user's text (byte-level BPE), or dropped and
+        # supplied again by the tokenizer's dummy prefix (SentencePiece)
+        candidates = [(self.head, "")]
+        if self.head.endswith(" "):
+            candidates += [(self.head[:-1], " "), (self.head[:-1], "")]
+        for head_text, lead in candidates:
+            head = tokenizer(head_text).input_ids
+            full = tokenizer(self.render(_PROBES[0])).input_ids
+            body = tokenizer(lead + _PROBES[0], add_special_tokens=False).input_ids
+            if full[:len(head)] != head or full[len(head):len(head) + len(body)] != body:
+                continue
+            tail = full[len(head) + len(body):]
+            bodies = tokenizer([lead + p for p in _PROBES], add_special_tokens=False).input_ids
+            if all(head + b + tail == tokenizer(self.render(p)).input_ids for p, b in zip(_PROBES, bodies)):
+                prefix_ids = tokenizer(self.prefix).input_ids
+                return head, lead, tail, len(prefix_ids) if head[:len(prefix_ids)] == prefix_ids else None
+        print("[WARN] Prompt template does not tokenize in pieces with this tokenizer; tokenizing whole prompts")
+        return None
+
+
+APP_TEMPLATE = PromptTemplate("app", APP_PREFIX)
+MAIN_TEMPLATE = PromptTemplate("main", MAIN_PREFIX)
+TEMPLATES = (APP_TEMPLATE, MAIN_TEMPLATE)
+
+# Fixed prefixes whose KV cache utils.llm keeps warm
+PREFIXES = (APP_PREFIX, MAIN_PREFIX)
+
+
+def build_app_prompt(user_prompt):
+    return APP_TEMPLATE.render(user_prompt)
+
+def build_main_prompt(user_prompt):
+    return MAIN_TEMPLATE.render(user_prompt)
+
+def describe_prompt(prompt):
+    """(template name, user's request) for a templated prompt, else ('other', prompt)."""
+    for template in TEMPLATES:
+        user = template.user_part(prompt)
+        if user is not None:
+            return template.name, user
+    return "other", prompt
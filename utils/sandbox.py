@@ -0,0 +1,416 @@
+# utils/sandbox.py
+"""
+Runs generated Python code against parsed TEST CASES in a pool of warm,
+resource-limited worker interpreters.
+
+SandboxPool starts SANDBOX_WORKERS long-lived `python -m utils.sandbox`
+workers once. Each has already imported the stdlib modules generated code
+tends to use. A test case is sent to an idle worker, which forks a child
+for it. The child sets rlimits (CPU, memory, file size, open files,
+processes), moves to a scratch directory, runs the code and reports back
+through a pipe. A case therefore costs a fork, not an interpreter startup,
+and one case cannot leak state into the next. Cases run in parallel, one
+per worker; a child that exceeds SANDBOX_TIMEOUT is killed.
+
+How a case is run (plan_case):
+- "call": the input is a call such as `max_subarray([1, 2])`, arguments such
+  as `nums = [1, 2], k = 3`, or a literal. It is evaluated against the
+  code's top-level function and the value is compared with the expected
+  output.
+- "stdin": the code reads input(). It runs as __main__ with the input on
+  stdin, and its stdout is compared with the expected output.
+
+This limits resources; it is not a security boundary. Generated code keeps
+the network access and file reads of the app's user. Test execution is
+therefore off unless SANDBOX_WORKERS is set (e.g. SANDBOX_WORKERS=4), and
+the app leaves it unticked even then. Without fork() (Windows) there are
+no rlimits either: each case runs inside the worker interpreter itself,
+which then exits, and the pool hands the next case to a replacement it
+started while the case ran.
+"""
+import ast
+import atexit
+import io
+import json
+import math
+import os
+import queue
+import select
+import subprocess
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from utils.telemetry import metrics, timed
+
+try:
+    import resource
+except ImportError:  # Windows: no rlimits, timeouts still apply
+    resource = None
+
+SANDBOX_WORKERS = int(os.environ.get("SANDBOX_WORKERS", "0"))  # opt-in: 0 disables test execution
+SANDBOX_TIMEOUT = float(os.environ.get("SANDBOX_TIMEOUT", "5"))  # seconds per test case
+SANDBOX_MEMORY_MB = int(os.environ.get("SANDBOX_MEMORY_MB", "256"))  # address space per test case
+
+_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+_GRACE = 2.0  # extra seconds before the pool gives up on a worker itself
+_MAX_OUTPUT = 4000  # characters of actual output / stdout kept per case
+_PREWARM = (
+    "bisect", "collections", "copy", "dataclasses", "functools", "heapq", "itertools", "json", "math",
+    "operator", "random", "re", "string", "typing",
+)
+# Only these reach the workers: no tokens or keys from the app's environment
+_ENV_KEEP = ("PATH", "LANG", "LC_ALL", "SYSTEMROOT", "TMPDIR", "TEMP", "TMP")
+
+
+# ---------- Planning (app side) ----------
+def _entry_points(tree):
+    """Top-level functions, the ones a test is likeliest to call first."""
+    functions = [node for node in tree.body if isinstance(node, (ast.FunctionDef, ast.AsyncFunctionDef))]
+    return sorted(functions, key=lambda f: (f.name == "main", f.name.startswith("_"), f.name.startswith("test")))
+
+def _parameters(function):
+    return [a.arg for a in function.args.posonlyargs + function.args.args + function.args.kwonlyargs]
+
+def _as_expression(text):
+    try:
+        return ast.parse(text, mode="eval").body
+    except SyntaxError:
+        return None
+
+def _call_for(tree, given):
+    """A Python expression calling the code with `given`, or None when it does not fit a call."""
+    defined = {node.name for node in tree.body if isinstance(node, (ast.FunctionDef, ast.ClassDef))}
+    functions = _entry_points(tree)
+
+    node = _as_expression(given)
+    if isinstance(node, ast.Call) and isinstance(node.func, ast.Name) and node.func.id in defined:
+        return given
+
+    # "nums = [1, 2], k = 3" or one assignment per line: keyword arguments
+    parts = [part.strip() for part in given.replace("\n", ",").split(",") if part.strip()]
+    keywords = _as_expression("_(" + ", ".join(parts) + ")")
+    if "=" in given and isinstance(keywords, ast.Call) and keywords.keywords and not keywords.args:
+        names = {k.arg for k in keywords.keywords}
+        for function in functions:
+            if names <= set(_parameters(function)):
+                return f"{function.name}({ast.unparse(keywords)[2:-1]})"
+
+    # A bare literal or tuple of literals: positional arguments
+    if node is not None and functions:
+        try:
+            value = ast.literal_eval(node)
+        except (ValueError, TypeError, SyntaxError, MemoryError, RecursionError):
+            return None
+        for function in functions:
+            count = len(function.args.args)
+            if isinstance(node, ast.Tuple) and count == len(value) > 1:
+                return f"{function.name}(*({given}))"
+            if count == 1:
+                return f"{function.name}({given})"
+    return None
+
+def plan_case(code, case):
+    """
+    The job a worker runs for one {"input", "expected"} case, or a
+    {"status": "skipped", "error": why} result when it cannot be run.
+    """
+    try:
+        tree = ast.parse(code)
+    except SyntaxError as e:
+        return {"status": "error", "error": f"SyntaxError: {e}"}
+    job = {"code": code, "expected": case["expected"], "timeout": SANDBOX_TIMEOUT, "memory_mb": SANDBOX_MEMORY_MB}
+
+    call = _call_for(tree, case["input"])
+    if call is not None:
+        return dict(job, mode="call", call=call)
+    if "input(" in code or "sys.stdin" in code:
+        stdin = case["input"]
+        return dict(job, mode="stdin", stdin=stdin if stdin.endswith("\n") else stdin + "\n")
+    return {"status": "skipped", "error": "input does not map to a function call and the code reads no stdin"}
+
+
+# ---------- Pool (app side) ----------
+class _Worker:
+    """One warm worker interpreter speaking JSON lines over stdin/stdout."""
+
+    def __init__(self):
+        env = {k: v for k, v in os.environ.items() if k in _ENV_KEEP}
+        self.proc = subprocess.Popen(
+            [sys.executable, "-m", "utils.sandbox"],
+            stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL,
+            cwd=_ROOT, env=env, text=True, encoding="utf-8", bufsize=1,
+        )
+
+    def ask(self, job):
+        """Run one job; None when the worker died or hung and has to be replaced."""
+        watchdog = threading.Timer(job["timeout"] + _GRACE, self.proc.kill)
+        watchdog.start()
+        try:
+            self.proc.stdin.write(json.dumps(job) + "\n")
+            self.proc.stdin.flush()
+            line = self.proc.stdout.readline()
+        except (BrokenPipeError, OSError, ValueError):
+            line = ""
+        finally:
+            watchdog.cancel()
+        return json.loads(line) if line else None
+
+    def close(self):
+        try:
+            self.proc.stdin.close()
+            self.proc.wait(timeout=1)
+        except Exception:
+            self.proc.kill()
+
+
+class SandboxPool:
+    """Runs test cases on `workers` warm worker interpreters, one case per worker at a time."""
+
+    def __init__(self, workers=SANDBOX_WORKERS):
+        self.workers = max(1, workers)
+        self._idle = queue.Queue()
+        self._executor = ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix="sandbox")
+        self._started = False
+        self._lock = threading.Lock()
+        self._restarts = 0
+        atexit.register(self.close)
+
+    def start(self):
+        """Start the workers now rather than on the first run()."""
+        with self._lock:
+            if not self._started:
+                for _ in range(self.workers):
+                    self._idle.put(_Worker())
+                self._started = True
+                print(f"[INFO] Sandbox pool started with {self.workers} workers")
+                if not hasattr(os, "fork"):
+                    print("[WARN] No fork() on this platform: test cases run inside the workers "
+                          "with no resource limits, only the timeout")
+        return self
+
+    @timed("run_tests")
+    def run(self, code, cases):
+        """
+        Run `cases` (utils.parser.parse_test_cases output) against `code`, in
+        parallel. Returns one result per case: the case plus "status"
+        (passed / failed / error / timeout / skipped), "actual", "error" and "seconds".
+        """
+        self.start()
+        jobs = [self._plan(code, case) for case in cases]
+        futures = [self._executor.submit(self._run_job, job) if "mode" in job else None for job in jobs]
+        results = []
+        for case, job, future in zip(cases, jobs, futures):
+            result = future.result() if future is not None else job
+            result = dict(case, **{k: v for k, v in result.items() if k not in ("code", "expected")})
+            metrics.inc("test_cases_total", status=result["status"])
+            results.append(result)
+        return results
+
+    @staticmethod
+    def _plan(code, case):
+        """plan_case, with a case it cannot read skipped instead of failing the whole run."""
+        try:
+            return plan_case(code, case)
+        except Exception as e:
+            return {"status": "skipped", "error": f"could not plan this case: {type(e).__name__}: {e}"}
+
+    def stats(self):
+        return {"workers": self.workers, "idle": self._idle.qsize(), "restarts": self._restarts}
+
+    def close(self):
+        while True:
+            try:
+                self._idle.get_nowait().close()
+            except queue.Empty:
+                break
+
+    def _run_job(self, job):
+        worker = self._idle.get()
+        # Without fork the worker exits after this case: its replacement warms up meanwhile
+        replacement = None if hasattr(os, "fork") else _Worker()
+        started = time.monotonic()
+        try:
+            result = worker.ask(job)
+            if result is None or result.pop("recycle", False):
+                # Hung past the watchdog, crashed, or (without fork) ran the code itself: use a fresh one
+                worker.close()
+                worker, replacement = replacement or _Worker(), None
+                with self._lock:
+                    self._restarts += 1
+            if result is None and time.monotonic() - started >= job["timeout"] + _GRACE:
+                result = {"status": "timeout", "error": f"worker did not answer within {job['timeout'] + _GRACE:g} s"}
+            elif result is None:
+                result = {"status": "error", "error": "sandbox worker exited unexpectedly"}
+            if job.get("mode") == "call":
+                result.setdefault("call", job["call"])
+            return result
+        finally:
+            self._idle.put(worker)
+            if replacement is not None:
+                replacement.close()
+
+
+# ---------- Worker (runs in `python -m utils.sandbox`) ----------
+_MISSING = object()
+
+def _normalize(text):
+    return " ".join(str(text).split()).strip(".")
+
+def _literal(text):
+    """The expected output as a Python value, ignoring a trailing "(explanation)" or "# comment"."""
+    for candidate in (text, text.split("#")[0], text.split(" (")[0], text.split("//")[0]):
+        try:
+            return ast.literal_eval(candidate.strip())
+        except (ValueError, SyntaxError, MemoryError, RecursionError):
+            continue
+    return _MISSING
+
+def _matches(actual, expected_text):
+    expected = _literal(expected_text)
+    if expected is not _MISSING:
+        if actual == expected:
+            return True
+        if isinstance(actual, (list, tuple)) and isinstance(expected, (list, tuple)):
+            return list(actual) == list(expected)
+        if isinstance(actual, float) and isinstance(expected, (int, float)) and not isinstance(expected, bool):
+            return math.isclose(actual, expected, rel_tol=1e-6, abs_tol=1e-9)
+    return _normalize(expected_text) in (_normalize(repr(actual)), _normalize(actual))
+
+def _stdout_matches(stdout, expected_text):
+    lines = [_normalize(line) for line in stdout.strip().splitlines()]
+    expected = [_normalize(line) for line in expected_text.strip().splitlines()]
+    return lines == expected or _matches(stdout.strip(), expected_text)
+
+def _limit(job):
+    if resource is None:
+        return
+    cpu = int(math.ceil(job["timeout"])) + 1
+    limits = [
+        (resource.RLIMIT_CPU, cpu),
+        (resource.RLIMIT_AS, job["memory_mb"] * 1024 * 1024),
+        (resource.RLIMIT_FSIZE, 1024 * 1024),
+        (resource.RLIMIT_NOFILE, 32),
+    ]
+    if hasattr(resource, "RLIMIT_NPROC"):
+        limits.append((resource.RLIMIT_NPROC, 0))
+    for which, value in limits:
+        try:
+            resource.setrlimit(which, (value, value))
+        except (ValueError, OSError):
+            pass
+
+def _execute(job, compiled):
+    """Run one job in this (child) process; returns the result dict."""
+    stdout = io.StringIO()
+    sys.stdin = io.StringIO(job.get("stdin", ""))
+    sys.stdout = sys.stderr = stdout
+    namespace = {"__name__": "__main__" if job["mode"] == "stdin" else "__sandbox__", "__builtins__": __builtins__}
+    started = time.perf_counter()
+    try:
+        try:
+            exec(compiled, namespace)
+        except SystemExit:
+            if job["mode"] != "stdin":
+                raise
+        if job["mode"] == "call":
+            actual = eval(job["call"], namespace)
+            passed = _matches(actual, job["expected"])
+            shown = repr(actual)
+        else:
+            shown = stdout.getvalue()
+            passed = _stdout_matches(shown, job["expected"])
+        status, error = ("passed" if passed else "failed"), None
+    except MemoryError:
+        status, error, shown = "error", f"MemoryError (limit {job['memory_mb']} MB)", None
+    except BaseException as e:
+        status, error, shown = "error", f"{type(e).__name__}: {e}", None
+    return {
+        "status": status,
+        "actual": shown[:_MAX_OUTPUT] if shown is not None else None,
+        "stdout": stdout.getvalue()[:_MAX_OUTPUT] if job["mode"] == "call" else None,
+        "error": error[:_MAX_OUTPUT] if error else None,
+        "seconds": round(time.perf_counter() - started, 6),
+    }
+
+def _run_forked(job, compiled, scratch):
+    read_end, write_end = os.pipe()
+    pid = os.fork()
+    if pid == 0:
+        status = 0
+        try:
+            os.close(read_end)
+            # Raw fd writes from the code must not reach the worker's protocol stream
+            devnull = os.open(os.devnull, os.O_RDWR)
+            for fd in (0, 1, 2):
+                os.dup2(devnull, fd)
+            os.chdir(scratch)
+            _limit(job)
+            data = json.dumps(_execute(job, compiled)).encode("utf-8")
+            while data:
+                data = data[os.write(write_end, data):]
+        except BaseException:
+            status = 1
+        finally:
+            os._exit(status)
+
+    os.close(write_end)
+    chunks, deadline = [], time.monotonic() + job["timeout"]
+    try:
+        while True:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0 or not select.select([read_end], [], [], remaining)[0]:
+                os.kill(pid, 9)
+                os.waitpid(pid, 0)
+                return {"status": "timeout", "error": f"no result within {job['timeout']:g} s"}
+            chunk = os.read(read_end, 65536)
+            if not chunk:
+                break
+            chunks.append(chunk)
+    finally:
+        os.close(read_end)
+    _, wait_status = os.waitpid(pid, 0)
+    if chunks:
+        return json.loads(b"".join(chunks))
+    if os.WIFSIGNALED(wait_status):
+        return {"status": "error", "error": f"killed by signal {os.WTERMSIG(wait_status)} (CPU or memory limit)"}
+    return {"status": "error", "error": "test process exited without a result"}
+
+def _worker_main():
+    import importlib
+    import tempfile
+    for name in _PREWARM:
+        importlib.import_module(name)
+    scratch = tempfile.mkdtemp(prefix="codeviz-sandbox-")
+    protocol = sys.stdout
+    compiled_cache = {}
+    for line in sys.stdin:
+        job = json.loads(line)
+        try:
+            compiled = compiled_cache.get(job["code"])
+            if compiled is None:
+                compiled = compiled_cache[job["code"]] = compile(job["code"], "<generated>", "exec")
+                if len(compiled_cache) > 16:
+                    compiled_cache.pop(next(iter(compiled_cache)))
+            if hasattr(os, "fork"):
+                result = _run_forked(job, compiled, scratch)
+            else:
+                # No isolation here: the code runs in this interpreter, without rlimits
+                os.chdir(scratch)
+                try:
+                    result = _execute(job, compiled)
+                finally:
+                    sys.stdin, sys.stdout, sys.stderr = sys.__stdin__, protocol, sys.__stderr__
+                    os.chdir(_ROOT)
+                result["recycle"] = True  # globals, builtins and sys.modules may all have been changed
+        except Exception as e:
+            result = {"status": "error", "error": f"{type(e).__name__}: {e}", "recycle": not hasattr(os, "fork")}
+        protocol.write(json.dumps(result) + "\n")
+        protocol.flush()
+        if result.get("recycle"):
+            break  # the case ran in this interpreter; the pool moves on to a clean one
+
+
+if __name__ == "__main__":
+    _worker_main()
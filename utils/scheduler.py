@@ -0,0 +1,236 @@
+# utils/scheduler.py
+"""
+Admission control in front of the model: the queue MicroBatcher pulls from.
+
+- Bounded: once `max_depth` requests are waiting, a new request either sheds
+  the newest queued request of a lower priority or is rejected (Overloaded),
+  so callers fail fast instead of timing out behind a long queue.
+- Priorities: interactive (UI) requests are always served before batch jobs.
+- Fairness: within a priority, clients are served round-robin, so one client
+  submitting many requests cannot starve the others.
+- Max wait: a request still queued after its class's max wait fails with
+  QueueTimeout instead of reaching the model late. A reaper thread expires
+  it at that deadline, also while a long generate keeps the queue idle.
+- Degradation: as the queue fills past `degrade_at`, newly admitted requests
+  get a smaller max_new_tokens and are not continued past it.
+"""
+import queue
+import threading
+import time
+from collections import Counter, OrderedDict, deque
+
+INTERACTIVE, BATCH = 0, 1
+PRIORITIES = {"interactive": INTERACTIVE, "batch": BATCH}
+
+
+class Overloaded(RuntimeError):
+    """Rejected at admission (or shed from the queue) because the queue is full."""
+
+
+class QueueTimeout(TimeoutError):
+    """Waited longer than its max wait before reaching the model."""
+
+
+def priority_of(name):
+    """'interactive' | 'batch' (or an int level) -> priority level."""
+    if isinstance(name, int):
+        return name
+    if name not in PRIORITIES:
+        raise ValueError(f"Unknown priority {name!r}; expected one of {sorted(PRIORITIES)}")
+    return PRIORITIES[name]
+
+
+class AdmissionQueue:
+    """
+    Thread-safe priority queue with the put/get/qsize surface MicroBatcher
+    uses. Requests need `priority`, `client`, `max_new_tokens`, `limit`,
+    `enqueued_at` and a `future` (see utils.batcher._Request).
+    """
+
+    def __init__(self, max_depth=32, max_wait=None, degrade_at=0.5, min_new_tokens=256):
+        self.max_depth = max_depth
+        self.max_wait = max_wait or {INTERACTIVE: 60.0, BATCH: 900.0}
+        self.degrade_at = degrade_at
+        self.min_new_tokens = min_new_tokens
+
+        # priority -> client -> waiting requests; clients rotate within a priority
+        self._classes = {level: OrderedDict() for level in PRIORITIES.values()}
+        self._depth = 0
+        lock = threading.Lock()
+        self._cond = threading.Condition(lock)      # get() waits here for requests
+        self._deadlines = threading.Condition(lock)  # the reaper waits here for the next max-wait deadline
+        self._reaper = None
+
+        # --- Metrics ---
+        self.counts = Counter()  # admitted, rejected, shed, expired, degraded (per priority name)
+        self._waits = {level: deque(maxlen=1024) for level in PRIORITIES.values()}
+        self._max_depth_seen = 0
+
+    # ---------- Queue surface ----------
+    def put(self, request):
+        with self._cond:
+            self._expire(time.perf_counter())
+            if self._depth >= self.max_depth:
+                victim = self._shed_for(request.priority)
+                if victim is None:
+                    self._count("rejected", request.priority)
+                    raise Overloaded(f"Inference queue is full ({self._depth} waiting); try again shortly")
+                self._count("shed", victim.priority)
+                victim.future.set_exception(Overloaded("Shed from the inference queue for higher-priority work"))
+            self._degrade(request)
+            self._classes[request.priority].setdefault(request.client, deque()).append(request)
+            self._depth += 1
+            self._max_depth_seen = max(self._max_depth_seen, self._depth)
+            self._count("admitted", request.priority)
+            self._cond.notify()
+            if self._reaper is None:
+                self._reaper = threading.Thread(target=self._reap, name="queue-reaper", daemon=True)
+                self._reaper.start()
+            self._deadlines.notify()
+
+    def get(self, block=True, timeout=None):
+        deadline = None if timeout is None else time.monotonic() + timeout
+        with self._cond:
+            while True:
+                request = self._pop()
+                if request is not None:
+                    return request
+                remaining = None if deadline is None else deadline - time.monotonic()
+                if not block or (remaining is not None and remaining <= 0):
+                    raise queue.Empty
+                self._cond.wait(remaining)
+
+    def qsize(self):
+        with self._cond:
+            return self._depth
+
+    # ---------- Metrics ----------
+    def stats(self):
+        with self._cond:
+            depth = {
+                name: sum(len(waiting) for waiting in self._classes[level].values())
+                for name, level in PRIORITIES.items()
+            }
+            waits = {name: sorted(self._waits[level]) for name, level in PRIORITIES.items()}
+            counts = dict(self.counts)
+            max_seen = self._max_depth_seen
+        return {
+            "depth": depth,
+            "max_depth": self.max_depth,
+            "max_depth_seen": max_seen,
+            "counts": counts,
+            "wait_ms": {
+                name: {
+                    "mean": 1000 * sum(w) / len(w) if w else 0.0,
+                    "p95": 1000 * w[min(len(w) - 1, int(0.95 * len(w)))] if w else 0.0,
+                }
+                for name, w in waits.items()
+            },
+        }
+
+    def metrics_text(self, prefix="codeviz_queue"):
+        """Prometheus text exposition of stats()."""
+        stats = self.stats()
+        lines = [
+            f"# TYPE {prefix}_depth gauge",
+            *(f'{prefix}_depth{{priority="{name}"}} {value}' for name, value in stats["depth"].items()),
+            f"# TYPE {prefix}_capacity gauge",
+            f"{prefix}_capacity {stats['max_depth']}",
+            f"# TYPE {prefix}_requests_total counter",
+        ]
+        for key, value in sorted(stats["counts"].items()):
+            outcome, name = key.split(":")
+            lines.append(f'{prefix}_requests_total{{outcome="{outcome}",priority="{name}"}} {value}')
+        lines.append(f"# TYPE {prefix}_wait_seconds gauge")
+        for name, wait in stats["wait_ms"].items():
+            for stat, ms in wait.items():
+                lines.append(f'{prefix}_wait_seconds{{priority="{name}",stat="{stat}"}} {ms / 1000:.6f}')
+        return "\n".join(lines) + "\n"
+
+    # ---------- Internals ----------
+    def _count(self, outcome, level):
+        name = next(name for name, lvl in PRIORITIES.items() if lvl == level)
+        self.counts[f"{outcome}:{name}"] += 1
+
+    def _pop(self):
+        """Next request: highest priority first, round-robin across that priority's clients."""
+        now = time.perf_counter()
+        self._expire(now)
+        for level in sorted(self._classes):
+            clients = self._classes[level]
+            if not clients:
+                continue
+            client, waiting = next(iter(clients.items()))
+            request = waiting.popleft()
+            if waiting:
+                clients.move_to_end(client)
+            else:
+                del clients[client]
+            self._depth -= 1
+            self._waits[level].append(now - request.enqueued_at)
+            return request
+        return None
+
+    def _reap(self):
+        """Expire requests at their deadline, even when nothing calls put() or get() meanwhile."""
+        with self._deadlines:
+            while True:
+                now = time.perf_counter()
+                self._expire(now)
+                deadline = self._next_deadline()
+                self._deadlines.wait(None if deadline is None else deadline - now)
+
+    def _next_deadline(self):
+        """perf_counter time at which the oldest queued request of any class runs out of wait, or None."""
+        deadlines = [
+            waiting[0].enqueued_at + self.max_wait[level]
+            for level, clients in self._classes.items() if self.max_wait.get(level) is not None
+            for waiting in clients.values()
+        ]
+        return min(deadlines, default=None)
+
+    def _expire(self, now):
+        for level, clients in self._classes.items():
+            limit = self.max_wait.get(level)
+            if limit is None:
+                continue
+            for client in list(clients):
+                waiting = clients[client]
+                # FIFO per client: the oldest requests are at the front
+                while waiting and now - waiting[0].enqueued_at >= limit:
+                    request = waiting.popleft()
+                    self._depth -= 1
+                    self._count("expired", level)
+                    request.future.set_exception(
+                        QueueTimeout(f"Waited over {limit:.0f} s in the inference queue")
+                    )
+                if not waiting:
+                    del clients[client]
+
+    def _shed_for(self, level):
+        """Drop the newest queued request of the lowest priority below `level`; returns it or None."""
+        for victim_level in sorted(self._classes, reverse=True):
+            if victim_level <= level:
+                break
+            clients = self._classes[victim_level]
+            if not clients:
+                continue
+            client = max(clients, key=lambda c: clients[c][-1].enqueued_at)
+            victim = clients[client].pop()
+            if not clients[client]:
+                del clients[client]
+            self._depth -= 1
+            return victim
+        return None
+
+    def _degrade(self, request):
+        """Shrink max_new_tokens in two steps as the queue fills past degrade_at."""
+        pressure = self._depth / self.max_depth
+        if pressure < self.degrade_at:
+            return
+        factor = 0.5 if pressure >= (1 + self.degrade_at) / 2 else 0.75
+        degraded = max(self.min_new_tokens, int(request.max_new_tokens * factor))
+        if degraded < request.max_new_tokens:
+            request.max_new_tokens = degraded
+            request.limit = None  # no continuing past the degraded budget either
+            self._count("degraded", request.priority)
@@ -0,0 +1,236 @@
+# utils/telemetry.py
+"""
+Per-stage latency and token telemetry for the app.py / main.py pipeline.
+
+Stages (tokenize, prefill, decode, parse_response, mermaid_fix, layout, render_html,
+render_section, run_tests, ttft, request) are timed into a process-wide Metrics registry
+together with token counters. They are exported three ways:
+
+- Prometheus text: metrics.text(), also written to TELEMETRY_DIR/metrics.prom
+  (node_exporter textfile-collector style) and served by server.py /metrics.
+- Structured logs: one JSON line per generate call and per request, appended
+  to TELEMETRY_DIR/events.jsonl.
+- The optional live stats panel in the Streamlit sidebar (metrics.snapshot()).
+
+Set TELEMETRY_DIR="" to keep telemetry in memory only.
+"""
+import json
+import os
+import threading
+import time
+from collections import Counter, deque
+from contextlib import contextmanager
+
+TELEMETRY_DIR = os.environ.get("TELEMETRY_DIR", os.path.join("outputs", "telemetry"))
+EXPORT_INTERVAL = 1.0  # seconds between metrics.prom rewrites
+
+
+class Metrics:
+    """Thread-safe stage timers, counters and gauges."""
+
+    def __init__(self, window=512):
+        self.window = window  # recent observations kept per stage for quantiles
+        self._stages = {}
+        self._counters = Counter()
+        self._gauges = {}
+        self._lock = threading.Lock()
+
+    def observe(self, stage, seconds):
+        with self._lock:
+            entry = self._stages.get(stage)
+            if entry is None:
+                entry = self._stages[stage] = {"count": 0, "sum": 0.0, "max": 0.0, "recent": deque(maxlen=self.window)}
+            entry["count"] += 1
+            entry["sum"] += seconds
+            entry["max"] = max(entry["max"], seconds)
+            entry["recent"].append(seconds)
+
+    @contextmanager
+    def timer(self, stage):
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(stage, time.perf_counter() - started)
+
+    def inc(self, name, value=1, **labels):
+        with self._lock:
+            self._counters[(name, tuple(sorted(labels.items())))] += value
+
+    def set(self, name, value, **labels):
+        with self._lock:
+            self._gauges[(name, tuple(sorted(labels.items())))] = value
+
+    def snapshot(self):
+        """Plain-dict view: per-stage count/mean/p50/p95/max (seconds), counters, gauges."""
+        with self._lock:
+            stages = {name: dict(entry, recent=sorted(entry["recent"])) for name, entry in self._stages.items()}
+            counters = dict(self._counters)
+            gauges = dict(self._gauges)
+        return {
+            "stages": {
+                name: {
+                    "count": e["count"],
+                    "mean": e["sum"] / e["count"],
+                    "p50": _quantile(e["recent"], 0.5),
+                    "p95": _quantile(e["recent"], 0.95),
+                    "max": e["max"],
+                }
+                for name, e in sorted(stages.items())
+            },
+            "counters": {_key(name, labels): value for (name, labels), value in sorted(counters.items())},
+            "gauges": {_key(name, labels): value for (name, labels), value in sorted(gauges.items())},
+        }
+
+    def text(self, prefix="codeviz"):
+        """Prometheus text exposition."""
+        with self._lock:
+            stages = {name: dict(entry, recent=sorted(entry["recent"])) for name, entry in self._stages.items()}
+            counters = sorted(self._counters.items())
+            gauges = sorted(self._gauges.items())
+
+        lines = [f"# TYPE {prefix}_stage_seconds summary"]
+        for name, e in sorted(stages.items()):
+            for q in (0.5, 0.95):
+                lines.append(f'{prefix}_stage_seconds{{stage="{name}",quantile="{q}"}} {_quantile(e["recent"], q):.6f}')
+            lines.append(f'{prefix}_stage_seconds_sum{{stage="{name}"}} {e["sum"]:.6f}')
+            lines.append(f'{prefix}_stage_seconds_count{{stage="{name}"}} {e["count"]}')
+        for kind, items in (("counter", counters), ("gauge", gauges)):
+            seen = set()
+            for (name, labels), value in items:
+                if name not in seen:
+                    lines.append(f"# TYPE {prefix}_{name} {kind}")
+                    seen.add(name)
+                lines.append(f"{prefix}_{_key(name, labels)} {value}")
+        return "\n".join(lines) + "\n"
+
+
+def _quantile(ordered, q):
+    return ordered[min(len(ordered) - 1, int(q * len(ordered)))] if ordered else 0.0
+
+def _key(name, labels):
+    if not labels:
+        return name
+    return name + "{" + ",".join(f'{k}="{v}"' for k, v in labels) + "}"
+
+
+metrics = Metrics()
+timed = metrics.timer
+
+_file_lock = threading.Lock()
+_last_export = 0.0
+
+
+def log_event(kind, **fields):
+    """Append one structured JSON line to TELEMETRY_DIR/events.jsonl."""
+    if not TELEMETRY_DIR:
+        return
+    record = dict(ts=time.time(), kind=kind, **fields)
+    try:
+        with _file_lock:
+            os.makedirs(TELEMETRY_DIR, exist_ok=True)
+            with open(os.path.join(TELEMETRY_DIR, "events.jsonl"), "a", encoding="utf-8") as f:
+                f.write(json.dumps(record) + "\n")
+    except OSError as e:
+        print(f"[WARN] Could not write telemetry log: {e}")
+
+
+def export(force=False):
+    """Rewrite TELEMETRY_DIR/metrics.prom (at most once per EXPORT_INTERVAL unless forced)."""
+    global _last_export
+    if not TELEMETRY_DIR:
+        return
+    now = time.monotonic()
+    with _file_lock:
+        if not force and now - _last_export < EXPORT_INTERVAL:
+            return
+        _last_export = now
+        path = os.path.join(TELEMETRY_DIR, "metrics.prom")
+        try:
+            os.makedirs(TELEMETRY_DIR, exist_ok=True)
+            with open(path + ".tmp", "w", encoding="utf-8") as f:
+                f.write(metrics.text())
+            os.replace(path + ".tmp", path)
+        except OSError as e:
+            print(f"[WARN] Could not write {path}: {e}")
+
+
+def record_generation(prompt_tokens, new_tokens, prefill_seconds, decode_seconds, section_tokens=None, **fields):
+    """
+    Account one generate call. `prompt_tokens` / `new_tokens` hold one entry per
+    row, `section_tokens` one {section: tokens} dict per row.
+    """
+    generated = sum(new_tokens)
+    steps = max(new_tokens) if new_tokens else 0
+    metrics.observe("prefill", prefill_seconds)
+    metrics.observe("decode", decode_seconds)
+    metrics.inc("prompt_tokens_total", sum(prompt_tokens))
+    metrics.inc("generated_tokens_total", generated)
+    metrics.inc("generate_calls_total")
+    # Every row advances once per step, so batch throughput counts all rows
+    tokens_per_sec = (generated - len(new_tokens)) / decode_seconds if decode_seconds > 0 and steps > 1 else 0.0
+    metrics.set("decode_tokens_per_second", round(tokens_per_sec, 3))
+    for row in section_tokens or ():
+        for section, count in row.items():
+            metrics.inc("section_tokens_total", count, section=section)
+    log_event(
+        "generate",
+        rows=len(new_tokens),
+        prompt_tokens=prompt_tokens,
+        new_tokens=new_tokens,
+        prefill_seconds=round(prefill_seconds, 6),
+        decode_seconds=round(decode_seconds, 6),
+        decode_tokens_per_sec=round(tokens_per_sec, 3),
+        section_tokens=section_tokens,
+        **fields
+    )
+    export()
+
+
+class RequestTrace:
+    """
+    One user request as the app/CLI sees it: time to first chunk, total time
+    and outcome. Wrap the chunk stream with watch()/awatch(), then finish().
+    """
+
+    def __init__(self, source, **fields):
+        self.source = source
+        self.fields = fields
+        self.started = time.perf_counter()
+        self.first_chunk = None
+        self.chars = 0
+
+    def _seen(self, chunk):
+        if self.first_chunk is None:
+            self.first_chunk = time.perf_counter()
+            metrics.observe("ttft", self.first_chunk - self.started)
+        self.chars += len(chunk)
+
+    def watch(self, chunks):
+        for chunk in chunks:
+            self._seen(chunk)
+            yield chunk
+
+    async def awatch(self, chunks):
+        try:
+            async for chunk in chunks:
+                self._seen(chunk)
+                yield chunk
+        finally:
+            if hasattr(chunks, "aclose"):
+                await chunks.aclose()
+
+    def finish(self, status, **fields):
+        total = time.perf_counter() - self.started
+        metrics.observe("request", total)
+        metrics.inc("requests_total", source=self.source, status=status)
+        log_event(
+            "request",
+            source=self.source,
+            status=status,
+            ttft_seconds=round(self.first_chunk - self.started, 6) if self.first_chunk else None,
+            total_seconds=round(total, 6),
+            response_chars=self.chars,
+            **dict(self.fields, **fields)
+        )
+        export(force=True)
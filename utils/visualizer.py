@@ -1,182 +1,355 @@
 # utils/visualizer.py
-import streamlit.components.v1 as components
+import hashlib
+import os
 import re
+import threading
 from collections import OrderedDict
+from html import escape
 
-# ---------- Helpers ----------
-def _safe_id(label, used):
-    """Make a safe ID from label, ensuring uniqueness."""
-    base = re.sub(r'[^A-Za-z0-9_]', '_', label).strip('_')
-    if not base:
-        base = "node"
-    if re.match(r'^\d', base):
-        base = "n_" + base
-    candidate = base
-    i = 1
-    while candidate in used:
-        candidate = f"{base}_{i}"
-        i += 1
-    used.add(candidate)
-    return candidate
-
-def _clean_label(lbl):
-    """Normalize label for display inside quotes."""
-    if lbl is None:
-        return ""
-    s = str(lbl)
-    s = s.replace('\r', ' ').replace('\n', ' ')
-    s = s.replace('"', "'")
-    s = re.sub(r'\s+', ' ', s).strip()
-    return s
+from utils.grammar import BODY_START, LINE_START, mermaid_run
+from utils.layout import render_svg
+from utils.mermaid import Graph, Node, Subgraph, parse_mermaid
+from utils.telemetry import timed
+
+# "svg": lay diagrams out on the server and embed inline SVG (works offline);
+# "mermaid": render in the browser with mermaid.js from the jsdelivr CDN
+DIAGRAM_RENDERER = os.environ.get("DIAGRAM_RENDERER", "svg").lower()
+SVG_CACHE_SIZE = int(os.environ.get("SVG_CACHE_SIZE", "128"))  # rendered diagrams kept in memory
+# Diagrams over either budget are simplified before rendering (0 = no limit)
+DIAGRAM_MAX_NODES = int(os.environ.get("DIAGRAM_MAX_NODES", "60"))
+DIAGRAM_MAX_EDGES = int(os.environ.get("DIAGRAM_MAX_EDGES", "120"))
 
-def _extract_label_from_token(token):
+# ---------- Helpers ----------
+def _conforms(src):
     """
-    Try to extract a human-friendly label from a token.
-    Prefer content inside [] or () or quotes; otherwise fallback to token trimmed.
+    Return the diagram body if `src` is already in the Mermaid subset that
+    constrained decoding (utils.grammar) produces, else None. The grammar
+    refuses reserved node IDs such as `end` and a header after the first
+    line, so those go to the repair path.
     """
-    token = token.strip()
-    # Try bracket [] first
-    m = re.search(r'\[([^\]]+)\]', token)
-    if m:
-        return _clean_label(m.group(1))
-    # Try parentheses ()
-    m = re.search(r'\(([^\)]+)\)', token)
-    if m:
-        return _clean_label(m.group(1))
-    # Try quoted strings
-    m = re.search(r'"([^"]+)"', token)
-    if m:
-        return _clean_label(m.group(1))
-    m = re.search(r"'([^']+)'", token)
-    if m:
-        return _clean_label(m.group(1))
-    # If token contains '-' trailing like 'DFS -' remove trailing dashes and words
-    token = re.sub(r'\s*-\s*$', '', token)
-    # remove stray remnants like repeated IDs: take first few words if long
-    token = _clean_label(token)
-    if len(token) > 60:
-        token = token[:57] + '...'
-    return token if token else "node"
+    body = src.replace("```mermaid", "").replace("```", "").strip()
+    if not re.match(r'(?i)^(flowchart|graph)\s+(TD|LR|RL|BT|TB)\s*$', body.split("\n", 1)[0]):
+        return None
+    return body if mermaid_run(LINE_START, body + "\n") == BODY_START else None
 
 # ---------- Main sanitizer ----------
+@timed("mermaid_fix")
 def validate_and_fix_mermaid(src: str) -> str:
     """
     Robust sanitizer for messy LLM-generated Mermaid.
-    Strategy:
-    - Remove code fences and 'mermaid version' garbage.
-    - Strip any previously auto-generated declarations (we will rebuild).
-    - Collapse newlines to spaces to repair labels split across lines.
-    - Split by '-->' to get token sequence and reconstruct edges individually.
-    - Build safe IDs, declare nodes once, deduplicate edges.
-    - Return a clean 'flowchart TD' block.
+    Grammar-conforming input is returned as is; anything else goes through
+    utils.mermaid, which rebuilds the diagram from a graph IR in one pass,
+    keeping node IDs, shapes, edge labels, subgraphs and branches.
     """
     if not src:
         return ""
 
-    s = str(src)
-
-    # Remove common noise
-    s = s.replace("```mermaid", "").replace("```", "")
-    s = re.sub(r'mermaid\s+version\s+[0-9\.]+', '', s, flags=re.IGNORECASE)
-    # Remove prior autogenerated id declarations like Some__Id[...] (they confuse the parser)
-    s = re.sub(r'^[A-Za-z0-9_]+__.*\[".*"\]\s*$', '', s, flags=re.MULTILINE)
-
-    # Remove explicit 'flowchart TD' or 'graph' occurrences temporarily (we'll add a clean one)
-    s = re.sub(r'(?i)^\s*flowchart\s+(TD|LR|RL|BT|TB)\s*', '', s, flags=re.MULTILINE)
-    s = re.sub(r'(?i)^\s*graph\s+(TD|LR|RL|BT|TB)\s*', '', s, flags=re.MULTILINE)
-
-    # Remove stray 'subgraph NAME' tokens for now (LLM often emits broken subgraphs)
-    s = re.sub(r'(?i)subgraph\s+[A-Za-z0-9_\-]+\s*', '', s)
-    # Remove stray 'end' tokens that are likely unmatched
-    s = re.sub(r'(?m)^\s*end\s*$', '', s)
-
-    # Collapse multiple whitespace and newlines into single spaces,
-    # but preserve explicit arrow tokens '-->' (we'll split by them)
-    # First, ensure arrow tokens are normalized
-    s = s.replace('->', '-->')
-    s = re.sub(r'\s*-->\s*', ' --> ', s)
-
-    # Join broken label lines: collapse all newlines to spaces (this is intentional and safe here)
-    body = ' '.join(line.strip() for line in s.splitlines() if line.strip())
-    body = re.sub(r'\s+', ' ', body).strip()
-
-    if not body:
-        return "flowchart TD\n"
-
-    # Now split on ' --> ' to get a sequence of tokens (some tokens may be standalone nodes)
-    parts = [p.strip() for p in re.split(r'\s*-->\s*', body) if p.strip()]
-
-    # If no parts, return header only
-    if not parts:
-        return "flowchart TD\n"
-
-    used_ids = set()
-    id_map = OrderedDict()  # label -> id (preserve insertion order)
-    edges = []
-    nodes_order = []  # list of (id,label) in order of first appearance
-
-    # Clean tokens: tokens may contain text like 'DFS([DFS function]) DFS -' etc.
-    # We'll extract a readable label for each token and assign a safe id.
-    cleaned_tokens = []
-    for token in parts:
-        # Remove trailing arrows remnants or stray punctuation
-        token = token.strip()
-        token = re.sub(r'\s*-\s*$', '', token)
-        token = re.sub(r'^\s*-\s*', '', token)
-        # If token includes duplicate 'DFS [..] DFS -' sequences, try to keep only the first bracketed segment
-        # Prefer bracketed [] or parentheses () content — extract label
-        label = _extract_label_from_token(token)
-        if not label:
-            # fallback: use first 6-8 words
-            label = ' '.join(token.split()[:6])
-        cleaned_tokens.append((token, label))
-
-    # Build edges between consecutive cleaned tokens
-    prev_id = None
-    for raw, label in cleaned_tokens:
-        # Map label to id (deduplicating identical labels)
-        key = label
-        if key in id_map:
-            nid = id_map[key]
-        else:
-            nid = _safe_id(key, used_ids)
-            id_map[key] = nid
-            nodes_order.append((nid, key))
-        if prev_id is not None:
-            # add edge prev_id --> nid
-            edges.append((prev_id, nid))
-        prev_id = nid
-
-    # Additionally, if original body had explicit node declarations like 'Node["Label"]'
-    # we ignore them (we rebuilt nodes). This avoids duplicate weird IDs.
-
-    # Deduplicate edges preserving order
-    seen_edges = set()
-    dedup_edges = []
-    for a, b in edges:
-        if (a, b) not in seen_edges:
-            dedup_edges.append((a, b))
-            seen_edges.add((a, b))
-
-    # Construct final mermaid lines
-    lines = ["flowchart TD"]
-    # node declarations (in order)
-    for nid, label in nodes_order:
-        lines.append(f'{nid}["{_clean_label(label)}"]')
-    # edges
-    for a, b in dedup_edges:
-        lines.append(f'{a} --> {b}')
-
-    cleaned = "\n".join(lines)
-    return cleaned
+    # Fast path: grammar-conforming input (e.g. from constrained decoding) is already valid
+    body = _conforms(str(src))
+    if body is not None:
+        return body
+    return parse_mermaid(src).to_mermaid()
+
+# ---------- Large-diagram simplification ----------
+def _over_budget(graph, max_nodes, max_edges):
+    return (max_nodes and len(graph.nodes) > max_nodes) or (max_edges and len(graph.edges) > max_edges)
+
+def _adjacency(graph):
+    succ = {v: [] for v in graph.nodes}
+    pred = {v: [] for v in graph.nodes}
+    seen = set()
+    for edge in graph.edges:
+        u, v = edge.source, edge.target
+        if u != v and (u, v) not in seen:
+            seen.add((u, v))
+            succ[u].append(v)
+            pred[v].append(u)
+    return succ, pred
+
+def _strongly_connected(order, succ):
+    """Tarjan's strongly connected components, iteratively (diagrams can be deeper than the recursion limit)."""
+    index, low, on_stack, stack, components = {}, {}, set(), [], []
+    for root in order:
+        if root in index:
+            continue
+        work = [(root, 0)]
+        while work:
+            v, i = work.pop()
+            if i == 0:
+                index[v] = low[v] = len(index)
+                stack.append(v)
+                on_stack.add(v)
+            for j in range(i, len(succ[v])):
+                w = succ[v][j]
+                if w not in index:
+                    work.append((v, j + 1))
+                    work.append((w, 0))
+                    break
+                if w in on_stack:
+                    low[v] = min(low[v], index[w])
+            else:
+                if low[v] == index[v]:
+                    component = []
+                    while True:
+                        w = stack.pop()
+                        on_stack.discard(w)
+                        component.append(w)
+                        if w == v:
+                            break
+                    components.append(component)
+                if work:
+                    parent = work[-1][0]
+                    low[parent] = min(low[parent], low[v])
+    return components
+
+def _contract(graph, groups, members, label_of, chain=False):
+    """
+    Replace each group (representative -> current node IDs) by one node; edges
+    inside a group disappear. Returns the new graph and the original node IDs
+    behind every collapsed node.
+    """
+    rep_of = {v: rep for rep, group in groups.items() for v in group}
+    out = Graph(graph.direction)
+    out.subgraphs = dict(graph.subgraphs)
+    collapsed = {}
+    for nid, node in graph.nodes.items():
+        rep = rep_of.get(nid)
+        if rep is None:
+            out.nodes[nid] = node
+            if nid in members:
+                collapsed[nid] = members[nid]
+        elif rep == nid:
+            inner = [orig for v in groups[rep] for orig in members.get(v, (v,))]
+            collapsed[rep] = inner
+            first, last = label_of[inner[0]], label_of[inner[-1]]
+            label = f"{first} … {last}" if chain else f"{first} (+{len(inner) - 1} more)"
+            subgraphs = {graph.nodes[v].subgraph for v in groups[rep]}
+            out.nodes[rep] = Node(rep, label, ("[[", "]]"), subgraphs.pop() if len(subgraphs) == 1 else None)
+    for edge in graph.edges:
+        u, v = rep_of.get(edge.source, edge.source), rep_of.get(edge.target, edge.target)
+        if u == v and edge.source != edge.target:
+            continue
+        out.add_edge(u, v, edge.arrow, edge.label)
+    return out, collapsed
+
+def _group_loops(graph, label_of):
+    """Put each strongly connected loop body of 2+ nodes into its own subgraph."""
+    succ, _ = _adjacency(graph)
+    position = {v: i for i, v in enumerate(graph.nodes)}
+    for component in _strongly_connected(list(graph.nodes), succ):
+        parents = {graph.nodes[v].subgraph for v in component}
+        if len(component) < 2 or len(parents) != 1:
+            continue
+        first = min(component, key=position.get)
+        sid = f"loop_{first}"
+        while sid in graph.subgraphs or sid in graph.nodes:
+            sid += "_"
+        graph.subgraphs[sid] = Subgraph(sid, f"Loop: {label_of[first]}", parents.pop())
+        for v in component:
+            graph.nodes[v].subgraph = sid
+
+def _chains(graph):
+    """Runs of 2+ nodes with exactly one way in and one way out, within one subgraph."""
+    succ, pred = _adjacency(graph)
+
+    def inner(v):
+        return len(pred[v]) == 1 and len(succ[v]) == 1
+
+    def linked(u, v):
+        return inner(v) and graph.nodes[u].subgraph == graph.nodes[v].subgraph
+
+    groups, visited = {}, set()
+    for v in graph.nodes:
+        if v in visited or not inner(v):
+            continue
+        start, walked = v, {v}
+        while pred[start][0] not in walked and linked(start, pred[start][0]):
+            start = pred[start][0]
+            walked.add(start)
+        run = [start]
+        visited.add(start)
+        while succ[run[-1]][0] not in visited and linked(run[-1], succ[run[-1]][0]):
+            run.append(succ[run[-1]][0])
+            visited.add(run[-1])
+        if len(run) >= 2:
+            groups[run[0]] = run
+    return groups
+
+def _matching(graph, members, limit, across):
+    """Pairs of neighbouring nodes to merge, smallest clusters first; at most `limit` pairs."""
+    position = {v: i for i, v in enumerate(graph.nodes)}
+
+    def size(v):
+        return len(members.get(v, (v,)))
+
+    candidates = sorted(
+        (size(e.source) + size(e.target), position[e.source], position[e.target])
+        for e in graph.edges if e.source != e.target
+    )
+    order = list(graph.nodes)
+    matched, groups = set(), {}
+    for _, i, j in candidates:
+        u, v = order[i], order[j]
+        if u in matched or v in matched:
+            continue
+        if not across and graph.nodes[u].subgraph != graph.nodes[v].subgraph:
+            continue
+        matched.update((u, v))
+        groups[order[min(i, j)]] = [order[min(i, j)], order[max(i, j)]]
+        if limit and len(groups) >= limit:
+            break
+    return groups
+
+def simplify_graph(graph, max_nodes=DIAGRAM_MAX_NODES, max_edges=DIAGRAM_MAX_EDGES):
+    """
+    Shrink a diagram that is over its node/edge budget:
+    1. loop bodies (strongly connected components) are grouped into subgraphs;
+    2. linear chains collapse into one node;
+    3. while still over budget, neighbouring nodes merge pairwise into clusters.
+    Returns (graph, {collapsed node ID: [original node IDs]}); a graph within
+    budget comes back unchanged.
+    """
+    if not _over_budget(graph, max_nodes, max_edges):
+        return graph, {}
+    label_of = {nid: node.label or nid for nid, node in graph.nodes.items()}
+    work = Graph(graph.direction)
+    work.subgraphs = dict(graph.subgraphs)
+    work.nodes = {nid: Node(nid, n.label, n.shape, n.subgraph) for nid, n in graph.nodes.items()}
+    work.edges = list(graph.edges)
+    _group_loops(work, label_of)
+    work, members = _contract(work, _chains(work), {}, label_of, chain=True)
+
+    across = False
+    while _over_budget(work, max_nodes, max_edges):
+        excess = len(work.nodes) - max_nodes if max_nodes and len(work.nodes) > max_nodes else 0
+        groups = _matching(work, members, excess, across)
+        if not groups and not across:
+            across = True  # nothing left to merge inside subgraphs: merge across them
+            continue
+        if not groups:
+            # Only unconnected nodes are left to merge
+            succ, pred = _adjacency(work)
+            loose = [v for v in work.nodes if not succ[v] and not pred[v]]
+            if len(loose) < 2:
+                break
+            groups = {loose[0]: loose}
+        work, members = _contract(work, groups, members, label_of)
+    # Subgraphs left without nodes are dropped
+    used = {node.subgraph for node in work.nodes.values()}
+    for sub in list(work.subgraphs.values()):
+        parent = sub.id if sub.id in used else None
+        while parent is not None and parent in work.subgraphs:
+            used.add(parent)
+            parent = work.subgraphs[parent].parent
+    work.subgraphs = {sid: sub for sid, sub in work.subgraphs.items() if sid in used}
+    return work, members
+
+def cluster_graph(graph, node_ids):
+    """The part of `graph` made of `node_ids` and the edges between them."""
+    inside = set(node_ids)
+    part = Graph(graph.direction)
+    for nid in node_ids:
+        node = graph.nodes[nid]
+        part.nodes[nid] = Node(nid, node.label, node.shape)
+    for edge in graph.edges:
+        if edge.source in inside and edge.target in inside:
+            part.add_edge(edge.source, edge.target, edge.arrow, edge.label)
+    return part
+
+def diagram_mermaid(src):
+    """Sanitized Mermaid for `src`, simplified when over the node/edge budget (for mermaid.js rendering)."""
+    fixed = validate_and_fix_mermaid(src)
+    graph = parse_mermaid(fixed)
+    if not _over_budget(graph, DIAGRAM_MAX_NODES, DIAGRAM_MAX_EDGES):
+        return fixed
+    return simplify_graph(graph)[0].to_mermaid()
+
+# ---------- Server-side SVG ----------
+_svg_cache = OrderedDict()
+_svg_lock = threading.Lock()
+
+# Clicking a collapsed node jumps to its cluster below the diagram and opens it
+_OPEN_CLUSTER = """<script>
+function openCluster() {
+  const d = document.getElementById(decodeURIComponent(location.hash.slice(1)));
+  if (d && d.tagName === 'DETAILS') { d.open = true; }
+}
+window.addEventListener('hashchange', openCluster);
+</script>"""
+
+
+@timed("layout")
+def _layout_svg(fixed):
+    graph = parse_mermaid(fixed)
+    shown, clusters = simplify_graph(graph)
+    links = {cid: (f"#cluster-{cid}", f"{len(ids)} steps, click to expand") for cid, ids in clusters.items()}
+    parts = [render_svg(shown, links=links)]
+    for cid, ids in clusters.items():
+        # A cluster can itself be over budget: its own clusters stay collapsed
+        inner = simplify_graph(cluster_graph(graph, ids))[0]
+        parts.append(
+            f'<details id="cluster-{cid}"><summary>{escape(shown.nodes[cid].label)} '
+            f'({len(ids)} steps)</summary>{render_svg(inner)}</details>'
+        )
+    if clusters:
+        parts.append(_OPEN_CLUSTER)
+    return "".join(parts)
+
+def diagram_html(src):
+    """
+    Inline SVG for a (possibly messy) Mermaid flowchart, cached by the hash of
+    the sanitized diagram. Over-budget diagrams are simplified, and each
+    collapsed cluster follows as an expandable <details> block.
+    """
+    fixed = validate_and_fix_mermaid(src)
+    key = hashlib.sha256(f"{DIAGRAM_MAX_NODES}:{DIAGRAM_MAX_EDGES}:{fixed}".encode("utf-8")).hexdigest()
+    with _svg_lock:
+        svg = _svg_cache.get(key)
+        if svg is not None:
+            _svg_cache.move_to_end(key)
+            return svg
+    svg = _layout_svg(fixed)
+    with _svg_lock:
+        _svg_cache[key] = svg
+        while len(_svg_cache) > SVG_CACHE_SIZE:
+            _svg_cache.popitem(last=False)
+    return svg
 
 # ---------- Renderer ----------
+@timed("render_mermaid")
 def render_mermaid(mermaid_code: str):
     """
-    Render the cleaned/transformed Mermaid in an HTML card using mermaid.esm.
-    Shows the cleaned source below for debugging.
+    Render the cleaned/transformed Mermaid in an HTML card: inline SVG laid out
+    on the server, or mermaid.esm in the browser (DIAGRAM_RENDERER=mermaid).
     """
-    fixed = validate_and_fix_mermaid(mermaid_code)
+    # Imported here so the CLI can share the sanitizer without Streamlit installed
+    import streamlit.components.v1 as components
+
+    if DIAGRAM_RENDERER == "svg":
+        try:
+            svg = diagram_html(mermaid_code)
+        except Exception as e:
+            print(f"[WARN] Server-side diagram layout failed, using mermaid.js: {e}")
+        else:
+            html = f"""
+    <!DOCTYPE html>
+    <html>
+    <head>
+      <style>
+        body {{ margin:0; font-family: Inter, Arial, sans-serif; background: transparent; }}
+        .card {{ background:#ffffff; border-radius:12px; padding:16px; box-shadow:0 8px 30px rgba(0,0,0,0.08); max-width:100%; }}
+        .diagram {{ overflow:auto; min-height:220px; }}
+      </style>
+    </head>
+    <body>
+      <div class="card"><div class="diagram">{svg}</div></div>
+    </body>
+    </html>
+    """
+            components.html(html, height=650, scrolling=True)
+            return
+
+    fixed = diagram_mermaid(mermaid_code)
 
     html = f"""
     <!DOCTYPE html>